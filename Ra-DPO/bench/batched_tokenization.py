@@ -0,0 +1,75 @@
+"""
+Check that the batched tokenization of the data loaders (DataLoader.tokenize_elements) gives exactly the same results as
+tokenizing one element at a time (DataLoader.tokenize), and compare their speed.
+
+Sample use is:
+
+python -m bench.batched_tokenization --tokenizer meta-llama/Meta-Llama-3-8B-Instruct --datasets hh ultrabin --num_pairs 512
+
+For every dataset, this takes the chosen and rejected generations of the first num_pairs pairs of the train split (in the
+order in which PairedPreferenceDataLoader tokenizes them: chosen, then rejected), tokenizes them both ways in batches of
+batch_size pairs, and asserts that the token ids, labels, texts and truncated turns are the same.
+"""
+import argparse
+import copy
+import time
+from transformers import AutoTokenizer
+from train import dataloader
+
+
+def get_elements(loader: dataloader.DataLoader, num_pairs: int) -> list:
+    """Return the (conversation, generation) of the chosen and rejected generations of the first num_pairs pairs."""
+    elements = []
+    for example in loader.full_data.values():
+        for i, j in example.pairs:
+            elements.extend([ (example.prompt, example.generations[i]), (example.prompt, example.generations[j]) ])
+            if len(elements) >= 2 * num_pairs:
+                return elements
+    return elements
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    if args.chat_template:
+        tokenizer.chat_template = open(args.chat_template).read()
+
+    print(f"{'dataset':>10} {'elements':>9} {'per element (s)':>16} {'batched (s)':>12} {'speedup':>8}")
+    for name in args.datasets:
+        loader = dataloader.PairedPreferenceDataLoader([ name ], tokenizer, split='train', batch_size=args.batch_size, n_epochs=1,
+                                                       max_length=args.max_length, max_prompt_length=args.max_prompt_length)
+        elements = get_elements(loader, args.num_pairs)
+        # both ways truncate the turns of the conversations in place, so each gets its own copy (with the same sharing of turns)
+        reference_elements, batched_elements = copy.deepcopy(elements), copy.deepcopy(elements)
+
+        start = time.perf_counter()
+        reference = [ loader.tokenize(conversation, generation) for conversation, generation in reference_elements ]
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = []
+        for k in range(0, len(batched_elements), 2 * args.batch_size):
+            batched.extend(loader.tokenize_elements(batched_elements[k:k + 2 * args.batch_size]))
+        batched_time = time.perf_counter() - start
+
+        for k, (x, y) in enumerate(zip(reference, batched)):
+            for key in x:
+                assert x[key] == y[key], f"element {k} of {name} differs in {key}"
+        assert [ c for c, _ in reference_elements ] == [ c for c, _ in batched_elements ], f"the truncated conversations of {name} differ"
+
+        print(f"{name:>10} {len(elements):>9} {reference_time:>16.3f} {batched_time:>12.3f} {reference_time / batched_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the batched tokenization of the data loaders")
+    parser.add_argument("--tokenizer", type=str, required=True, help="Name or path of the tokenizer (with a chat template)")
+    parser.add_argument("--chat_template", type=str, default=None, help="Optional file with the chat template to use instead")
+    parser.add_argument("--datasets", type=str, nargs='+', default=['hh', 'ultrabin'], help="Datasets of train/dataloader.py to sample")
+    parser.add_argument("--num_pairs", type=int, default=512, help="Number of pairs to tokenize per dataset")
+    parser.add_argument("--batch_size", type=int, default=32, help="Number of pairs tokenized at once")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum length of prompt + generation")
+    parser.add_argument("--max_prompt_length", type=int, default=256, help="Maximum length of the prompt")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+"""
+Measure how much of the batches of the data loaders is padding, with and without length-grouped batches
+(DataLoader.length_grouped_batches), as logged by the trainers in dataloader/padding_ratio.
+
+Sample use is:
+
+python -m bench.length_grouping --tokenizer meta-llama/Meta-Llama-3-8B-Instruct --datasets hh shp --length_grouped_batches 0 16 64
+
+For every dataset and number of length-grouped batches, this iterates over num_batches batches of the train split with
+the given data loader and reports the mean padding ratio and the number of padded tokens per example, which is what
+the forward and backward passes of the trainers are spent on.
+"""
+import argparse
+from transformers import AutoTokenizer
+from train import dataloader
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    if args.chat_template:
+        tokenizer.chat_template = open(args.chat_template).read()
+
+    loader_class = getattr(dataloader, args.dataloader)
+
+    print(f"{'dataset':>10} {'grouped':>8} {'batches':>8} {'padding ratio':>14} {'tokens/example':>15}")
+    for name in args.datasets:
+        for length_grouped_batches in args.length_grouped_batches:
+            loader = loader_class([ name ], tokenizer, split='train', batch_size=args.batch_size, n_epochs=1, max_length=args.max_length,
+                                  max_prompt_length=args.max_prompt_length, length_grouped_batches=length_grouped_batches,
+                                  control_tokens={'chosen': '<|good|>', 'rejected': '<|bad|>'})
+
+            padding_ratios, num_tokens, num_examples = [], 0, 0
+            for batch in loader:
+                padding_ratios.append(batch['padding_ratio'])
+                num_tokens += sum(v.numel() for k, v in batch.items() if k.endswith('_combined_input_ids'))
+                num_examples += len(batch['prompt_text'])
+                if len(padding_ratios) >= args.num_batches:
+                    break
+
+            print(f"{name:>10} {length_grouped_batches:>8} {len(padding_ratios):>8} {sum(padding_ratios) / len(padding_ratios):>14.3f} {num_tokens / num_examples:>15.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the padding of the batches of the data loaders with length-grouped batches")
+    parser.add_argument("--tokenizer", type=str, required=True, help="Name or path of the tokenizer (with a chat template)")
+    parser.add_argument("--chat_template", type=str, default=None, help="Optional file with the chat template to use instead")
+    parser.add_argument("--datasets", type=str, nargs='+', default=['hh', 'shp'], help="Datasets of train/dataloader.py to sample")
+    parser.add_argument("--dataloader", type=str, default='PairedPreferenceDataLoader', help="Data loader class of train/dataloader.py")
+    parser.add_argument("--length_grouped_batches", type=int, nargs='+', default=[0, 16, 64], help="Numbers of length-grouped batches to compare")
+    parser.add_argument("--num_batches", type=int, default=256, help="Number of batches to measure per configuration")
+    parser.add_argument("--batch_size", type=int, default=32, help="Number of examples per batch")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum length of prompt + generation")
+    parser.add_argument("--max_prompt_length", type=int, default=256, help="Maximum length of the prompt")
+
+    args = parser.parse_args()
+    main(args)
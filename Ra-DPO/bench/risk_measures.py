@@ -0,0 +1,78 @@
+"""
+CPU micro-benchmark of the risk measures in train/risk_measures.py.
+
+Sample use is:
+
+python -m bench.risk_measures --vocab_sizes 32000 50304 --num_rows 256 --chunk_size 32
+
+For every vocabulary size and risk measure, this reports the time of a forward and backward pass over num_rows
+positions, computed both over all the rows at once and chunk_size rows at a time, and checks that the two agree.
+"""
+import argparse
+import time
+import torch
+from train.risk_measures import RISK_MEASURES, compute_risk
+
+
+def forward_backward(risk_measure: str, logits: torch.Tensor, reference_logits: torch.Tensor, args):
+    """Compute the risk measure of the log ratios of the two distributions and its gradient with respect to logits."""
+    logits = logits.detach().requires_grad_()
+    reference_logps = reference_logits.log_softmax(-1)
+    losses = reference_logps - logits.log_softmax(-1)
+
+    value = compute_risk(risk_measure, losses, reference_logps.exp(), args.confidence_levels, chunk_size=args.chunk_size if args.chunked else None,
+                         theta=args.theta, num_points=args.num_points, wang_lambda=args.wang_lambda)
+    value.sum().backward()
+    return value.detach(), logits.grad
+
+
+def time_call(fn, repeats: int) -> float:
+    """Return the mean wall-clock time of fn() in seconds, after one warmup call."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+
+    print(f"{'vocab':>8} {'measure':>9} {'full (ms)':>10} {'chunked (ms)':>13} {'max |diff|':>11} {'max |grad diff|':>16}")
+    for vocab_size in args.vocab_sizes:
+        logits = torch.randn(args.num_rows, vocab_size) * 3
+        reference_logits = torch.randn(args.num_rows, vocab_size) * 3
+
+        for risk_measure in args.risk_measures:
+            args.chunked = False
+            full_value, full_grad = forward_backward(risk_measure, logits, reference_logits, args)
+            full_time = time_call(lambda: forward_backward(risk_measure, logits, reference_logits, args), args.repeats)
+
+            args.chunked = True
+            chunked_value, chunked_grad = forward_backward(risk_measure, logits, reference_logits, args)
+            chunked_time = time_call(lambda: forward_backward(risk_measure, logits, reference_logits, args), args.repeats)
+
+            max_diff = (full_value - chunked_value).abs().max().item()
+            max_grad_diff = (full_grad - chunked_grad).abs().max().item()
+            assert max_diff <= 1e-5 * full_value.abs().max().item() + 1e-6, f"chunked {risk_measure} disagrees by {max_diff}"
+
+            print(f"{vocab_size:>8} {risk_measure:>9} {full_time * 1000:>10.2f} {chunked_time * 1000:>13.2f} {max_diff:>11.2e} {max_grad_diff:>16.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the risk measures used by Ra_DPOTrainer on CPU")
+    parser.add_argument("--vocab_sizes", type=int, nargs='+', default=[32000, 50304], help="Vocabulary sizes to benchmark")
+    parser.add_argument("--risk_measures", type=str, nargs='+', default=list(RISK_MEASURES), help="Risk measures to benchmark")
+    parser.add_argument("--num_rows", type=int, default=128, help="Number of positions")
+    parser.add_argument("--chunk_size", type=int, default=32, help="Number of positions per chunk in the chunked run")
+    parser.add_argument("--confidence_levels", type=float, nargs='+', default=[0.95], help="Confidence levels of the risk measures")
+    parser.add_argument("--theta", type=float, default=1.0, help="Risk aversion of the entropic risk")
+    parser.add_argument("--num_points", type=int, default=32, help="Number of grid points of the EVaR")
+    parser.add_argument("--wang_lambda", type=float, default=0.5, help="Shift of the Wang transform")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed calls per configuration")
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads(), help="Number of CPU threads")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for reproducibility")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+"""
+CPU benchmark of the shared-prefix forward of PairedPreferenceTrainer (config.shared_prefix_forward) on a small GPT-2.
+
+Sample use is:
+
+python -m bench.shared_prefix --batch_size 4 --prompt_lengths 64 256 --response_length 64
+
+For every prompt length, this builds random chosen/rejected pairs that share their prompt, checks that the per-token
+log probabilities and their gradients match those of the concatenated forward, and reports the time of a forward and
+backward pass of each, as well as the speedup of the shared-prefix forward.
+"""
+import argparse
+import time
+import torch
+from omegaconf import OmegaConf
+from transformers import GPT2Config, GPT2LMHeadModel
+from train.trainers import DPOTrainer
+
+
+def make_batch(args, prompt_length: int) -> dict:
+    """Return a batch like the ones of dataloader.DataLoader, with chosen and rejected responses of varying lengths."""
+    batch = {}
+    prompts = torch.randint(1, args.vocab_size, (args.batch_size, prompt_length))
+
+    for prefix in ['chosen', 'rejected']:
+        responses = torch.randint(1, args.vocab_size, (args.batch_size, args.response_length))
+        response_lengths = torch.randint(args.response_length // 2, args.response_length + 1, (args.batch_size,))
+        attention_mask = torch.cat([ torch.ones_like(prompts), (torch.arange(args.response_length) < response_lengths.unsqueeze(-1)).long() ], dim=1)
+
+        batch[f'{prefix}_combined_input_ids'] = torch.cat([ prompts, responses ], dim=1) * attention_mask
+        batch[f'{prefix}_combined_attention_mask'] = attention_mask
+        batch[f'{prefix}_labels'] = batch[f'{prefix}_combined_input_ids'].masked_fill(attention_mask == 0, -100)
+        batch[f'{prefix}_labels'][:, :prompt_length] = -100
+
+    return batch
+
+
+def forward_backward(trainer: DPOTrainer, model: torch.nn.Module, batch: dict):
+    """Return the per-token log probabilities of the concatenated batch and the gradient of their sum."""
+    model.zero_grad()
+    concatenated_batch = trainer.concatenated_inputs(batch)
+    logits, labels, _ = trainer.concatenated_logits(model, concatenated_batch, trainer.shared_prefix_inputs(model, concatenated_batch))
+    logps = trainer.get_batch_logps(logits, labels)
+    logps.sum().backward()
+    return logps.sum(-1).detach(), torch.cat([ p.grad.flatten() for p in model.parameters() ])
+
+
+def time_call(fn, repeats: int) -> float:
+    """Return the mean wall-clock time of fn() in seconds, after one warmup call."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+
+    model_config = GPT2Config(vocab_size=args.vocab_size, n_positions=max(args.prompt_lengths) + args.response_length,
+                              n_embd=args.hidden_size, n_layer=args.num_layers, n_head=args.num_heads, attn_implementation='eager')
+    model = GPT2LMHeadModel(model_config).train()
+    # dropout would make the two forwards differ
+    model.config.resid_pdrop = model.config.embd_pdrop = model.config.attn_pdrop = 0.0
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.0
+
+    trainer = DPOTrainer.__new__(DPOTrainer)
+    trainer.policy_dtype = torch.float32
+
+    print(f"{'prompt':>7} {'concatenated (ms)':>18} {'shared (ms)':>12} {'speedup':>8} {'max |logp diff|':>16} {'max |grad diff|':>16}")
+    for prompt_length in args.prompt_lengths:
+        batch = make_batch(args, prompt_length)
+
+        trainer.config = OmegaConf.create({'shared_prefix_forward': False, 'model': {'activation_checkpointing': False}})
+        full_logps, full_grad = forward_backward(trainer, model, batch)
+        full_time = time_call(lambda: forward_backward(trainer, model, batch), args.repeats)
+
+        trainer.config.shared_prefix_forward = True
+        shared_logps, shared_grad = forward_backward(trainer, model, batch)
+        shared_time = time_call(lambda: forward_backward(trainer, model, batch), args.repeats)
+
+        max_diff = (full_logps - shared_logps).abs().max().item()
+        max_grad_diff = (full_grad - shared_grad).abs().max().item()
+        assert max_diff <= 1e-4 * full_logps.abs().max().item(), f"shared-prefix log probabilities disagree by {max_diff}"
+
+        print(f"{prompt_length:>7} {full_time * 1000:>18.2f} {shared_time * 1000:>12.2f} {full_time / shared_time:>7.2f}x {max_diff:>16.2e} {max_grad_diff:>16.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the shared-prefix forward of PairedPreferenceTrainer on CPU")
+    parser.add_argument("--prompt_lengths", type=int, nargs='+', default=[64, 256], help="Prompt lengths to benchmark")
+    parser.add_argument("--response_length", type=int, default=64, help="Maximum response length")
+    parser.add_argument("--batch_size", type=int, default=4, help="Number of chosen/rejected pairs")
+    parser.add_argument("--vocab_size", type=int, default=8192, help="Vocabulary size of the model")
+    parser.add_argument("--hidden_size", type=int, default=256, help="Hidden size of the model")
+    parser.add_argument("--num_layers", type=int, default=4, help="Number of layers of the model")
+    parser.add_argument("--num_heads", type=int, default=4, help="Number of attention heads of the model")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed calls per configuration")
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads(), help="Number of CPU threads")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for reproducibility")
+
+    args = parser.parse_args()
+    main(args)
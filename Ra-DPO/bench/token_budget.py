@@ -0,0 +1,138 @@
+"""
+CPU check of the gradient accumulation of BasicTrainer.train with batches of varying sizes (model.max_batch_tokens) on
+a small GPT-2 trained with SFTTrainer.
+
+Sample use is:
+
+python -m bench.token_budget --batch_size 4 --gradient_accumulation_steps 2 --num_updates 3
+
+This trains a copy of the same model twice on the same full batches, once with fixed-size batching and once with
+max_batch_tokens set (so large that every batch is full), and checks that the accumulated gradient of every update is
+the same. It then trains on batches of random sizes with max_batch_tokens set and checks that every accumulated
+gradient is batch_size times the mean gradient of the examples of its update, as it is for full batches.
+"""
+import argparse
+import copy
+import torch
+from accelerate import Accelerator
+from omegaconf import OmegaConf
+from transformers import GPT2Config, GPT2LMHeadModel
+from train.trainers import SFTTrainer
+
+
+class RecordingSGD(torch.optim.SGD):
+    """SGD that records the gradient of every update."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gradients = []
+
+    def step(self, closure=None):
+        self.gradients.append(torch.cat([ p.grad.flatten().clone() for group in self.param_groups for p in group['params'] ]))
+        return super().step(closure)
+
+
+def make_batch(args, batch_size: int) -> dict:
+    """Return an SFT batch like the ones of dataloader.DataLoader, with random prompts and responses of varying lengths."""
+    length = args.prompt_length + args.response_length
+    lengths = torch.randint(args.prompt_length + 1, length + 1, (batch_size,))
+    attention_mask = (torch.arange(length) < lengths.unsqueeze(-1)).long()
+    input_ids = torch.randint(1, args.vocab_size, (batch_size, length)) * attention_mask
+    labels = input_ids.masked_fill(attention_mask == 0, -100)
+    labels[:, :args.prompt_length] = -100
+
+    return {
+        'prompt_text': [ '' ] * batch_size,
+        'target_combined_input_ids': input_ids,
+        'target_combined_attention_mask': attention_mask,
+        'target_labels': labels,
+    }
+
+
+def train(args, model: torch.nn.Module, batches: list, max_batch_tokens) -> list:
+    """Train a copy of the model on the batches with BasicTrainer.train and return the gradient of every update."""
+    config = OmegaConf.create({
+        'optimizer': 'SGD', 'lr': args.lr, 'do_first_eval': False, 'eval_every': 10 ** 9, 'minimum_log_interval_secs': 0,
+        'wandb': {'enabled': False}, 'debug': True, 'intermediate_checkpoints': False,
+        'model': {'batch_size': args.batch_size, 'max_batch_tokens': max_batch_tokens, 'max_grad_norm': 1e9,
+                  'gradient_accumulation_steps': args.gradient_accumulation_steps},
+    })
+
+    accelerator = Accelerator(gradient_accumulation_steps=args.gradient_accumulation_steps, cpu=True)
+    policy = copy.deepcopy(model)
+    optimizer = RecordingSGD(policy.parameters(), lr=args.lr)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    policy, prepared_optimizer, scheduler = accelerator.prepare(policy, optimizer, scheduler)
+
+    # only the attributes that BasicTrainer.train and SFTTrainer.get_batch_metrics use
+    trainer = SFTTrainer.__new__(SFTTrainer)
+    trainer.config, trainer.accelerator, trainer.policy_dtype = config, accelerator, torch.float32
+    trainer.policy, trainer.optimizer, trainer.scheduler, trainer.reference_model = policy, prepared_optimizer, scheduler, None
+    trainer.train_iterator, trainer.num_skip_batches, trainer.example_counter, trainer.batch_counter = batches, 0, 0, 0
+    trainer.accelerator.print = lambda *args, **kwargs: None
+    trainer.train()
+
+    return optimizer.gradients
+
+
+def mean_gradient(model: torch.nn.Module, batches: list) -> torch.Tensor:
+    """Return the mean over all the examples of the batches of the gradient of their SFT loss."""
+    model = copy.deepcopy(model).train()
+    model.zero_grad()
+    num_examples = 0
+    for batch in batches:
+        logits = model(batch['target_combined_input_ids'], attention_mask=batch['target_combined_attention_mask']).logits
+        logps = SFTTrainer.get_batch_logps(None, logits, batch['target_labels'])
+        (-logps.sum()).backward()
+        num_examples += len(batch['prompt_text'])
+    return torch.cat([ p.grad.flatten() for p in model.parameters() ]) / num_examples
+
+
+def max_relative_diff(x: torch.Tensor, y: torch.Tensor) -> float:
+    return ((x - y).abs().max() / y.abs().max()).item()
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model_config = GPT2Config(vocab_size=args.vocab_size, n_positions=args.prompt_length + args.response_length,
+                              n_embd=args.hidden_size, n_layer=args.num_layers, n_head=args.num_heads,
+                              resid_pdrop=0.0, embd_pdrop=0.0, attn_pdrop=0.0)
+    model = GPT2LMHeadModel(model_config)
+    num_batches = args.num_updates * args.gradient_accumulation_steps
+
+    full_batches = [ make_batch(args, args.batch_size) for _ in range(num_batches) ]
+    fixed = train(args, model, full_batches, max_batch_tokens=None)
+    budget = train(args, model, full_batches, max_batch_tokens=10 ** 9)
+    assert len(fixed) == len(budget) == args.num_updates
+    for i, (x, y) in enumerate(zip(budget, fixed)):
+        diff = max_relative_diff(x, y)
+        assert diff <= 1e-5, f"update {i} of full batches differs by {diff} with max_batch_tokens"
+        print(f"full batches, update {i}: max relative gradient difference to fixed-size batching {diff:.2e}")
+
+    # every update is from the same weights, so that its gradient can be compared to the mean gradient of its examples
+    args.lr = 0.0
+    sizes = torch.randint(1, args.batch_size + 1, (num_batches,)).tolist()
+    varying_batches = [ make_batch(args, size) for size in sizes ]
+    varying = train(args, model, varying_batches, max_batch_tokens=10 ** 9)
+    for i, x in enumerate(varying):
+        update_batches = varying_batches[i * args.gradient_accumulation_steps:(i + 1) * args.gradient_accumulation_steps]
+        diff = max_relative_diff(x, args.batch_size * mean_gradient(model, update_batches))
+        assert diff <= 1e-5, f"update {i} of batches of sizes {[ len(b['prompt_text']) for b in update_batches ]} differs by {diff}"
+        print(f"batches of sizes {[ len(b['prompt_text']) for b in update_batches ]}, update {i}: max relative difference to batch_size x mean gradient {diff:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the gradient accumulation of batches of varying sizes on CPU")
+    parser.add_argument("--batch_size", type=int, default=4, help="Maximum number of examples per batch")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=2, help="Number of batches per update")
+    parser.add_argument("--num_updates", type=int, default=3, help="Number of updates to check")
+    parser.add_argument("--prompt_length", type=int, default=16, help="Prompt length")
+    parser.add_argument("--response_length", type=int, default=16, help="Maximum response length")
+    parser.add_argument("--lr", type=float, default=1e-2, help="Learning rate of the SGD updates between full batches")
+    parser.add_argument("--vocab_size", type=int, default=512, help="Vocabulary size of the model")
+    parser.add_argument("--hidden_size", type=int, default=64, help="Hidden size of the model")
+    parser.add_argument("--num_layers", type=int, default=2, help="Number of layers of the model")
+    parser.add_argument("--num_heads", type=int, default=2, help="Number of attention heads of the model")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for reproducibility")
+
+    args = parser.parse_args()
+    main(args)
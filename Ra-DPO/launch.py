@@ -23,7 +23,8 @@ import torch
 torch.backends.cuda.matmul.allow_tf32 = True
 import torch.nn as nn
 from train.utils import disable_dropout
-from train.models import AutoModelForCausalLMWithValueHead, ReferenceModelWrapper
+from train.models import AutoModelForCausalLMWithValueHead, ReferenceModelWrapper, CachedReferenceModel, AdapterDisabledReference, PipelinedReferenceModel
+from train.reference_store import reference_fingerprint, evict_reference_caches, keep_reference_cache_alive
 from train import trainers
 from train import dataloader
 import os
@@ -31,13 +32,138 @@ import hydra
 from omegaconf import OmegaConf, DictConfig
 import wandb
 import json
-from typing import Optional, Set
-from transformers import AutoModelForCausalLM, AutoTokenizer, set_seed
+from typing import Optional, Set, Tuple
+from transformers import AutoModelForCausalLM, AutoTokenizer, PreTrainedTokenizerBase, set_seed
 from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.utils import broadcast_object_list
 from peft import LoraConfig, TaskType, get_peft_model, PeftModel
 from torch.optim.lr_scheduler import CosineAnnealingLR, LinearLR, SequentialLR
 
 
+def get_tokenizer(config: DictConfig, log=print) -> Tuple[PreTrainedTokenizerBase, int]:
+    """Load the tokenizer, with the default chat template and the control tokens of the loss; also return the number of added tokens."""
+    tokenizer_name_or_path = config.model.tokenizer_name_or_path or config.model.name_or_path
+    log(f'Loading tokenizer {tokenizer_name_or_path}')
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+
+    special_tokens = []
+    # Check if the tokenizer has a chat template and set a default one if it doesn't
+    if not tokenizer.chat_template:
+        with open("template.jinja") as f:
+            tokenizer.chat_template = f.read()
+
+        log("Default chat template set.")
+
+    control_tokens = list(config.loss.get("control_tokens", {}).values())
+    special_tokens.extend(control_tokens)
+
+    num_tokens_added = tokenizer.add_special_tokens({"additional_special_tokens": special_tokens})
+    return tokenizer, num_tokens_added
+
+
+def get_data_iterators(config: DictConfig, tokenizer, **kwargs) -> Tuple[dataloader.DataLoader, dataloader.DataLoader]:
+    """Return the train and eval dataloaders of the config; kwargs override the arguments they share."""
+    data_loader_class = getattr(dataloader, config.loss.dataloader)
+    data_iterator_kwargs = dict(
+        max_length=config.model.max_length,
+        max_prompt_length=config.model.max_prompt_length,
+        seed=config.seed,
+        frac_unique_desirable=config.frac_unique_desirable,
+        frac_unique_undesirable=config.frac_unique_undesirable,
+        control_tokens=config.loss.get("control_tokens", {}),
+        pack_sequences=config.pack_sequences,
+        tokenization_cache_dir=config.tokenization_cache_dir,
+        num_tokenization_threads=config.num_tokenization_threads,
+        length_grouped_batches=config.length_grouped_batches,
+        max_batch_tokens=config.model.max_batch_tokens,
+    )
+    data_iterator_kwargs.update(kwargs)
+
+    train_iterator = data_loader_class(
+        config.datasets, 
+        tokenizer,
+        split='train',
+        batch_size=config.model.batch_size,
+        n_epochs=config.n_epochs,
+        n_examples=config.n_examples,
+        **data_iterator_kwargs
+    )
+    eval_iterator = data_loader_class(
+        config.datasets, 
+        tokenizer,
+        split='test',
+        batch_size=config.model.eval_batch_size,
+        n_examples=config.n_eval_examples, 
+        n_epochs=(1 if config.n_eval_examples is None else None),
+        **data_iterator_kwargs
+    )
+
+    if config.prefetch_batches:
+        train_iterator = dataloader.PrefetchLoader(train_iterator, config.prefetch_batches)
+        eval_iterator = dataloader.PrefetchLoader(eval_iterator, config.prefetch_batches)
+
+    return train_iterator, eval_iterator
+
+
+def check_reference_cache(config: DictConfig, TrainerClass):
+    """Raise a ValueError if the reference values that the trainer needs cannot be cached as configured."""
+    if TrainerClass.use_reference_distribution and not config.loss.get('reference_topk'):
+        raise ValueError(f"{config.loss.trainer} needs the token-level reference distribution; set loss.reference_topk to cache it")
+
+    if config.reference_cache_dtype == 'sum' and (not TrainerClass.sums_reference_logps or config.loss.get('tokenwise_KL')):
+        raise ValueError(f"{config.loss.trainer} needs the token-level reference logprobs; reference_cache_dtype cannot be 'sum'")
+
+
+def get_reference_model(config: DictConfig, TrainerClass, tokenizer, num_tokens_added: int, log=print) -> nn.Module:
+    """Load the reference model of the trainer on CPU, in eval mode."""
+    reference_cls = TrainerClass.reference_hf_model_class
+    reference_kwargs = {
+        'torch_dtype': getattr(torch, config.model.reference_dtype),
+        'attn_implementation' : config.model.attn_implementation if config.model.policy_dtype in ["float16", "bfloat16"] else "eager",
+    }
+    reference_path = config.model.load_from or config.model.name_or_path
+    log(f'Loading reference model from {reference_path}')
+    reference_model = reference_cls.from_pretrained(reference_path, **reference_kwargs)
+
+    if config.model.activation_checkpointing: 
+        reference_model.gradient_checkpointing_enable()
+
+    if num_tokens_added:
+        reference_model.resize_token_embeddings(len(tokenizer))
+
+    reference_model.eval()
+    return reference_model
+
+
+def use_reference_cache(config: DictConfig, TrainerClass, reference_model: nn.Module, tokenizer, is_main_process: bool) -> str:
+    """
+    Point config.load_reference_logprobs (and config.load_reference_distributions) at the entry of config.reference_cache_dir
+    for the fingerprint of the reference model, tokenizer and truncation settings, so that the cache of any earlier run
+    with the same fingerprint is reused. Only the main process hashes the weights; the other processes receive the
+    fingerprint from it (broadcasting is a no-op outside of distributed runs). The main process marks the entry as used for as long as it runs (so that other
+    runs don't evict it) and evicts old entries. Returns the path of the entry.
+    """
+    fingerprint, components = reference_fingerprint(reference_model, tokenizer, config) if is_main_process else (None, None)
+    fingerprint, components = broadcast_object_list([fingerprint, components])
+    cache_path = os.path.join(config.reference_cache_dir, fingerprint)
+    # stores of other formats of the log probabilities are kept apart
+    config.load_reference_logprobs = os.path.join(cache_path, 'reference_logprobs' + ('' if config.reference_cache_dtype == 'float16' else f'_{config.reference_cache_dtype}'))
+    if TrainerClass.use_reference_distribution and not config.load_reference_distributions:
+        config.load_reference_distributions = os.path.join(cache_path, f'reference_distributions_top{config.loss.reference_topk}')
+
+    if is_main_process:
+        os.makedirs(cache_path, exist_ok=True)
+        with open(os.path.join(cache_path, 'fingerprint.json'), 'w') as f:
+            json.dump(components, f, indent=2)
+        keep_reference_cache_alive(cache_path)
+        evict_reference_caches(config.reference_cache_dir, keep=fingerprint, max_size_gb=config.reference_cache_max_size_gb,
+                               max_age_days=config.reference_cache_max_age_days)
+
+    return cache_path
+
+
 def main(config: DictConfig):
     """Main entry point for training. Validates config, creates/initializes model(s), and starts training."""
     # Resolve hydra references, e.g. so we don't re-compute the run directory
@@ -92,94 +218,84 @@ def main(config: DictConfig):
         accelerator.print(f'Writing to {config.local_run_dir}')
         accelerator.print('=' * 80)
 
-    # Prepare tokenizer
-    tokenizer_name_or_path = config.model.tokenizer_name_or_path or config.model.name_or_path
-    accelerator.print(f'Loading tokenizer {tokenizer_name_or_path}')
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id
-
-    special_tokens = []
-    # Check if the tokenizer has a chat template and set a default one if it doesn't
-    if not tokenizer.chat_template:
-        with open("template.jinja") as f:
-            tokenizer.chat_template = f.read()
-
-        accelerator.print("Default chat template set.")
-
-    control_tokens = list(config.loss.get("control_tokens", {}).values())
-    special_tokens.extend(control_tokens)
-
-    num_tokens_added = tokenizer.add_special_tokens({"additional_special_tokens": special_tokens})
+    tokenizer, num_tokens_added = get_tokenizer(config, accelerator.print)
 
     # Create data loaders
     accelerator.print(f'Loading data')
-    data_loader_class = getattr(dataloader, config.loss.dataloader)
-    data_iterator_kwargs = dict(
-        max_length=config.model.max_length,
-        max_prompt_length=config.model.max_prompt_length,
-        seed=config.seed,
-        frac_unique_desirable=config.frac_unique_desirable,
-        frac_unique_undesirable=config.frac_unique_undesirable,
-        control_tokens=config.loss.get("control_tokens", {}),
-    )
-    train_iterator = data_loader_class(
-        config.datasets, 
-        tokenizer,
-        split='train',
-        batch_size=config.model.batch_size,
-        n_epochs=config.n_epochs,
-        n_examples=config.n_examples,
-        **data_iterator_kwargs
-    )
-    eval_iterator = data_loader_class(
-        config.datasets, 
-        tokenizer,
-        split='test',
-        batch_size=config.model.eval_batch_size,
-        n_examples=config.n_eval_examples, 
-        n_epochs=(1 if config.n_eval_examples is None else None),
-        **data_iterator_kwargs
-    )
+    # every process only loads (and caches the reference values of) its own shard of every batch
+    train_iterator, eval_iterator = get_data_iterators(config, tokenizer, process_index=accelerator.process_index, num_processes=accelerator.num_processes)
 
     TrainerClass = getattr(trainers, config.loss.trainer)
-    # Building reference
-    if TrainerClass.use_reference_model:
-        reference_cls = TrainerClass.reference_hf_model_class
-        reference_kwargs = {
-            'torch_dtype': getattr(torch, config.model.reference_dtype),
-            'attn_implementation' : config.model.attn_implementation if config.model.policy_dtype in ["float16", "bfloat16"] else "eager",
-        }
-        reference_path = config.model.load_from or config.model.name_or_path
-        accelerator.print(f'Loading reference model from {reference_path}')
-        reference_model = reference_cls.from_pretrained(reference_path, **reference_kwargs)
+    if config.model.max_batch_tokens and TrainerClass.train is not trainers.BasicTrainer.train:
+        raise ValueError(f"{config.loss.trainer} does not support batches of varying sizes; set model.max_batch_tokens=null")
 
-        if config.model.activation_checkpointing: 
-            reference_model.gradient_checkpointing_enable()
+    # with LoRA, the reference can be the policy with its adapters disabled (unless it is cached anyway)
+    use_peft_reference = TrainerClass.use_reference_model and config.model.use_peft and config.model.peft_reference and not config.cache_reference_logprobs
 
-        if num_tokens_added:
-            reference_model.resize_token_embeddings(len(tokenizer))
+    # Building reference
+    if TrainerClass.use_reference_model:
+        if config.cache_reference_logprobs:
+            check_reference_cache(config, TrainerClass)
 
-        reference_model.eval()
+        if use_peft_reference:
+            if TrainerClass.policy_hf_model_class != AutoModelForCausalLM:
+                raise ValueError(f"{config.loss.trainer} cannot use the policy as its reference; set model.peft_reference=false")
 
-        if config.cache_reference_logprobs:
-            reference_accelerator = Accelerator(
-                project_dir=config.local_run_dir,
-                gradient_accumulation_steps=config.model.gradient_accumulation_steps,
-                kwargs_handlers=[DistributedDataParallelKwargs(find_unused_parameters=True)]
-            )
+            if config.pipeline_reference_depth:
+                raise ValueError("the policy cannot be run as its reference on another thread; set pipeline_reference_depth=0 or model.peft_reference=false")
 
-            if reference_accelerator.state.fsdp_plugin is not None:
-                reference_accelerator.state.fsdp_plugin.transformer_layer_cls_to_wrap = config.model.block_name
+            accelerator.print('Using the policy with its adapters disabled as the reference model')
+            reference_model = None # set once the policy is built
+        elif config.cache_reference_logprobs and config.precomputed_reference:
+            # the stores were scored offline by score_reference.py, so the reference model is never loaded
+            if not config.load_reference_logprobs or (TrainerClass.use_reference_distribution and not config.load_reference_distributions):
+                raise ValueError("precomputed_reference needs the load_reference_logprobs (and load_reference_distributions) printed by score_reference.py")
 
-            reference_accelerator.print("precomputing logprobs ...")
-            reference_model = ReferenceModelWrapper(
-                reference_accelerator, 
-                reference_model, 
-                tokenizer, 
-                config, 
-                iterators=[train_iterator, eval_iterator],
-            )
+            accelerator.print(f'Reading reference values from {config.load_reference_logprobs}')
+            reference_model = CachedReferenceModel(config, store_distributions=TrainerClass.use_reference_distribution, create=False)
+        else:
+            reference_model = get_reference_model(config, TrainerClass, tokenizer, num_tokens_added, accelerator.print)
+
+            if config.cache_reference_logprobs:
+                reference_accelerator = Accelerator(
+                    project_dir=config.local_run_dir,
+                    gradient_accumulation_steps=config.model.gradient_accumulation_steps,
+                    kwargs_handlers=[DistributedDataParallelKwargs(find_unused_parameters=True)]
+                )
+
+                if reference_accelerator.state.fsdp_plugin is not None:
+                    reference_accelerator.state.fsdp_plugin.transformer_layer_cls_to_wrap = config.model.block_name
+
+                if config.reference_cache_dir and not config.load_reference_logprobs:
+                    # reuse the cache of any earlier run with the same reference model, tokenizer and truncation settings
+                    cache_path = use_reference_cache(config, TrainerClass, reference_model, tokenizer, reference_accelerator.is_main_process)
+                    reference_accelerator.wait_for_everyone()
+                    reference_accelerator.print(f"using reference cache {cache_path}")
+
+                reference_accelerator.print("precomputing logprobs ...")
+                reference_model = ReferenceModelWrapper(
+                    reference_accelerator, 
+                    reference_model, 
+                    tokenizer, 
+                    config, 
+                    iterators=([eval_iterator] if config.eval_only else [train_iterator, eval_iterator]),
+                    store_distributions=TrainerClass.use_reference_distribution,
+                )
+            elif config.pipeline_reference_depth:
+                if TrainerClass.policy_hf_model_class != AutoModelForCausalLM:
+                    raise ValueError(f"{config.loss.trainer} does not support pipeline_reference_depth")
+                if TrainerClass.use_reference_distribution and not config.loss.get('reference_topk'):
+                    raise ValueError(f"{config.loss.trainer} needs the token-level reference distribution; set loss.reference_topk to pipeline it")
+
+                accelerator.print(f'Computing the reference outputs up to {config.pipeline_reference_depth} batches ahead')
+                reference_model = PipelinedReferenceModel(
+                    reference_model,
+                    config,
+                    accelerator.device,
+                    depth=config.pipeline_reference_depth,
+                    store_distributions=TrainerClass.use_reference_distribution,
+                    autocast=accelerator.autocast,
+                )
     else:
         reference_model = None
 
@@ -232,6 +348,9 @@ def main(config: DictConfig):
     else:
         peft_config = None
 
+    if use_peft_reference:
+        reference_model = AdapterDisabledReference(policy)
+
     if config.model.activation_checkpointing:
         policy.gradient_checkpointing_enable()
 
@@ -252,7 +371,7 @@ def main(config: DictConfig):
         scheduler.load_state_dict(scheduler_state)
 
         metrics = json.load(open(os.path.join(config.model.from_checkpoint, 'metrics.json')))
-        num_skip_batches = int(metrics.get('counter', 0) / config.model.batch_size)
+        num_skip_batches = metrics.get('batch_counter', int(metrics.get('counter', 0) / config.model.batch_size))
     else:
         num_skip_batches = 0
     
@@ -270,6 +389,14 @@ def main(config: DictConfig):
         num_skip_batches=num_skip_batches,
     )
 
+    if config.eval_only:
+        results = trainer.eval()
+
+        if accelerator.is_main_process:
+            with open(os.path.join(config.local_run_dir, 'eval_results.json'), 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
     trainer.train()
     trainer.save(
         os.path.join(config.local_run_dir, 'FINAL'), 
@@ -0,0 +1,218 @@
+# Copyright (c) 2023 Contextual AI, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Offline scoring of the reference model: write the reference log probabilities (and, for trainers that need them, e.g.
+TDPO and Ra-DPO, the top-k reference distributions) of every example of the datasets to the reference stores, so that
+any number of training runs can read them without loading the reference model.
+
+Sample use is:
+
+python score_reference.py loss=ra-dpo model=llama datasets=[hh] ++model.load_from=PATH ++reference_cache_dir=/shared/reference_caches ++reference_score_workers=4
+
+which takes the same config as launch.py and prints the overrides for launch.py, e.g.
+
+accelerate launch ... launch.py loss=ra-dpo model=llama datasets=[hh] ++cache_reference_logprobs=true ++precomputed_reference=true ++load_reference_logprobs=... ++load_reference_distributions=...
+
+The stores are at config.load_reference_logprobs (and config.load_reference_distributions), at the entry of
+config.reference_cache_dir for the fingerprint of the reference model, or in the run directory. Only the sequences
+missing from them are scored, so scoring more datasets into the same stores appends to them.
+
+The sequences are sorted by length and grouped into batches of at most model.eval_batch_size * model.max_length tokens
+(the padded size of an eval batch), so that little compute is spent on padding. The batches are scored by a pool of
+config.reference_score_workers processes, each with its own copy of the reference model on one of the GPUs (round-robin)
+or on CPU, while the main process writes the results to the stores every reference_cache_flush_every batches.
+"""
+import os
+import hydra
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf, DictConfig
+from tqdm import tqdm
+from typing import Dict, List, Tuple
+from transformers import set_seed
+
+from launch import get_tokenizer, get_data_iterators, get_reference_model, check_reference_cache, use_reference_cache
+from train import trainers
+from train.models import CachedReferenceModel, reference_logprobs, reference_distributions
+from train.reference_store import unique_writer
+
+
+# state of every worker process, set by init_worker
+worker = {}
+
+
+def init_worker(config: Dict, vocab_size: int, devices: mp.Queue):
+    """Load the reference model of a worker onto the next free device."""
+    config = OmegaConf.create(config)
+    device = devices.get()
+    if device == 'cpu':
+        torch.set_num_threads(max(1, os.cpu_count() // config.reference_score_workers))
+    else:
+        torch.cuda.set_device(device)
+
+    TrainerClass = getattr(trainers, config.loss.trainer)
+    tokenizer, num_tokens_added = get_tokenizer(config, log=lambda *args: None)
+    reference_model = get_reference_model(config, TrainerClass, tokenizer, num_tokens_added, log=lambda *args: None)
+    assert len(tokenizer) == vocab_size
+
+    worker.update(
+        config=config,
+        device=device,
+        model=reference_model.to(device),
+        dtype=getattr(torch, config.model.reference_dtype),
+        pad_token_id=tokenizer.pad_token_id,
+        store_distributions=TrainerClass.use_reference_distribution,
+    )
+
+
+def score_batch(sequences: List[Tuple[int, np.ndarray, np.ndarray]]) -> Tuple[List[int], List[np.ndarray], List[Tuple[np.ndarray, ...]]]:
+    """
+    Score a batch of (example id, input ids, labels) sequences with the reference model of the worker.
+
+    Returns:
+        The example ids, the log probabilities of every sequence (one per token except the last), and the sparse reference
+        distributions of every sequence (see models.reference_distributions), or None if they are not needed.
+    """
+    keys, input_ids, labels = zip(*sequences)
+    lengths = [ len(x) for x in input_ids ]
+    max_length = max(lengths)
+
+    # right padding, like dataloader.DataLoader.collate
+    padded_input_ids = torch.full((len(keys), max_length), worker['pad_token_id'], dtype=torch.long)
+    padded_labels = torch.full((len(keys), max_length), -100, dtype=torch.long)
+    attention_mask = torch.zeros((len(keys), max_length), dtype=torch.long)
+    for i, length in enumerate(lengths):
+        padded_input_ids[i, :length] = torch.from_numpy(input_ids[i])
+        padded_labels[i, :length] = torch.from_numpy(labels[i])
+        attention_mask[i, :length] = 1
+
+    device = worker['device']
+    padded_labels = padded_labels.to(device)
+    with torch.no_grad():
+        logits = worker['model'](padded_input_ids.to(device), attention_mask=attention_mask.to(device)).logits.to(worker['dtype'])
+        batch_logprobs = reference_logprobs(logits, padded_labels).cpu().numpy()
+        logprobs = [ v[:length - 1] for v, length in zip(batch_logprobs, lengths) ]
+
+        distributions = None
+        if worker['store_distributions']:
+            config = worker['config']
+            distributions = reference_distributions(logits, padded_labels, config.loss.reference_topk, config.loss.chunk_size)
+
+    return list(keys), logprobs, distributions
+
+
+def missing_sequences(iterators, stores) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+    """Return the (example id, input ids, labels) of every distinct sequence in the iterators that is missing from a store."""
+    sequences = {}
+    for iterator in iterators:
+        for batch in iterator:
+            # should be 'target', 'KL' for KTO and just 'target' for everything else
+            prefixes = [ k[:k.index('_')] for k in batch if k.endswith('_combined_input_ids') ]
+
+            for prefix in prefixes:
+                example_ids = batch[f'{prefix}_example_id']
+                missing = ~np.logical_and.reduce([ store.contains(example_ids) for store in stores ])
+                lengths = batch[f'{prefix}_combined_attention_mask'].sum(-1).tolist()
+
+                for i in np.nonzero(missing)[0].tolist():
+                    key = example_ids[i].item()
+                    if key not in sequences:
+                        input_ids = batch[f'{prefix}_combined_input_ids'][i, :lengths[i]].numpy().astype(np.int32)
+                        labels = batch[f'{prefix}_labels'][i, :lengths[i]].numpy().astype(np.int32)
+                        sequences[key] = (key, input_ids, labels)
+
+    return list(sequences.values())
+
+
+def length_sorted_batches(sequences: List[Tuple[int, np.ndarray, np.ndarray]], max_tokens: int) -> List[List[Tuple[int, np.ndarray, np.ndarray]]]:
+    """Group the sequences, longest first, into batches whose padded size is at most max_tokens (or of one sequence)."""
+    batches = []
+    for sequence in sorted(sequences, key=lambda x: len(x[1]), reverse=True):
+        # the first sequence of a batch is its longest
+        if batches and (len(batches[-1]) + 1) * len(batches[-1][0][1]) <= max_tokens:
+            batches[-1].append(sequence)
+        else:
+            batches.append([ sequence ])
+
+    return batches
+
+
+def main(config: DictConfig):
+    """Score the reference values of every example in the datasets of the config that are missing from the stores."""
+    OmegaConf.resolve(config)
+    set_seed(config.seed)
+
+    TrainerClass = getattr(trainers, config.loss.trainer)
+    if not TrainerClass.use_reference_model:
+        raise ValueError(f"{config.loss.trainer} does not use a reference model")
+    check_reference_cache(config, TrainerClass)
+
+    tokenizer, num_tokens_added = get_tokenizer(config)
+    # the packed keys are not needed to score the sequences
+    train_iterator, eval_iterator = get_data_iterators(config, tokenizer, pack_sequences=False)
+
+    if config.reference_cache_dir and not config.load_reference_logprobs:
+        # the fingerprint is computed from the weights, so the main process also loads the reference model, once
+        reference_model = get_reference_model(config, TrainerClass, tokenizer, num_tokens_added)
+        print(f"using reference cache {use_reference_cache(config, TrainerClass, reference_model, tokenizer, is_main_process=True)}")
+        del reference_model
+
+    cached_reference = CachedReferenceModel(config, store_distributions=TrainerClass.use_reference_distribution)
+    stores = [ cached_reference.logprob_store ] + ([ cached_reference.distribution_store ] if cached_reference.store_distributions else [])
+
+    print("Finding the sequences missing from the reference stores")
+    sequences = missing_sequences([eval_iterator] if config.eval_only else [train_iterator, eval_iterator], stores)
+    batches = length_sorted_batches(sequences, config.model.eval_batch_size * config.model.max_length)
+    print(f"Scoring {len(sequences)} sequences in {len(batches)} batches")
+
+    if batches:
+        # other scoring or training runs may write to the same stores at once
+        writer = unique_writer('score')
+        num_gpus = torch.cuda.device_count()
+        num_workers = config.reference_score_workers or max(num_gpus, 1)
+        config.reference_score_workers = num_workers
+
+        ctx = mp.get_context('spawn')
+        devices = ctx.Queue()
+        for i in range(num_workers):
+            devices.put(f'cuda:{i % num_gpus}' if num_gpus else 'cpu')
+
+        with ctx.Pool(num_workers, initializer=init_worker, initargs=(OmegaConf.to_container(config), len(tokenizer), devices)) as pool:
+            pbar = tqdm(total=len(sequences), dynamic_ncols=True, desc="Scoring reference model")
+
+            # the longest batches are scored first, so that running out of memory happens early
+            for num_batches, (keys, logprobs, distributions) in enumerate(pool.imap_unordered(score_batch, batches), start=1):
+                for key, v in zip(keys, logprobs):
+                    cached_reference.logprob_store.add(key, cached_reference.encode_logprobs(v))
+
+                if distributions is not None:
+                    for key, v in zip(keys, distributions):
+                        cached_reference.distribution_store.add(key, dict(zip(cached_reference.distribution_fields, v)))
+
+                if num_batches % config.reference_cache_flush_every == 0:
+                    for store in stores:
+                        store.flush(writer)
+
+                pbar.update(len(keys))
+
+            pbar.close()
+
+        for store in stores:
+            store.flush(writer)
+
+    overrides = f"++cache_reference_logprobs=true ++precomputed_reference=true ++load_reference_logprobs={config.load_reference_logprobs or cached_reference.logprob_store.path}"
+    if cached_reference.store_distributions:
+        overrides += f" ++load_reference_distributions={config.load_reference_distributions or cached_reference.distribution_store.path}"
+    print(f"Train without loading the reference model with: launch.py ... {overrides}")
+
+
+@hydra.main(version_base=None, config_path="config", config_name="HH_py14_risk_config.yaml")
+def hydra_main(config: DictConfig):
+    main(config)
+
+if __name__ == '__main__':
+    hydra_main()
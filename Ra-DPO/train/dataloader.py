@@ -20,6 +20,8 @@ Each Example object will contain
 """
 
 import datasets
+import hashlib
+import os
 import torch
 from torch.nn.utils.rnn import pad_sequence
 from collections import defaultdict
@@ -27,9 +29,14 @@ import tqdm
 import re
 import random
 import json
-from typing import Dict, List, Optional, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Event, Thread
+from typing import Callable, Dict, List, Optional, Tuple
 from dataclasses import dataclass, field
 from .utils import rank0_print, on_rank0, delete_dict
+from .reference_store import ReferenceStore, unique_writer
 import pandas as pd
 import numpy as np
 
@@ -429,12 +436,99 @@ def get_ultrafeedback_hybrid(split: str) -> Dataset:
     return data
 
 
+class TokenizationCache:
+    """
+    On-disk cache of the tokenized batch elements of DataLoader.tokenize_elements (see DataLoader.tokenize), kept in
+    a reference_store.ReferenceStore with one field per column: the token ids, the labels, the untruncated prompt and the
+    truncated texts, the latter as utf-8 bytes. Every element is keyed by a hash of its conversation and generation, in
+    a directory of config.tokenization_cache_dir for the fingerprint of everything else that the tokenization depends on,
+    so that later epochs and later runs read the token ids instead of tokenizing the element again.
+
+    The elements added are kept in memory until they are written every flush_every elements (and at the end of every
+    epoch of the data loader).
+    """
+    fields = {
+        'combined_input_ids': ('int32', 1),
+        'labels': ('int32', 1),
+        'prompt_text': ('uint8', 1),
+        'text': ('uint8', 1),
+        'combined_text': ('uint8', 1),
+        # the contents of the turns of the conversation after truncation, as a json list
+        'contents': ('uint8', 1),
+    }
+    text_fields = ['prompt_text', 'text', 'combined_text', 'contents']
+
+    def __init__(self, cache_dir: str, components: Dict, writer: str, flush_every: int = 1024):
+        """
+        Args:
+            cache_dir: directory of the caches of all fingerprints
+            components: the dataset, split, tokenizer and truncation settings that the tokenized elements depend on
+            writer: name of the segments written by this process, unique across processes and runs (see ReferenceStore.flush)
+            flush_every: number of elements added between writes
+        """
+        fingerprint = hashlib.blake2b(json.dumps(components, sort_keys=True).encode(), digest_size=16).hexdigest()
+        self.path = os.path.join(cache_dir, fingerprint)
+        self.store = ReferenceStore(self.path, fields=self.fields)
+        self.writer = writer
+        self.flush_every = flush_every
+        self.pending = {}
+
+        # several processes may open the cache at once; they all write the same file
+        tmp_path = os.path.join(self.path, f'fingerprint.json.{writer}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(components, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, 'fingerprint.json'))
+
+    def key(self, conversation: List[Dict[str, str]], generation: str) -> int:
+        """Return the signed 64-bit key of the batch element of the given conversation and generation."""
+        digest = hashlib.blake2b(json.dumps([conversation, generation], sort_keys=True).encode(), digest_size=8)
+        return int.from_bytes(digest.digest(), 'little', signed=True)
+
+    def get(self, key: int) -> Optional[Dict]:
+        """Return the tokenized element with the given key (see DataLoader.tokenize), or None if it is not cached."""
+        if key in self.pending:
+            return self.pending[key]
+
+        tokenized = self.store.get(key)
+        if tokenized is None:
+            return None
+
+        for name in self.text_fields:
+            tokenized[name] = tokenized[name].tobytes().decode('utf-8')
+
+        tokenized['contents'] = json.loads(tokenized['contents'])
+        tokenized['combined_input_ids'] = tokenized['combined_input_ids'].reshape(-1).tolist()
+        tokenized['labels'] = tokenized['labels'].reshape(-1).tolist()
+        return tokenized
+
+    def add(self, key: int, tokenized: Dict):
+        """Add a tokenized element, and write the ones added so far if there are flush_every of them."""
+        self.pending[key] = tokenized
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write the elements added since the last flush to the store."""
+        for key, tokenized in self.pending.items():
+            values = dict(tokenized, contents=json.dumps(tokenized['contents']))
+            for name in self.text_fields:
+                values[name] = np.frombuffer(values[name].encode('utf-8'), dtype=np.uint8)
+            self.store.add(key, values)
+
+        self.store.flush(self.writer)
+        self.pending = {}
+
+
 class DataLoader:
     """
     The base data loader class, similar to the one from the DPO repo.
     Subclass this and overwrite the __iter__ method as needed, since the batcch elements will be different depending
     on whether you're doing SFT, aligning with a pairwise loss like DPO, or alignment with a unary loss like KTO. 
     """
+    # the prefixes of the sequences that are packed without padding if pack_sequences is true, in the order in which
+    # the trainer concatenates them (see pack)
+    packed_prefixes = []
+
     def __init__(self, 
                  dataset_names: List[str],
                  tokenizer,
@@ -447,6 +541,13 @@ class DataLoader:
                  n_examples: Optional[int] = None,
                  seed: int = 0,
                  control_tokens: Dict = {},
+                 pack_sequences: bool = False,
+                 process_index: int = 0,
+                 num_processes: int = 1,
+                 tokenization_cache_dir: Optional[str] = None,
+                 num_tokenization_threads: int = 1,
+                 length_grouped_batches: int = 0,
+                 max_batch_tokens: Optional[int] = None,
                  **kwargs):
         
         torch.manual_seed(seed)
@@ -458,13 +559,41 @@ class DataLoader:
         self.max_length = max_length
         self.max_prompt_length = max_prompt_length
         self.max_prompt_count = max_prompt_count
+        self.pack_sequences = pack_sequences
+        # every batch of batch_size examples is split evenly across the processes, each of which only collates its own shard
+        self.process_index = process_index
+        self.num_processes = num_processes
+        if batch_size % num_processes != 0:
+            raise ValueError(f"the batch size ({batch_size}) must be divisible by the number of processes ({num_processes}) on the {split} split")
         self.kwargs = kwargs
+        # the tokenizer settings that, together with the token ids, determine the example ids
+        self.tokenizer_fingerprint = json.dumps([tokenizer.name_or_path, len(tokenizer), getattr(tokenizer, 'chat_template', None)]).encode()
 
         assert n_epochs is not None or n_examples is not None, "Must specify either n_epochs or n_examples"
         self.n_epochs = n_epochs
         self.epoch_idx = 0
         self.n_examples = n_examples
         
+        self.tokenization_cache = None
+        if tokenization_cache_dir:
+            self.tokenization_cache = TokenizationCache(tokenization_cache_dir, {
+                'datasets': sorted(dataset_names),
+                'split': split,
+                'tokenizer': [tokenizer.name_or_path, type(tokenizer).__name__, len(tokenizer), tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id],
+                'chat_template': getattr(tokenizer, 'chat_template', None),
+                'max_length': max_length,
+                'max_prompt_length': max_prompt_length,
+                'control_tokens': { k: str(v) for k, v in control_tokens.items() },
+            }, writer=unique_writer(f'rank{process_index}'))
+
+        # threads that tokenize parts of every wave of tokenize_elements (fast tokenizers release the GIL while encoding)
+        self.num_tokenization_threads = num_tokenization_threads
+        self.tokenization_threads = ThreadPoolExecutor(num_tokenization_threads) if num_tokenization_threads > 1 else None
+        # if > 0, the examples are grouped by length within every length_grouped_batches batches (see tokenized_batches)
+        self.length_grouped_batches = length_grouped_batches
+        # if set, batches have up to batch_size examples, as many as fit in this many padded tokens per process (see token_budget_batches)
+        self.max_batch_tokens = max_batch_tokens
+
         self.full_data = {} # a dict of Examples
 
         for name in dataset_names:
@@ -484,7 +613,9 @@ class DataLoader:
         # first, pad everything to the same length
         padded_batch = {}
         for k in batch[0].keys():
-            if k.endswith('_input_ids') or k.endswith('_attention_mask') or k.endswith('_labels'):
+            if k.endswith('_example_id'):
+                padded_batch[k] = torch.LongTensor([ex[k] for ex in batch])
+            elif k.endswith('_input_ids') or k.endswith('_attention_mask') or k.endswith('_labels'):
                 if 'prompt' in k:
                     # flip prompt so that you are padding to the beginning
                     to_pad = [torch.LongTensor(ex[k][::-1]) for ex in batch]
@@ -506,14 +637,53 @@ class DataLoader:
             else:
                 padded_batch[k] = [ex[k] for ex in batch]
 
+        # the fraction of the padded sequences that is padding, which length_grouped_batches reduces
+        attention_masks = [ padded_batch[k] for k in padded_batch if k.endswith('_combined_attention_mask') ]
+        if attention_masks:
+            padded_batch['padding_ratio'] = 1 - sum(x.sum().item() for x in attention_masks) / sum(x.numel() for x in attention_masks)
+
+        if self.pack_sequences and self.packed_prefixes:
+            padded_batch.update(self.pack(batch))
+
         return padded_batch
 
+    def pack(self, batch: List[Dict]) -> Dict[str, torch.Tensor]:
+        """
+        Pack the '{prefix}_combined' sequences of the examples, for every prefix in packed_prefixes (one prefix after the
+        other), into a single row without padding.
+
+        Returns:
+            A dict with
+                packed_input_ids, packed_labels, packed_position_ids: tensors of shape (1, total_length); the first label of
+                    every sequence is -100, so that no token is predicted from the previous sequence, and the position ids
+                    restart at 0 for every sequence
+                packed_cu_seqlens: int32 tensor of shape (num_sequences + 1,) with the cumulative sequence lengths
+        """
+        input_ids, labels, position_ids, cu_seqlens = [], [], [], [0]
+
+        for prefix in self.packed_prefixes:
+            for ex in batch:
+                sequence = ex[f'{prefix}_combined_input_ids']
+                input_ids.extend(sequence)
+                labels.extend([-100] + ex[f'{prefix}_labels'][1:])
+                position_ids.extend(range(len(sequence)))
+                cu_seqlens.append(cu_seqlens[-1] + len(sequence))
+
+        return {
+            'packed_input_ids': torch.LongTensor(input_ids).unsqueeze(0),
+            'packed_labels': torch.LongTensor(labels).unsqueeze(0),
+            'packed_position_ids': torch.LongTensor(position_ids).unsqueeze(0),
+            'packed_cu_seqlens': torch.IntTensor(cu_seqlens),
+        }
+
     def tokenize_batch_element(self, conversation: List[Dict[str, str]], generation: str, truncation_mode: str, prefix: str='target') -> Dict:
         """
         Tokenize a single batch element and truncate if prompt + generation is too long. Batch element is turned into Pytorch 
         tensors in self.collate. Create the labels for the generation, which are of length equal to the sum of the length of 
         the prompt and the generation, with -100 for the prompt tokens.
 
+        The data loaders tokenize the elements of a whole batch at once with tokenize_elements, which this calls for one element.
+
         Args:
         - conversation: list of previous turns, each resembling dict {"role": "assistant", "content": generation}
         - generation: output text (i.e., assistant generation)
@@ -523,7 +693,167 @@ class DataLoader:
         Returns:
             A dict of the tokenized prompt and the concatenation of the two on all relevant elements (e.g., tokens, 
             attention mask, etc.). The generation elements will have keys starting with '{prefix}_' and the concatenated 
-            elements will have keys starting with '{prefix}_combined_'.
+            elements will have keys starting with '{prefix}_combined_'. '{prefix}_example_id' is a stable signed 64-bit
+            hash of the tokenizer and the token ids of the concatenation, which keys the cached reference values.
+        """
+        return self.make_batch_element(self.tokenize_elements([ (conversation, generation) ])[0], prefix)
+
+    def make_batch_element(self, tokenized: Dict, prefix: str) -> Dict:
+        """Return the batch element of a tokenized element (see tokenize), with its keys starting with '{prefix}_'."""
+        tokenized_prompt_and_generation = tokenized['combined_input_ids']
+
+        return {
+            'prompt_text': tokenized['prompt_text'],
+            f'{prefix}_text': tokenized['text'],
+            f'{prefix}_combined_text': tokenized['combined_text'],
+            f'{prefix}_combined_input_ids': tokenized_prompt_and_generation,
+            f'{prefix}_combined_attention_mask': [1] * len(tokenized_prompt_and_generation),
+            f'{prefix}_example_id': self.example_id(tokenized_prompt_and_generation),
+            f'{prefix}_labels': tokenized['labels'],
+        }
+
+    def tokenize_elements(self, elements: List[Tuple[List[Dict[str, str]], str]]) -> List[Dict]:
+        """
+        Tokenize the (conversation, generation) of every element, with the same results (and the same truncation of the
+        turns of the conversations in place) as calling tokenize on every element in order, but with one call of the
+        tokenizer per step for all the elements (see tokenize_distinct).
+
+        Since tokenizing an element can truncate the turns of its conversation, and so change how the next element with
+        the same conversation is tokenized, the elements are tokenized in waves with at most one element per conversation.
+
+        If tokenization_cache_dir is set, the elements tokenized before (by this or an earlier run) are read from the
+        TokenizationCache, and the others are added to it. Every process only adds its share of the elements.
+
+        Returns:
+            The tokenized elements, in the format of tokenize.
+        """
+        results = [ None ] * len(elements)
+        remaining = list(range(len(elements)))
+
+        while remaining:
+            wave, deferred, conversations = [], [], set()
+            for k in remaining:
+                turns = tuple(id(turn) for turn in elements[k][0])
+                (deferred if turns in conversations else wave).append(k)
+                conversations.add(turns)
+
+            keys = {}
+            if self.tokenization_cache is not None:
+                for k in wave:
+                    keys[k] = self.tokenization_cache.key(*elements[k])
+                    results[k] = self.tokenization_cache.get(keys[k])
+
+                    if results[k] is not None:
+                        # the turns are truncated in place, as by tokenize
+                        for turn, content in zip(elements[k][0], results[k]['contents']):
+                            turn['content'] = content
+
+            missing = [ k for k in wave if results[k] is None ]
+            if self.tokenization_threads is None:
+                tokenized_missing = self.tokenize_distinct([ elements[k] for k in missing ])
+            else:
+                # the elements of a wave are independent, so contiguous parts of them are tokenized at once
+                part_size = -(-len(missing) // self.num_tokenization_threads)
+                parts = [ [ elements[k] for k in missing[i:i + part_size] ] for i in range(0, len(missing), part_size) ]
+                tokenized_missing = [ x for part in self.tokenization_threads.map(self.tokenize_distinct, parts) for x in part ]
+
+            for k, tokenized in zip(missing, tokenized_missing):
+                results[k] = tokenized
+                if k in keys and keys[k] % self.num_processes == self.process_index:
+                    self.tokenization_cache.add(keys[k], tokenized)
+
+            remaining = deferred
+
+        return results
+
+    def tokenize_distinct(self, elements: List[Tuple[List[Dict[str, str]], str]]) -> List[Dict]:
+        """
+        Tokenize elements with distinct conversations like tokenize, with one batched call of the tokenizer for the
+        contents of all the turns, the templated turns, the generations, the truncated prompts and the concatenations
+        (which fast tokenizers encode in parallel), and one call of batch_decode for the truncated texts.
+        """
+        if not elements:
+            return []
+
+        conversations = [ conversation for conversation, _ in elements ]
+        turns = [ turn for conversation in conversations for turn in conversation ]
+        filter_out_bos_eos = lambda x: [ t for t in x if t not in [ self.tokenizer.bos_token_id, self.tokenizer.eos_token_id, self.tokenizer.pad_token_id] ]
+        # apply_chat_template with tokenize=True encodes the rendered text without special tokens
+        encode_templated = lambda texts: self.tokenizer(texts, add_special_tokens=False)['input_ids']
+
+        untruncated_prompt_strings = self.tokenizer.apply_chat_template(conversations, tokenize=False, add_generation_prompt=True) # for inference-time generation
+        content_token_ids = self.tokenizer([ turn['content'] for turn in turns ])['input_ids']
+        templated_lengths = [ len(x) for x in encode_templated(self.tokenizer.apply_chat_template([ [turn] for turn in turns ], tokenize=False, add_generation_prompt=True)) ]
+        generation_token_ids = self.tokenizer([ generation for _, generation in elements ])['input_ids']
+
+        # truncate history to fit in self.max_prompt_length
+        prompt_lengths, num_turns, truncated_turns = [], [], []
+        offset = 0
+        for conversation in conversations:
+            prompt_length = 0
+
+            for i, turn in enumerate(conversation):
+                templated_length = templated_lengths[offset + i]
+
+                if prompt_length + templated_length > self.max_prompt_length:
+                    truncated_turns.append((turn, filter_out_bos_eos(content_token_ids[offset + i])[:self.max_prompt_length - (prompt_length + templated_length)]))
+                    prompt_length = self.max_prompt_length
+                    break
+                else:
+                    prompt_length += templated_length
+
+            prompt_lengths.append(prompt_length)
+            num_turns.append(i + 1)
+            offset += len(conversation)
+
+        if truncated_turns:
+            for (turn, _), content in zip(truncated_turns, self.tokenizer.batch_decode([ ids for _, ids in truncated_turns ])):
+                turn['content'] = content
+
+        contents = [ [ turn['content'] for turn in conversation ] for conversation in conversations ]
+        conversations = [ conversation[:n] for conversation, n in zip(conversations, num_turns) ]
+
+        # truncate the generation if necessary
+        generations = self.tokenizer.batch_decode([ filter_out_bos_eos(ids)[:(self.max_length - prompt_length)] for ids, prompt_length in zip(generation_token_ids, prompt_lengths) ])
+
+        tokenized_prompts = encode_templated(self.tokenizer.apply_chat_template(conversations, tokenize=False, add_generation_prompt=True))
+        tokenized_prompt_and_generation_strings = self.tokenizer.apply_chat_template(
+            [ conversation + [{"role": "assistant", "content": generation}] for conversation, generation in zip(conversations, generations) ],
+            tokenize=False,
+            add_generation_prompt=False
+        )
+        tokenized_prompts_and_generations = encode_templated(tokenized_prompt_and_generation_strings)
+
+        results = []
+        for k, (tokenized_prompt, tokenized_prompt_and_generation) in enumerate(zip(tokenized_prompts, tokenized_prompts_and_generations)):
+            if tokenized_prompt[-1] in [self.tokenizer.eos_token_id, self.tokenizer.pad_token_id]:
+                tokenized_prompt.pop()
+
+            # Prepare labels
+            labels = tokenized_prompt_and_generation[:]
+            labels[:len(tokenized_prompt)] = [-100] * len(tokenized_prompt)
+
+            results.append({
+                'prompt_text': untruncated_prompt_strings[k],
+                'text': generations[k],
+                'combined_text': tokenized_prompt_and_generation_strings[k],
+                'combined_input_ids': tokenized_prompt_and_generation,
+                'labels': labels,
+                'contents': contents[k],
+            })
+
+        return results
+
+    def tokenize(self, conversation: List[Dict[str, str]], generation: str) -> Dict:
+        """
+        Truncate and tokenize the conversation and generation of a batch element (see tokenize_batch_element), one call
+        of the tokenizer at a time. The contents of the turns of the conversation are truncated in place. This is the
+        reference that tokenize_distinct, which the data loaders use, must match (see bench/batched_tokenization.py).
+
+        Returns:
+            A dict with the untruncated prompt ('prompt_text'), the truncated generation ('text'), the templated
+            concatenation of the two ('combined_text'), its token ids ('combined_input_ids') and labels ('labels'), and
+            the contents of the turns of the conversation after truncation ('contents').
         """
         untruncated_prompt_string = self.tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True) # for inference-time generation
         
@@ -544,6 +874,7 @@ class DataLoader:
             else:
                 prompt_length += templated_length
 
+        contents = [ turn['content'] for turn in conversation ]
         conversation = conversation[:(i+1)]
 
         # truncate the generation if necessary 
@@ -561,21 +892,117 @@ class DataLoader:
             add_generation_prompt=False
         )
 
-        # Prepare the batch element
-        batch_element = {
-            'prompt_text': untruncated_prompt_string,
-            f'{prefix}_text': generation,
-            f'{prefix}_combined_text': tokenized_prompt_and_generation_string,
-            f'{prefix}_combined_input_ids': tokenized_prompt_and_generation,
-            f'{prefix}_combined_attention_mask': [1] * len(tokenized_prompt_and_generation),
-        }
-
         # Prepare labels
         labels = tokenized_prompt_and_generation[:]
         labels[:len(tokenized_prompt)] = [-100] * len(tokenized_prompt)
-        batch_element[f'{prefix}_labels'] = labels
 
-        return batch_element
+        return {
+            'prompt_text': untruncated_prompt_string,
+            'text': generation,
+            'combined_text': tokenized_prompt_and_generation_string,
+            'combined_input_ids': tokenized_prompt_and_generation,
+            'labels': labels,
+            'contents': contents,
+        }
+
+    def flush_tokenization_cache(self):
+        """Write the elements added to the tokenization cache, if any, so that the next epochs and runs read them."""
+        if self.tokenization_cache is not None:
+            self.tokenization_cache.flush()
+
+    def shard(self, batch: List[Dict]) -> List[Dict]:
+        """Return the contiguous slice of the examples in a batch that this process trains on (the same on every run)."""
+        shard_size = len(batch) // self.num_processes
+        return batch[self.process_index * shard_size:(self.process_index + 1) * shard_size]
+
+    def tokenized_batches(self, items: List, get_elements: Callable, epoch_idx: int):
+        """
+        Split the (shuffled) items of an epoch into batches of batch_size items and tokenize them, yielding every batch as
+        a list of (item, tokenized elements) pairs, where get_elements(item) returns the (conversation, generation)
+        elements of an item, in the order in which they are tokenized (see tokenize_elements).
+
+        If length_grouped_batches > 0, the items are tokenized length_grouped_batches batches at a time, sorted by their
+        total number of tokens and split into batches, which are yielded in a random order (for the seed and epoch).
+        The batches are then of examples of similar lengths, with little padding, while which examples are in the same
+        group of batches and the order of the batches still change every epoch.
+
+        If max_batch_tokens is set, the items are instead split into batches of varying sizes (see token_budget_batches),
+        with the last batch of every group of items carried over to the next group, as more items may fit in it.
+
+        The items of a last, incomplete batch are still tokenized, as that truncates their prompts for the next epoch.
+        """
+        group_size = self.batch_size * max(self.length_grouped_batches, 1)
+        rng = random.Random(self.seed + epoch_idx)
+        carried = []
+
+        for start in range(0, len(items), group_size):
+            group_items = items[start:start + group_size]
+            elements = [ get_elements(item) for item in group_items ]
+            tokenized = self.tokenize_elements([ element for x in elements for element in x ])
+
+            group, k = [], 0
+            for item, x in zip(group_items, elements):
+                group.append((item, tokenized[k:k + len(x)]))
+                k += len(x)
+
+            if self.max_batch_tokens:
+                group = carried + group
+            else:
+                # the incomplete batch is the last items of the epoch, whatever their lengths
+                group = group[:len(group) - len(group) % self.batch_size]
+
+            if self.length_grouped_batches:
+                group.sort(key=lambda x: sum(len(t['combined_input_ids']) for t in x[1]))
+
+            if self.max_batch_tokens:
+                batches = self.token_budget_batches(group)
+                carried = batches.pop()
+            else:
+                batches = [ group[k:k + self.batch_size] for k in range(0, len(group), self.batch_size) ]
+
+            if self.length_grouped_batches:
+                rng.shuffle(batches)
+
+            yield from batches
+
+        # the last batch of the epoch, without the examples that cannot be split evenly across the processes
+        carried = carried[:len(carried) - len(carried) % self.num_processes]
+        if carried:
+            yield carried
+
+    def token_budget_batches(self, group: List) -> List[List]:
+        """
+        Split a group of (item, tokenized elements) pairs, in order, into batches of up to batch_size items, each with as
+        many items as fit in max_batch_tokens padded tokens per process, i.e., such that the number of items per process
+        times the number of elements per item (e.g., 2 for pairs) times the length of the longest element is at most
+        max_batch_tokens. Every batch has a multiple of num_processes items, and at least num_processes items even if they
+        do not fit. The last batch is returned even if more items would fit in it.
+        """
+        batches = [ [] ]
+        longest = 0
+
+        for item in group:
+            batch = batches[-1]
+            item_longest = max(len(t['combined_input_ids']) for t in item[1])
+            padded_tokens = -(-(len(batch) + 1) // self.num_processes) * len(item[1]) * max(longest, item_longest)
+
+            if len(batch) >= self.num_processes and (len(batch) >= self.batch_size or padded_tokens > self.max_batch_tokens):
+                # the items beyond a multiple of num_processes start the next batch
+                num_carried = len(batch) % self.num_processes
+                batches.append(batch[len(batch) - num_carried:])
+                del batch[len(batch) - num_carried:]
+                longest = max([ len(t['combined_input_ids']) for _, x in batches[-1] for t in x ], default=0)
+
+            batches[-1].append(item)
+            longest = max(longest, item_longest)
+
+        return batches
+
+    def example_id(self, token_ids: List[int]) -> int:
+        """Return a stable signed 64-bit id of the given tokenized sequence."""
+        digest = hashlib.blake2b(self.tokenizer_fingerprint, digest_size=8)
+        digest.update(np.asarray(token_ids, dtype=np.int64).tobytes())
+        return int.from_bytes(digest.digest(), 'little', signed=True)
 
     def __iter__(self):
         """Create a flat version of the data and yield batches."""
@@ -590,6 +1017,26 @@ class SFTDataLoader(DataLoader):
     """
     Dataloader for supervised fine-tuning.
     """
+    def get_elements(self, example):
+        """Return the (conversation, target generation) element of an example, with the control token if specified."""
+        # Assuming example.prompt is now a list of conversation turns
+        conversation = example.prompt
+        if not isinstance(conversation[0], dict):
+            # Convert to the new format if it's not already
+            conversation = [{"role": "user", "content": conversation[0]}]
+            for i, message in enumerate(conversation[1:]):
+                role = "assistant" if i % 2 == 0 else "user"
+                conversation.append({"role": role, "content": message})
+
+        # Get the target generation (last turn from assistant)
+        target_generation = example.generations[example.sft_index]
+
+        # Add control token if specified
+        if self.control_tokens.get('chosen'):
+            target_generation = self.control_tokens['chosen'] + target_generation
+
+        return [ (conversation, target_generation) ]
+
     def __iter__(self):
         flat_data = []
         prompts = list(self.full_data.keys())
@@ -606,43 +1053,17 @@ class SFTDataLoader(DataLoader):
             if done: break
             random.Random(self.seed + epoch_idx).shuffle(flat_data)
 
-            batch = []
-
-            for example in flat_data:
-                # Assuming example.prompt is now a list of conversation turns
-                conversation = example.prompt
-                if not isinstance(conversation[0], dict):
-                    # Convert to the new format if it's not already
-                    conversation = [{"role": "user", "content": conversation[0]}]
-                    for i, message in enumerate(conversation[1:]):
-                        role = "assistant" if i % 2 == 0 else "user"
-                        conversation.append({"role": role, "content": message})
-
-                # Get the target generation (last turn from assistant)
-                target_generation = example.generations[example.sft_index]
-
-                # Add control token if specified
-                if self.control_tokens.get('chosen'):
-                    target_generation = self.control_tokens['chosen'] + target_generation
-
-                batch_element = self.tokenize_batch_element(
-                    conversation,
-                    target_generation,
-                    example.truncation_mode
-                )
-                batch_element['original_prompt'] = example.original_prompt
-                batch.append(batch_element)
-
-                if len(batch) == self.batch_size:
-                    example_idx += len(batch)
-                    yield self.collate(batch)
-                    batch = []
-
-                    if self.n_examples is not None and example_idx >= self.n_examples:
-                        rank0_print(f'Finished generating {self.n_examples} examples on {self.split} split')
-                        done = True
-                        break
+            for batch in self.tokenized_batches(flat_data, self.get_elements, epoch_idx):
+                batch = [ dict(self.make_batch_element(target, 'target'), original_prompt=example.original_prompt) for example, (target,) in batch ]
+                example_idx += len(batch)
+                yield self.collate(self.shard(batch))
+
+                if self.n_examples is not None and example_idx >= self.n_examples:
+                    rank0_print(f'Finished generating {self.n_examples} examples on {self.split} split')
+                    done = True
+                    break
 
+            self.flush_tokenization_cache()
             epoch_idx += 1
             if self.n_epochs is not None and epoch_idx >= self.n_epochs:
                 done = True
@@ -689,6 +1110,26 @@ class ConditionalSFTDataLoader(DataLoader):
                 flat_data.append((example, example.generations[j], 'rejected'))
 
         return flat_data
+
+    def get_elements(self, item):
+        """Return the (conversation, generation) element of a flat data item, with the control token of its status."""
+        example, generation, status = item
+
+        # Convert prompt to conversation format if it's not already
+        conversation = example.prompt
+        if not isinstance(conversation[0], dict):
+            conversation = [{"role": "user", "content": conversation[0]}]
+            for i, message in enumerate(conversation[1:]):
+                role = "assistant" if i % 2 == 0 else "user"
+                conversation.append({"role": role, "content": message})
+
+        # Add control token to the generation
+        if status == 'chosen':
+            conditioned_generation = self.control_tokens["chosen"] + generation
+        else:
+            conditioned_generation = self.control_tokens["rejected"] + generation
+
+        return [ (conversation, conditioned_generation) ]
     
     def __iter__(self):
         prompts = list(self.full_data.keys()) 
@@ -703,41 +1144,17 @@ class ConditionalSFTDataLoader(DataLoader):
             if done: break
             random.Random(self.seed + epoch_idx).shuffle(flat_data)
 
-            batch = []
+            for batch in self.tokenized_batches(flat_data, self.get_elements, epoch_idx):
+                batch = [ dict(self.make_batch_element(target, 'target'), status=status) for (_, _, status), (target,) in batch ]
+                example_idx += len(batch)
+                yield self.collate(self.shard(batch))
 
-            for example, generation, status in flat_data:
-                # Convert prompt to conversation format if it's not already
-                conversation = example.prompt
-                if not isinstance(conversation[0], dict):
-                    conversation = [{"role": "user", "content": conversation[0]}]
-                    for i, message in enumerate(conversation[1:]):
-                        role = "assistant" if i % 2 == 0 else "user"
-                        conversation.append({"role": role, "content": message})
-
-                # Add control token to the generation
-                if status == 'chosen':
-                    conditioned_generation = self.control_tokens["chosen"] + generation
-                else:
-                    conditioned_generation = self.control_tokens["rejected"] + generation
-
-                batch_element = self.tokenize_batch_element(
-                    conversation,
-                    conditioned_generation,
-                    example.truncation_mode
-                )
-                batch_element['status'] = status
-                batch.append(batch_element)
-
-                if len(batch) >= self.batch_size:
-                    example_idx += len(batch)
-                    yield self.collate(batch)
-                    batch = []
-
-                    if self.n_examples is not None and example_idx >= self.n_examples:
-                        rank0_print(f'Finished generating {example_idx} examples on {self.split} split')
-                        done = True
-                        break
+                if self.n_examples is not None and example_idx >= self.n_examples:
+                    rank0_print(f'Finished generating {example_idx} examples on {self.split} split')
+                    done = True
+                    break
 
+            self.flush_tokenization_cache()
             epoch_idx += 1
             if self.n_epochs is not None and epoch_idx >= self.n_epochs:
                 done = True
@@ -762,6 +1179,11 @@ class UnpairedPreferenceDataLoader(DataLoader):
 
         if self.batch_size == 1:
             raise ValueError("can't use batch size of 1 with UnpairedPreferenceDataLoader")
+
+        # the KL sequences are only built once a batch is formed, and can be longer than any of its examples, so a token
+        # budget could not bound the memory of the batch
+        if self.max_batch_tokens:
+            raise ValueError("can't use max_batch_tokens with UnpairedPreferenceDataLoader")
         
     def get_flat_data(self, prompts):
         """
@@ -808,42 +1230,28 @@ class UnpairedPreferenceDataLoader(DataLoader):
         while True:
             if done: break
             random.Random(self.seed + epoch_idx).shuffle(flat_data)   # so generations in the same preference are not in the same batch
-            batch = []
-            example_queue = []
-
-            for example, generation, status in flat_data:
-                batch_element = self.tokenize_batch_element(example.prompt, generation, example.truncation_mode, prefix='target')
-                batch_element['status'] = status 
-                batch_element['truncation_mode'] = example.truncation_mode
-                batch_element['conversation'] = example.prompt
-                example_queue.append(batch_element)
-                
-                if len(example_queue) >= self.batch_size:
-                    while len(batch) < self.batch_size:
-                        batch.append(example_queue.pop(0))
-                    
-                if len(batch) >= self.batch_size:
-                    # for estimating the KL term, match up x and y' that are not corresponding input-output pairs in the data
-                    # for x_i, get a mismatched y' by just picking the subsequent y_{i+1} in the batch (desirable/undesirable status does not matter)
-                    # the respective input IDs, attention mask, and so on will be prefixed by the term KL
-                    indices = list(range(1, len(batch))) + [0]
-                    for i in range(len(batch)):
-                        batch[i].update(self.tokenize_batch_element(
-                            batch[i]['conversation'],
-                            batch[indices[i]]['target_text'],
-                            batch[i]['truncation_mode'],
-                            prefix='KL'
-                        ))
-
-                    example_idx += len(batch)
-                    yield self.collate(batch)
-                    batch = []
-
-                    if self.n_examples is not None and example_idx >= self.n_examples:
-                        rank0_print(f'Finished generating {example_idx} examples on {self.split} split')
-                        done = True
-                        break
 
+            for batch in self.tokenized_batches(flat_data, lambda item: [ (item[0].prompt, item[1]) ], epoch_idx):
+                batch = [ dict(self.make_batch_element(target, 'target'), status=status, truncation_mode=example.truncation_mode, conversation=example.prompt)
+                          for (example, _, status), (target,) in batch ]
+
+                # for estimating the KL term, match up x and y' that are not corresponding input-output pairs in the data
+                # for x_i, get a mismatched y' by just picking the subsequent y_{i+1} in the batch (desirable/undesirable status does not matter)
+                # the respective input IDs, attention mask, and so on will be prefixed by the term KL
+                indices = list(range(1, len(batch))) + [0]
+                tokenized = self.tokenize_elements([ (batch[i]['conversation'], batch[indices[i]]['target_text']) for i in range(len(batch)) ])
+                for i in range(len(batch)):
+                    batch[i].update(self.make_batch_element(tokenized[i], 'KL'))
+
+                example_idx += len(batch)
+                yield self.collate(self.shard(batch))
+
+                if self.n_examples is not None and example_idx >= self.n_examples:
+                    rank0_print(f'Finished generating {example_idx} examples on {self.split} split')
+                    done = True
+                    break
+
+            self.flush_tokenization_cache()
             epoch_idx += 1
             if self.n_epochs is not None and epoch_idx >= self.n_epochs:
                 done = True
@@ -918,6 +1326,8 @@ class PairedPreferenceDataLoader(DataLoader):
     """
     Dataloader for losses that do require pairwise preferences (e.g., DPO).
     """
+    packed_prefixes = ['chosen', 'rejected']
+
     def __iter__(self):
         flat_data = []
         prompts = list(self.full_data.keys())
@@ -939,24 +1349,20 @@ class PairedPreferenceDataLoader(DataLoader):
         while True:
             if done: break
             random.Random(self.seed + epoch_idx).shuffle(flat_data)
-            batch = []
-
-            for example, (i, j) in flat_data:
-                batch_element = {}
-                batch_element.update(self.tokenize_batch_element(example.prompt, example.generations[i], example.truncation_mode, prefix='chosen'))
-                batch_element.update(self.tokenize_batch_element(example.prompt, example.generations[j], example.truncation_mode, prefix='rejected'))
-                batch.append(batch_element)
 
-                if len(batch) >= self.batch_size:
-                    example_idx += len(batch)
-                    yield self.collate(batch)
-                    batch = []
+            # the chosen generation of every pair is tokenized before the rejected one
+            get_elements = lambda item: [ (item[0].prompt, item[0].generations[k]) for k in item[1] ]
+            for batch in self.tokenized_batches(flat_data, get_elements, epoch_idx):
+                batch = [ dict(self.make_batch_element(chosen, 'chosen'), **self.make_batch_element(rejected, 'rejected')) for _, (chosen, rejected) in batch ]
+                example_idx += len(batch)
+                yield self.collate(self.shard(batch))
 
-                    if self.n_examples is not None and example_idx >= self.n_examples:
-                        rank0_print(f'Finished {example_idx} examples on {self.split} split')
-                        done = True
-                        break
+                if self.n_examples is not None and example_idx >= self.n_examples:
+                    rank0_print(f'Finished {example_idx} examples on {self.split} split')
+                    done = True
+                    break
 
+            self.flush_tokenization_cache()
             epoch_idx += 1
             if self.n_epochs is not None and epoch_idx >= self.n_epochs:
                 done = True
@@ -965,3 +1371,65 @@ class PairedPreferenceDataLoader(DataLoader):
     def get_num_training_steps(self):
         max_prompt_count = min(float("inf"), self.max_prompt_count) if self.max_prompt_count else float("inf")
         return int(sum(min(max_prompt_count, len(example.pairs)) for _, example in self.full_data.items()))
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoader to build and collate its batches ahead of training on a background thread, with at most
+    num_batches of them waiting in a bounded queue. The batches are built by the same generator as without prefetching,
+    so their order (for a given seed and epoch) and contents are the same. Every other attribute is that of the loader.
+
+    starvation_seconds is the time that the consumer last waited for a batch (0 if one was ready), and
+    total_starvation_seconds the time it waited over the current pass.
+    """
+    def __init__(self, loader: DataLoader, num_batches: int):
+        self.loader = loader
+        self.num_batches = num_batches
+        self.starvation_seconds = 0.0
+        self.total_starvation_seconds = 0.0
+
+    def __getattr__(self, name: str):
+        return getattr(self.loader, name)
+
+    def _produce(self, queue: Queue, stop: Event):
+        """Put every batch of the loader (then None, or the exception raised while building them) in the queue until stopped."""
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.loader:
+                if not put(batch):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        queue, stop = Queue(maxsize=self.num_batches), Event()
+        producer = Thread(target=self._produce, args=(queue, stop), daemon=True, name=f'prefetch-{self.loader.split}')
+        producer.start()
+        self.total_starvation_seconds = 0.0
+
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = queue.get()
+                self.starvation_seconds = time.perf_counter() - start
+                self.total_starvation_seconds += self.starvation_seconds
+
+                if batch is None:
+                    break
+                elif isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # stop the producer if the batches were not all consumed
+            stop.set()
+            producer.join()
+
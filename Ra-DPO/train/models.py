@@ -7,19 +7,25 @@
 Contains the classes necessary for doing PPO (offline, one-step) with language model.
 This code is largely from the TRL library, with some modifications to ensure stability.
 """
+import contextlib
+import functools
 import json
 import os
-import pickle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import pad_sequence
+import torch.nn.functional as F
 from huggingface_hub import hf_hub_download
 from transformers import PreTrainedModel, AutoModelForCausalLM
-from accelerate.utils import gather_object
 from tqdm import tqdm
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple
+
+from .utils import pack_response_positions, unpack_positions, sparsify_reference_logits, chunked_apply
+from .reference_store import ReferenceStore, StagingBuffers, unique_writer
 
 
 class PreTrainedModelWrapper(nn.Module):
@@ -422,15 +428,232 @@ class AutoModelForCausalLMWithValueHead(PreTrainedModelWrapper):
         return model_with_value_head
 
 
-class ReferenceModelWrapper(nn.Module):
+class AdapterDisabledReference:
+    """
+    Stands in for the reference model of a PEFT (e.g., LoRA) policy by running the policy itself with its adapters
+    disabled, i.e., the base model that the adapters are trained on, so that no second copy of the weights is needed.
+
+    The policy is run in eval mode (without dropout), and put back in the mode it was in. Any other attribute (e.g., the
+    modules or config) is that of the policy.
     """
-    A wrapper around the reference model that precomputes the logprobs and saves them in a local dict,
-    after which the reference model and accelerator are deleted to save GPU memory.
+    def __init__(self, model: nn.Module, peft_model: nn.Module = None):
+        """
+        Args:
+            - model: the policy, possibly wrapped (e.g., by FSDP)
+            - peft_model: the unwrapped PeftModel of the policy (model by default)
+        """
+        self.model = model
+        self.peft_model = peft_model if peft_model is not None else model
+
+    def __call__(self, *args, **kwargs):
+        was_training = self.model.training
+        self.model.eval()
+
+        try:
+            with self.peft_model.disable_adapter():
+                return self.model(*args, **kwargs)
+        finally:
+            self.model.train(was_training)
+
+    def __getattr__(self, name: str):
+        return getattr(self.model, name)
+
+    def eval(self):
+        pass # the mode of the policy is set by the trainer
+
+    def train(self, mode: bool = True):
+        pass
+
+
+def reference_logprobs(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """Compute the token-level log probabilities of the given labels under the given logits."""
+    # ignoring vocab size, batch size x length should be equal
+    assert logits.shape[:-1] == labels.shape
+
+    # only the response positions are passed through the log-softmax
+    loss_mask, labels, (logits,) = pack_response_positions(labels, logits)
+
+    distribution_logps = logits.float().log_softmax(-1)
+    per_token_logps = torch.gather(distribution_logps, dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+
+    return unpack_positions(per_token_logps, loss_mask)
+
+
+def reference_distributions(logits: torch.Tensor, labels: torch.Tensor, k: int, chunk_size: int = None) -> List[Tuple[np.ndarray, ...]]:
+    """
+    Sparsify the reference distribution at the response positions of every sequence in the batch.
+
+    Returns:
+        A list with one (topk_ids, topk_logps, tail_logps, label_logps) tuple of numpy arrays per sequence, each
+        with one row per response position (see utils.sparsify_reference_logits). The ids are int32.
+    """
+    assert logits.shape[:-1] == labels.shape
+
+    loss_mask, labels, (logits,) = pack_response_positions(labels, logits)
+    topk_ids, topk_logps, tail_logps, label_logps = chunked_apply(
+        functools.partial(sparsify_reference_logits, k=k),
+        logits, labels, chunk_size=chunk_size, dim=0
+    )
+    topk_ids = topk_ids.int()
 
-    Note that the wrapper returns the logprobs of the sequence, not the logits (like the underlying
+    lengths = loss_mask.sum(-1).tolist()
+    per_sequence = [ np.split(x.cpu().numpy(), np.cumsum(lengths)[:-1]) for x in (topk_ids, topk_logps.float(), tail_logps.float(), label_logps.float()) ]
+    return list(zip(*per_sequence))
+
+
+class CachedReferenceModel(nn.Module):
+    """
+    Stands in for the reference model by reading the reference values of every sequence from on-disk
+    reference_store.ReferenceStore's, which are either precomputed by ReferenceModelWrapper at the start of training or
+    scored offline with score_reference.py. The stores are memory-mapped shard by shard as sequences are looked up.
+
+    Note that the model returns the logprobs of the sequence, not the logits (like the underlying
     model would).
+
+    The log probabilities are stored as set by config.reference_cache_dtype (see logprob_store_fields), and returned
+    in the dtype and on the device asked for. Batches for a GPU are gathered from the memory-mapped stores straight into
+    pinned staging buffers (see reference_store.StagingBuffers) and copied without blocking, so that the copy overlaps
+    with the computation of the policy that is already queued.
+
+    For trainers that need the token-level reference distribution (e.g., TDPO and Ra-DPO), the compressed form of
+    utils.sparsify_reference_logits (the top-k tokens at every response position plus the mass of the rest of the
+    vocabulary) is returned by get_reference_distributions.
     """
-    def __init__(self, reference_accelerator, reference_model, tokenizer, config, iterators):
+    # fields of the distribution store; the fields of both stores map to their dtype and the width of their rows
+    distribution_fields = ['topk_ids', 'topk_logps', 'tail_logps', 'label_logps']
+
+    def __init__(self, config, store_distributions: bool=False, create: bool=True):
+        """
+        Args:
+            - config: Hydra config; the stores are at config.load_reference_logprobs and config.load_reference_distributions,
+              or in the run directory if these are not set
+            - store_distributions: if true, also read the top-k reference distribution (config.loss.reference_topk)
+            - create: if false, the stores must already exist
+        """
+        super().__init__()
+        self.config = config
+        self.store_distributions = store_distributions
+        self.cache_dtype = config.reference_cache_dtype
+        self.logprob_fields = self.logprob_store_fields(self.cache_dtype)
+        self.staging = StagingBuffers()
+        self.logprob_store = self._open_store(
+            config.load_reference_logprobs or os.path.join(config.local_run_dir, 'reference_logprobs'),
+            self.logprob_fields,
+            create,
+        )
+        self.distribution_store = None
+
+        if store_distributions:
+            self.distribution_store = self._open_store(
+                config.load_reference_distributions or os.path.join(config.local_run_dir, 'reference_distributions'),
+                self.distribution_store_fields(config.loss.reference_topk),
+                create,
+            )
+
+    @staticmethod
+    def logprob_store_fields(cache_dtype: str) -> Dict[str, Tuple[str, int]]:
+        """
+        Return the fields of the log probability store for the given config.reference_cache_dtype:
+            - float16, bfloat16: one value per token
+            - int8: one 8-bit value per token and one float32 scale per sequence (see encode_logprobs)
+            - sum: only the float32 sum of the log probabilities of every sequence, for losses that only use sums
+        """
+        if cache_dtype in ['float16', 'bfloat16']:
+            return { 'logprobs': (cache_dtype, 1) }
+        elif cache_dtype == 'int8':
+            return { 'logprobs': ('uint8', 1), 'scale': ('float32', 1) }
+        elif cache_dtype == 'sum':
+            return { 'logprob_sum': ('float32', 1) }
+        raise ValueError(f"unknown reference_cache_dtype '{cache_dtype}'; must be one of float16, bfloat16, int8 or sum")
+
+    def encode_logprobs(self, logprobs: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Return the values of the log probability store for the log probabilities of one sequence. Since log probabilities
+        are at most 0, the 8-bit values are the quantized -logprobs / scale in [0, 255], with the scale chosen per sequence.
+        """
+        logprobs = np.asarray(logprobs, dtype=np.float32)
+        if self.cache_dtype == 'int8':
+            scale = max(-logprobs.min(initial=0), 1e-8) / 255
+            return { 'logprobs': np.rint(-logprobs / scale).clip(0, 255), 'scale': [ scale ] }
+        elif self.cache_dtype == 'sum':
+            return { 'logprob_sum': [ logprobs.sum() ] }
+        return { 'logprobs': logprobs }
+
+    @staticmethod
+    def distribution_store_fields(k: int) -> Dict[str, Tuple[str, int]]:
+        return { 'topk_ids': ('int32', k), 'topk_logps': ('float16', k), 'tail_logps': ('float16', 1), 'label_logps': ('float16', 1) }
+
+    @staticmethod
+    def _open_store(path: str, fields: Dict[str, Tuple[str, int]], create: bool) -> ReferenceStore:
+        if create:
+            return ReferenceStore(path, fields=fields)
+
+        store = ReferenceStore(path)
+        if store.fields != fields:
+            raise ValueError(f"the fields of the reference store at {path} ({store.fields}) do not match {fields}")
+        return store
+
+    def _gather(self, store: ReferenceStore, example_ids: torch.LongTensor, field: str, device: torch.device, num_rows: int = None) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """Return the values of a field of the given sequences on the device (see ReferenceStore.gather), and their lengths."""
+        if torch.device(device).type != 'cuda':
+            values, lengths = store.gather(example_ids, field, num_rows)
+            return values.to(device), lengths
+
+        values, lengths = store.gather(example_ids, field, num_rows, allocate=self.staging.allocator(field))
+        staged = self.staging.to(field, device)
+        if store.fields[field][0] == 'bfloat16':
+            staged = staged.view(torch.bfloat16)
+        return staged.view(values.shape), lengths
+
+    def forward(self, input_ids: torch.LongTensor, example_ids: torch.LongTensor, dtype: torch.dtype = torch.float32, device: torch.device = 'cpu', **kwargs) -> torch.Tensor:
+        """
+        Return the cached log probabilities of the sequences with the given example ids, of shape (batch_size,
+        sequence_length - 1) like the token-level log probabilities of the trainers, with zeros after the end of every
+        sequence, in the given dtype and on the given device. The input ids are only used for their shape.
+
+        If only the sums are stored, the sum of every sequence is returned at its first position, so that it is still
+        the sum over the last dimension.
+        """
+        num_rows = input_ids.shape[1] - 1
+        if self.cache_dtype == 'sum':
+            sums, _ = self._gather(self.logprob_store, example_ids, 'logprob_sum', device)
+            logprobs = torch.zeros(len(sums), num_rows, dtype=dtype, device=sums.device)
+            logprobs[:, 0] = sums
+            return logprobs
+
+        values, _ = self._gather(self.logprob_store, example_ids, 'logprobs', device, num_rows=num_rows)
+        if self.cache_dtype == 'int8':
+            scales, _ = self._gather(self.logprob_store, example_ids, 'scale', device)
+            return (-values.float() * scales.unsqueeze(-1)).to(dtype)
+
+        return values.to(dtype)
+
+    def get_reference_distributions(self, example_ids: torch.LongTensor, device: torch.device = 'cpu') -> Tuple[torch.LongTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """
+        Return the cached sparse reference distributions of the sequences with the given example ids on the given device,
+        with the response positions of all the sequences stacked in order (the same order in which
+        utils.pack_response_positions packs them).
+        """
+        topk_ids, topk_logps, tail_logps, label_logps = [ self._gather(self.distribution_store, example_ids, name, device)[0] for name in self.distribution_fields ]
+        return topk_ids.long(), topk_logps.float(), tail_logps.float(), label_logps.float()
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+    
+    def eval(self):
+        pass # pass through, allows wrapper to be treated like a neural network
+
+
+class ReferenceModelWrapper(CachedReferenceModel):
+    """
+    A wrapper around the reference model that precomputes the logprobs and saves them in an on-disk
+    reference_store.ReferenceStore, after which the reference model and accelerator are deleted to save GPU memory.
+    The cached values are then read like those of CachedReferenceModel.
+
+    For trainers that need the token-level reference distribution (e.g., TDPO and Ra-DPO), the wrapper can also
+    store it in the compressed form of utils.sparsify_reference_logits.
+    """
+    def __init__(self, reference_accelerator, reference_model, tokenizer, config, iterators, store_distributions: bool=False):
         """
         Args:
             - reference_accelerator: accelerator that should be used for caching (different from main accelerator)
@@ -438,15 +661,17 @@ class ReferenceModelWrapper(nn.Module):
             - tokenizer: instance of AutoTokenizer
             - config: Hydra config
             - iterators: list of iterators, each instantiated by calling iter on a dataloader.DataLoader
+            - store_distributions: if true, also cache the top-k reference distribution (config.loss.reference_topk) at every response position
         """
-        super().__init__()
+        super().__init__(config, store_distributions=store_distributions)
         self.reference_accelerator = reference_accelerator
         self.num_processes = reference_accelerator.num_processes 
+        # other runs with the same reference may write to the same stores at the same time (see reference_cache_dir)
+        self.writer = unique_writer(f'rank{reference_accelerator.process_index}')
         self.reference_model = reference_model
         self.reference_dtype = getattr(torch, config.model.reference_dtype)
         self.tokenizer = tokenizer
         self.iterators = iterators
-        self.config = config
 
         self.reference_model, self.tokenizer, self.iterators = reference_accelerator.prepare(
             self.reference_model,
@@ -454,27 +679,79 @@ class ReferenceModelWrapper(nn.Module):
             self.iterators
         )
 
-        self.logprobs = {}
-
-        if config.load_reference_logprobs:
-            self.logprobs = pickle.load(open(config.load_reference_logprobs, 'rb'))
-        else:
-            self._precompute_log_probs()
+        # only the sequences missing from the stores (e.g., after a preemption, or for new datasets) are computed
+        self._precompute_log_probs()
 
         self._free_memory() # delete the reference model and the accelerator to free up memory
 
-    def _remove_padding(self, token_ids):
-        return [ t for t in token_ids if t not in [ self.tokenizer.bos_token_id, self.tokenizer.pad_token_id, self.tokenizer.eos_token_id ]]
+    def _stores(self) -> List[ReferenceStore]:
+        return [ self.logprob_store ] + ([ self.distribution_store ] if self.store_distributions else [])
+
+    def _data_fingerprint(self) -> str:
+        """Describe the data that the iterators go over, to tell whether a finished precompute covered the same data."""
+        return json.dumps([
+            list(self.config.datasets), [ getattr(it, 'split', None) for it in self.iterators ], self.config.n_examples,
+            self.config.n_eval_examples, self.config.seed, self.config.model.max_length, self.config.model.max_prompt_length,
+        ])
+
+    def _progress_path(self, store: ReferenceStore) -> str:
+        return os.path.join(store.path, f'progress-rank{self.reference_accelerator.process_index}.json')
+
+    def _is_complete(self, store: ReferenceStore) -> bool:
+        """Whether this process already went over the same data (see _data_fingerprint) for the given store."""
+        if not os.path.exists(self._progress_path(store)):
+            return False
+
+        with open(self._progress_path(store)) as f:
+            progress = json.load(f)
+        return progress['complete'] and progress['data'] == self._data_fingerprint() and progress['num_processes'] == self.num_processes
+
+    def _save_progress(self, num_batches: int, num_sequences: int, complete: bool):
+        """Flush the buffered values of every store and then record the progress of this process in it."""
+        progress = {
+            'data': self._data_fingerprint(),
+            'num_processes': self.num_processes,
+            'num_batches': num_batches,
+            'num_sequences': num_sequences,
+            'complete': complete,
+        }
+
+        for store in self._stores():
+            store.flush(self.writer)
+            tmp_path = f'{self._progress_path(store)}.{self.writer}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(progress, f)
+            os.replace(tmp_path, self._progress_path(store))
 
     def _precompute_log_probs(self):
         """
-        Calculate the log probabilities of every input-output sequence in every iterator in self.iterators.
-        Save these in self.logprobs as the values, where the key is the sequence of token ids (as a tuple, not a list).
-        These are then saved to 'cached_ref_logprobs.json' in the run directory.
+        Calculate the log probabilities of every input-output sequence in every iterator in self.iterators that is not
+        already in self.logprob_store, a reference_store.ReferenceStore in 'reference_logprobs' in the run directory
+        (or config.load_reference_logprobs). The store is keyed by the example ids of the batches, with one value per
+        position of the sequence (except the last), or only their sum, in the format of config.reference_cache_dtype.
+
+        If self.store_distributions, the sparsified reference distributions are likewise saved in self.distribution_store,
+        with one row per response position.
+
+        Every process appends the sequences it computed to its own segments of the stores every
+        config.reference_cache_flush_every batches, followed by a progress manifest ('progress-rank{i}.json'). A
+        preempted precompute therefore resumes with the sequences that are missing, and a process whose manifest shows
+        that it went over the same data does not go over it again. Nothing is gathered across processes, but every
+        process waits for all the others at the end, whether or not it had anything left to compute.
         """
+        if not all(self._is_complete(store) for store in self._stores()):
+            self._compute_missing_log_probs()
+
+        # every process reads the segments written by all the others
+        self.reference_accelerator.wait_for_everyone()
+
+    def _compute_missing_log_probs(self):
+        """Compute and store the reference values of the sequences missing from the stores (see _precompute_log_probs)."""
         self.reference_model.eval()
-        logprobs = []
-        example_counter = 0
+        # the sequences cached before this call (segments written since are not seen by these readers)
+        cached_stores = [ ReferenceStore(store.path) for store in self._stores() ]
+        computed_ids = set()
+        num_batches, num_sequences = 0, 0
         
         pbar = tqdm(disable=not self.reference_accelerator.is_local_main_process, dynamic_ncols=True)
         pbar.set_description(f"Caching logprobs for reference model")
@@ -482,69 +759,198 @@ class ReferenceModelWrapper(nn.Module):
         with torch.no_grad():
             for data_iterator in self.iterators:
                 for batch in data_iterator:
-                    batch = {k: v.to(self.reference_accelerator.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
-                    
                     # should be 'target', 'KL' for KTO and just 'target' for everything els
                     prefixes = [ k[:k.index('_')] for k in batch if k.endswith('_combined_input_ids') ]
 
                     for prefix in prefixes:
-                        logits = self.reference_model(
-                            batch[f'{prefix}_combined_input_ids'], 
-                            attention_mask=batch[f'{prefix}_combined_attention_mask']
-                        ).logits.to(self.reference_dtype)
+                        example_ids = batch[f'{prefix}_example_id']
+                        missing = ~np.logical_and.reduce([ store.contains(example_ids) for store in cached_stores ])
+                        missing &= np.array([ i not in computed_ids for i in example_ids.tolist() ], dtype=bool)
+                        if not missing.any():
+                            continue
 
-                        batch_logprobs = self._compute_log_probs(logits, batch[f'{prefix}_labels']).tolist()
+                        rows = torch.from_numpy(np.nonzero(missing)[0])
+                        input_ids = batch[f'{prefix}_combined_input_ids'][rows].to(self.reference_accelerator.device)
+                        attention_mask = batch[f'{prefix}_combined_attention_mask'][rows].to(self.reference_accelerator.device)
+                        labels = batch[f'{prefix}_labels'][rows].to(self.reference_accelerator.device)
 
-                        for k,v in zip(batch[f'{prefix}_combined_input_ids'].tolist(), batch_logprobs):
-                            logprobs.append((tuple(self._remove_padding(k)), v))
-                    
-                    example_counter += self.config.model.batch_size
-                    pbar.update(self.config.model.batch_size)
-                    pbar.set_postfix(examples=example_counter)
+                        logits = self.reference_model(input_ids, attention_mask=attention_mask).logits.to(self.reference_dtype)
 
-        self.reference_accelerator.wait_for_everyone()
-        pbar.close()
+                        keys = example_ids[rows].tolist()
+                        lengths = attention_mask.sum(-1).tolist()
+                        batch_logprobs = reference_logprobs(logits, labels).cpu().numpy()
 
-        # Gather dictionaries from all processes
-        gathered_logprobs = gather_object(logprobs)
-        self.logprobs = dict(gathered_logprobs)
+                        for key, v, length in zip(keys, batch_logprobs, lengths):
+                            self.logprob_store.add(key, self.encode_logprobs(v[:length - 1]))
 
-        if self.reference_accelerator.is_main_process:
-            with open(os.path.join(self.config.local_run_dir, 'cached_reference_logprobs.pkl'), 'wb') as f:
-                pickle.dump(self.logprobs, f) 
+                        if self.store_distributions:
+                            batch_distributions = reference_distributions(logits, labels, self.config.loss.reference_topk, self.config.loss.chunk_size)
 
-    def _compute_log_probs(self, logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
-        """Compute the token-level log probabilities of the given labels under the given logits."""
-        # ignoring vocab size, batch size x length should be equal
-        assert logits.shape[:-1] == labels.shape
+                            for key, v in zip(keys, batch_distributions):
+                                self.distribution_store.add(key, dict(zip(self.distribution_fields, v)))
 
-        labels = labels[:, 1:].clone()
-        logits = logits[:, :-1, :]
-        loss_mask = (labels != -100)
+                        computed_ids.update(keys)
+                        num_sequences += len(keys)
+                    
+                    num_batches += 1
+                    pbar.update(self.config.model.batch_size)
+                    pbar.set_postfix(examples=num_batches * self.config.model.batch_size, computed=num_sequences)
 
-        # dummy token; we'll ignore the losses on these tokens later
-        labels[labels == -100] = 0
+                    if num_batches % self.config.reference_cache_flush_every == 0:
+                        self._save_progress(num_batches, num_sequences, complete=False)
 
-        distribution_logps = logits.float().log_softmax(-1)
-        per_token_logps = torch.gather(distribution_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        self._save_progress(num_batches, num_sequences, complete=True)
+        pbar.close()
 
-        return per_token_logps * loss_mask
-    
     def _free_memory(self):
         del self.reference_accelerator
         del self.reference_model
         torch.cuda.empty_cache()
 
-    def forward(self, input_ids: Dict[str, Any], *args, **kwargs) -> torch.Tensor:
+
+class PipelinedReferenceModel:
+    """
+    Stands in for the reference model by computing its outputs for upcoming batches on a worker thread (and its own CUDA
+    stream), while the policy runs forward and backward on the current batch. The outputs are read through the same
+    interface as those of CachedReferenceModel: forward returns the log probabilities of the sequences, and
+    get_reference_distributions their sparse top-k distributions (see reference_distributions).
+
+    The batches must be iterated over with pipeline, which submits every batch to the worker up to `depth` batches
+    ahead of the one it yields, so that at most depth + 1 batches of outputs are held at a time. The outputs returned
+    while a batch is being used are those of that batch.
+    """
+    def __init__(self, reference_model: nn.Module, config, device: torch.device, depth: int = 1, store_distributions: bool = False, autocast=None):
+        """
+        Args:
+            - reference_model: reference model, in eval mode; it is moved to the device as a whole
+            - config: Hydra config
+            - device: device to run the reference model on
+            - depth: number of batches ahead of the current one that are submitted to the worker
+            - store_distributions: if true, compute the top-k reference distributions (config.loss.reference_topk) instead of
+              the log probabilities, for trainers that need them (e.g., TDPO and Ra-DPO)
+            - autocast: optional function returning the autocast context to run the reference model in (e.g., Accelerator.autocast)
+        """
+        self.config = config
+        self.device = torch.device(device)
+        self.reference_model = reference_model.to(self.device)
+        self.reference_dtype = getattr(torch, config.model.reference_dtype)
+        self.depth = depth
+        self.store_distributions = store_distributions
+        self.autocast = autocast or contextlib.nullcontext
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reference')
+        # outputs of the batch being used, and those of the batches being used by outer loops (e.g., training around eval)
+        self.current = None
+        self.outer = []
+
+    def pipeline(self, iterator, num_skip_batches: int = 0):
+        """
+        Yield the batches of the iterator, each after submitting the following `depth` batches to the worker. The
+        first num_skip_batches batches are yielded without computing their outputs (e.g., when resuming from a checkpoint).
+        """
+        pending = deque()
+        self.outer.append(self.current)
+
+        try:
+            for batch in iterator:
+                if num_skip_batches > 0:
+                    num_skip_batches -= 1
+                    self.current = None
+                    yield batch
+                    continue
+
+                pending.append((batch, self.executor.submit(self._compute, batch)))
+                if len(pending) > self.depth:
+                    batch, self.current = pending.popleft()
+                    yield batch
+
+            while pending:
+                batch, self.current = pending.popleft()
+                yield batch
+        finally:
+            for _, future in pending:
+                future.cancel()
+            self.current = self.outer.pop()
+
+    def _compute(self, batch: Dict) -> Tuple[Dict[int, Any], Any]:
+        """
+        Run the reference model on every sequence of the (CPU) batch on the worker. Returns the outputs of every sequence
+        by example id (the log probabilities of every token except the last, or the sparse distribution at every response
+        position), and the CUDA event after which they can be read, if any.
+        """
+        outputs = {}
+        stream = torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()
+
+        with torch.no_grad(), stream, self.autocast():
+            # should be 'target', 'KL' for KTO and 'chosen', 'rejected' for paired trainers
+            prefixes = [ k[:k.index('_')] for k in batch if k.endswith('_combined_input_ids') ]
+
+            for prefix in prefixes:
+                input_ids = batch[f'{prefix}_combined_input_ids'].to(self.device, non_blocking=True)
+                attention_mask = batch[f'{prefix}_combined_attention_mask'].to(self.device, non_blocking=True)
+                labels = batch[f'{prefix}_labels'].to(self.device, non_blocking=True)
+                keys = batch[f'{prefix}_example_id'].tolist()
+
+                logits = self.reference_model(input_ids, attention_mask=attention_mask).logits.to(self.reference_dtype)
+
+                if self.store_distributions:
+                    loss_mask, response_labels, (response_logits,) = pack_response_positions(labels, logits)
+                    distributions = chunked_apply(
+                        functools.partial(sparsify_reference_logits, k=self.config.loss.reference_topk),
+                        response_logits, response_labels, chunk_size=self.config.loss.chunk_size, dim=0
+                    )
+                    lengths = loss_mask.sum(-1).tolist()
+                    outputs.update(zip(keys, zip(*[ x.split(lengths) for x in distributions ])))
+                else:
+                    lengths = attention_mask.sum(-1).tolist()
+                    logprobs = reference_logprobs(logits, labels)
+                    outputs.update((key, v[:length - 1]) for key, v, length in zip(keys, logprobs, lengths))
+
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        return outputs, event
+
+    def _outputs(self, example_ids: torch.LongTensor, device: torch.device) -> List[Any]:
+        """Wait for the outputs of the current batch and return those of the sequences with the given example ids."""
+        if self.current is None:
+            raise RuntimeError("the batches must be iterated over with PipelinedReferenceModel.pipeline")
+
+        outputs, event = self.current.result()
+        values = [ outputs[key] for key in example_ids.tolist() ]
+
+        if event is not None:
+            stream = torch.cuda.current_stream(torch.device(device))
+            stream.wait_event(event)
+            # the memory of the outputs, allocated on the stream of the worker, is in use on this stream until freed
+            for v in values:
+                for x in (v if isinstance(v, tuple) else (v,)):
+                    x.record_stream(stream)
+
+        return values
+
+    def forward(self, input_ids: torch.LongTensor, example_ids: torch.LongTensor, dtype: torch.dtype = torch.float32, device: torch.device = 'cpu', **kwargs) -> torch.Tensor:
+        """
+        Return the reference log probabilities of the sequences with the given example ids, of shape (batch_size,
+        sequence_length - 1), with zeros after the end of every sequence, like CachedReferenceModel.forward.
+        """
+        values = self._outputs(example_ids, device)
+        logprobs = nn.utils.rnn.pad_sequence(values, batch_first=True)
+        logprobs = F.pad(logprobs, (0, input_ids.shape[1] - 1 - logprobs.shape[1]))
+        return logprobs.to(device=device, dtype=dtype)
+
+    def get_reference_distributions(self, example_ids: torch.LongTensor, device: torch.device = 'cpu') -> Tuple[torch.LongTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
         """
-        Return the cached log probabilities for the given input ids.
+        Return the sparse reference distributions of the sequences with the given example ids, with the response positions
+        of all the sequences stacked in order, like CachedReferenceModel.get_reference_distributions.
         """
-        batch_logprobs = [ torch.Tensor(self.logprobs[tuple(self._remove_padding(k))]) for k in input_ids.tolist() ]
-        batch_logprobs = pad_sequence(batch_logprobs, batch_first=True, padding_value=0)
-        return batch_logprobs
+        topk_ids, topk_logps, tail_logps, label_logps = [ torch.cat(x).to(device) for x in zip(*self._outputs(example_ids, device)) ]
+        return topk_ids.long(), topk_logps.float(), tail_logps.float(), label_logps.float()
 
     def __call__(self, *args, **kwargs):
         return self.forward(*args, **kwargs)
-    
+
     def eval(self):
-        pass # pass through, allows wrapper to be treated like a neural network
\ No newline at end of file
+        pass # the reference model is always in eval mode
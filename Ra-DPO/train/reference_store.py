@@ -0,0 +1,407 @@
+# Copyright (c) 2023 Contextual AI, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+On-disk store of per-sequence reference values (e.g., the cached reference log probabilities of ReferenceModelWrapper).
+
+Every sequence is identified by a 64-bit key (its example id, see dataloader.DataLoader.tokenize_batch_element) and
+has, for every field of the store, a variable number of rows of a fixed width (e.g., one row per token for the log
+probabilities, or one row of the top-k token ids per response position).
+The entries are sharded by key (key % num_shards), and every shard is a set of immutable segments, each written by a
+single process with ReferenceStore.flush, which can be called repeatedly to append new segments:
+
+    store/meta.json                                          fields and number of shards
+    store/shard-{shard:03d}-{writer}-{n:05d}.index.npy       keys of the n-th segment of a writer with the offset and length of every field
+    store/shard-{shard:03d}-{writer}-{n:05d}.{field}.bin     raw values of the field, of shape (num_rows, width)
+
+Writer names are made unique across hosts, processes and runs (see unique_writer), so that processes never write to
+the same file, even when concurrent runs share a store, and no data needs to be gathered across processes. A shard is only
+opened when one of its keys is looked up; its value files are memory-mapped, and ReferenceStore.gather reads the rows
+of a batch of keys with one vectorized index per segment, without any per-key Python work.
+"""
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+import uuid
+from glob import glob
+from threading import Event, Thread
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+
+def as_keys(keys: Union[Sequence[int], np.ndarray, torch.Tensor]) -> np.ndarray:
+    """Return the given signed 64-bit keys (e.g., a tensor of example ids) as a numpy array of unsigned 64-bit keys."""
+    if isinstance(keys, torch.Tensor):
+        keys = keys.cpu().numpy()
+    return np.asarray(keys, dtype=np.int64).reshape(-1).view(np.uint64)
+
+
+def storage_dtype(dtype: str) -> np.dtype:
+    """Return the numpy dtype that the values of a field are stored as; bfloat16, which numpy lacks, is stored as its raw bits."""
+    return np.dtype(np.uint16 if dtype == 'bfloat16' else dtype)
+
+
+def to_storage(values, dtype: str) -> np.ndarray:
+    """Convert the given values to the storage dtype of a field (see storage_dtype)."""
+    if dtype == 'bfloat16':
+        return torch.as_tensor(np.asarray(values, dtype=np.float32)).to(torch.bfloat16).view(torch.int16).numpy().view(np.uint16)
+    return np.asarray(values, dtype=dtype)
+
+
+def ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Return the concatenation of np.arange(start, start + length) for every start and length."""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def unique_writer(name: str) -> str:
+    """
+    Return a writer name for ReferenceStore.flush that starts with the given name (e.g., the process index) and is unique
+    across hosts, processes and runs, so that concurrent runs sharing a store never write segments of the same name.
+    """
+    return f'{name}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class ReferenceStore:
+    """
+    A sharded, memory-mapped store of per-sequence arrays, keyed by 64-bit keys.
+    """
+    def __init__(self, path: str, fields: Optional[Dict[str, Tuple[str, int]]] = None, num_shards: int = 16):
+        """
+        Open the store at the given path, creating it if it does not exist. Keys are signed 64-bit integers.
+
+        Args:
+            path: directory of the store
+            fields: dict mapping the name of every field to its dtype name (that of a numpy dtype, e.g., 'float16', or
+                'bfloat16') and the width of its rows; needed to create the store, and must match the existing store otherwise
+            num_shards: number of shards of a new store
+        """
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            stored_fields = { name: tuple(spec) for name, spec in meta['fields'].items() }
+            if fields is not None and { name: tuple(spec) for name, spec in fields.items() } != stored_fields:
+                raise ValueError(f"the fields of the reference store at {path} ({stored_fields}) do not match {fields}")
+            self.fields = stored_fields
+            self.num_shards = meta['num_shards']
+        elif fields is None:
+            raise FileNotFoundError(f"no reference store found at {path}")
+        else:
+            self.fields = { name: tuple(spec) for name, spec in fields.items() }
+            self.num_shards = num_shards
+            os.makedirs(path, exist_ok=True)
+            # several processes may create the store at once; they all write the same file
+            tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({ 'fields': self.fields, 'num_shards': self.num_shards }, f)
+            os.replace(tmp_path, meta_path)
+
+        self.index_dtype = np.dtype([('key', np.uint64)] + [ (f'{name}_{x}', np.int64) for name in self.fields for x in ['offset', 'length'] ])
+        self.shards = {}
+        self.buffer = []
+        self.num_segments = {}
+
+    def add(self, key: int, values: Dict[str, np.ndarray]):
+        """Buffer the values of one sequence, given as arrays with the width of every field as last dimension (if not 1)."""
+        self.buffer.append((key, { name: to_storage(values[name], dtype).reshape(-1, width) for name, (dtype, width) in self.fields.items() }))
+
+    def flush(self, writer: str):
+        """
+        Write the buffered entries as a new segment of every shard they belong to. The writer name must be unique among
+        the processes that may ever write to the store, including those of other runs (see unique_writer); its segments
+        are numbered after the ones already in the store.
+        """
+        if not self.buffer:
+            return
+
+        if writer not in self.num_segments:
+            existing = glob(os.path.join(self.path, f'shard-*-{writer}-*.index.npy'))
+            self.num_segments[writer] = 1 + max([ int(p[:-len('.index.npy')].rsplit('-', 1)[1]) for p in existing ], default=-1)
+        segment = f'{writer}-{self.num_segments[writer]:05d}'
+        self.num_segments[writer] += 1
+
+        keys = as_keys([ key for key, _ in self.buffer ])
+        shards = keys % np.uint64(self.num_shards)
+
+        for shard in np.unique(shards):
+            entries = np.nonzero(shards == shard)[0]
+            index = np.zeros(len(entries), dtype=self.index_dtype)
+            index['key'] = keys[entries]
+            prefix = os.path.join(self.path, f'shard-{int(shard):03d}-{segment}')
+
+            for name in self.fields:
+                arrays = [ self.buffer[i][1][name] for i in entries ]
+                lengths = np.array([ len(a) for a in arrays ], dtype=np.int64)
+                index[f'{name}_length'] = lengths
+                index[f'{name}_offset'] = np.cumsum(lengths) - lengths
+                np.concatenate(arrays).tofile(f'{prefix}.{name}.bin.tmp')
+                os.replace(f'{prefix}.{name}.bin.tmp', f'{prefix}.{name}.bin')
+
+            # the index is written last, so that a segment is only visible once all its values are on disk
+            with open(f'{prefix}.index.npy.tmp', 'wb') as f:
+                np.save(f, index)
+            os.replace(f'{prefix}.index.npy.tmp', f'{prefix}.index.npy')
+
+        self.buffer = []
+        # segments written since the shards were opened are picked up on the next lookup
+        self.shards = {}
+
+    def _open_shard(self, shard: int) -> Dict:
+        """Load the indices of all the segments of a shard, sorted by key, and memory-map their values."""
+        if shard in self.shards:
+            return self.shards[shard]
+
+        indices, values = [], []
+        for index_path in sorted(glob(os.path.join(self.path, f'shard-{shard:03d}-*.index.npy'))):
+            prefix = index_path[:-len('.index.npy')]
+            indices.append(np.load(index_path))
+            segment_values = {}
+
+            for name, (dtype, width) in self.fields.items():
+                if os.path.getsize(f'{prefix}.{name}.bin') == 0:
+                    segment_values[name] = np.empty((0, width), dtype=storage_dtype(dtype))
+                else:
+                    segment_values[name] = np.memmap(f'{prefix}.{name}.bin', dtype=storage_dtype(dtype), mode='r').reshape(-1, width)
+            values.append(segment_values)
+
+        index = np.concatenate(indices) if indices else np.zeros(0, dtype=self.index_dtype)
+        segments = np.concatenate([ np.full(len(x), i) for i, x in enumerate(indices) ]) if indices else np.zeros(0, dtype=np.int64)
+        order = np.argsort(index['key'], kind='stable')
+
+        self.shards[shard] = { 'index': index[order], 'segments': segments[order], 'values': values }
+        return self.shards[shard]
+
+    def _search(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the shard of every (unsigned) key, its position in the shard's sorted index and whether it was found."""
+        shards = keys % np.uint64(self.num_shards)
+        positions = np.zeros(len(keys), dtype=np.int64)
+        found = np.zeros(len(keys), dtype=bool)
+
+        for shard in np.unique(shards):
+            entries = np.nonzero(shards == shard)[0]
+            stored_keys = self._open_shard(int(shard))['index']['key']
+            if len(stored_keys) == 0:
+                continue
+
+            positions[entries] = np.minimum(np.searchsorted(stored_keys, keys[entries]), len(stored_keys) - 1)
+            found[entries] = stored_keys[positions[entries]] == keys[entries]
+
+        return shards, positions, found
+
+    def contains(self, keys: Union[Sequence[int], np.ndarray, torch.Tensor]) -> np.ndarray:
+        """Return a boolean array marking which of the given keys are in the store."""
+        return self._search(as_keys(keys))[2]
+
+    def get(self, key: int) -> Optional[Dict[str, np.ndarray]]:
+        """Return the values of every field of one key (in their storage dtype), or None if the key is not in the store."""
+        shards, positions, found = self._search(as_keys([ key ]))
+        if not found[0]:
+            return None
+
+        data = self.shards[int(shards[0])]
+        entry = data['index'][positions[0]]
+        values = data['values'][data['segments'][positions[0]]]
+        return { name: values[name][entry[f'{name}_offset']:entry[f'{name}_offset'] + entry[f'{name}_length']] for name in self.fields }
+
+    def gather(self, keys: Union[Sequence[int], np.ndarray, torch.Tensor], field: str, num_rows: Optional[int] = None,
+               allocate: Optional[Callable[[Tuple[int, ...], np.dtype], np.ndarray]] = None) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        Return the values of the given field for all the given keys.
+
+        Args:
+            keys: keys to look up
+            field: name of the field
+            num_rows: if given, the rows of every key are written at the start of a block of num_rows rows of its own,
+                followed by zeros, instead of being concatenated
+            allocate: function that returns the array of the given shape and (storage) dtype to write the values to, e.g.,
+                a view of a pinned buffer; np.empty by default
+
+        Returns:
+            values: tensor of shape (total_rows, width), with the rows of all the keys concatenated in the order of the
+                keys, or of shape (num_keys, num_rows, width) if num_rows is given; the last dimension is dropped if the
+                width is 1
+            lengths: tensor of shape (num_keys,) with the number of rows of every key
+        """
+        dtype, width = self.fields[field]
+        shards, positions, found = self._search(as_keys(keys))
+        if not found.all():
+            raise KeyError(f"{(~found).sum()} sequences missing from the reference store at {self.path}")
+
+        lengths = np.zeros(len(positions), dtype=np.int64)
+        groups = []
+        for shard in np.unique(shards):
+            entries = np.nonzero(shards == shard)[0]
+            data = self.shards[int(shard)]
+            index = data['index'][positions[entries]]
+            segments = data['segments'][positions[entries]]
+            lengths[entries] = index[f'{field}_length']
+
+            for segment in np.unique(segments):
+                selected = segments == segment
+                groups.append((data['values'][segment][field], entries[selected], index[f'{field}_offset'][selected]))
+
+        if num_rows is None:
+            offsets = np.cumsum(lengths) - lengths
+            values = (allocate or np.empty)((lengths.sum(), width), storage_dtype(dtype))
+        else:
+            if (lengths > num_rows).any():
+                raise ValueError(f"sequences of up to {lengths.max()} rows do not fit in {num_rows} rows")
+            offsets = np.arange(len(lengths)) * num_rows
+            values = (allocate or np.empty)((len(lengths) * num_rows, width), storage_dtype(dtype))
+            values[:] = 0
+
+        for source, entries, source_offsets in groups:
+            values[ranges(offsets[entries], lengths[entries])] = source[ranges(source_offsets, lengths[entries])]
+
+        values = torch.from_numpy(values.view(np.int16)).view(torch.bfloat16) if dtype == 'bfloat16' else torch.from_numpy(values)
+        if num_rows is not None:
+            values = values.view(len(lengths), num_rows, width)
+        return (values.squeeze(-1) if width == 1 else values), torch.from_numpy(lengths)
+
+
+class StagingBuffers:
+    """
+    Pinned host buffers for ReferenceStore.gather to write batches to (through its allocate argument), from which the
+    batches are copied to the GPU without blocking. Every name (e.g., a field) has two buffers that are used in turn, so
+    that filling one of them only waits for the copy from it two batches earlier; the buffers grow to the largest batch.
+    """
+    num_buffers = 2
+
+    def __init__(self):
+        self.buffers, self.events, self.turns, self.staged = {}, {}, {}, {}
+
+    def allocator(self, name: str) -> Callable[[Tuple[int, ...], np.dtype], np.ndarray]:
+        """Return an allocate function for ReferenceStore.gather that hands out the next buffer of the given name."""
+        def allocate(shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+            buffers = self.buffers.setdefault(name, [ None ] * self.num_buffers)
+            events = self.events.setdefault(name, [ None ] * self.num_buffers)
+            turn = self.turns[name] = (self.turns.get(name, -1) + 1) % self.num_buffers
+
+            # the copy from this buffer must be done before it is overwritten
+            if events[turn] is not None:
+                events[turn].synchronize()
+
+            # bfloat16 values are stored as uint16, which torch does not pin
+            torch_dtype = torch.int16 if dtype == np.uint16 else torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+            numel = int(np.prod(shape))
+            if buffers[turn] is None or buffers[turn].dtype != torch_dtype or buffers[turn].numel() < numel:
+                buffers[turn] = torch.empty(numel, dtype=torch_dtype, pin_memory=True)
+
+            self.staged[name] = buffers[turn][:numel].view(shape)
+            array = self.staged[name].numpy()
+            return array.view(np.uint16) if dtype == np.uint16 else array
+
+        return allocate
+
+    def to(self, name: str, device: torch.device) -> torch.Tensor:
+        """Start copying the batch last written to a buffer of the given name to the device, and return the device tensor."""
+        values = self.staged[name].to(device, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self.events[name][self.turns[name]] = event
+        return values
+
+
+def reference_fingerprint(reference_model: torch.nn.Module, tokenizer, config) -> Tuple[str, Dict]:
+    """
+    Return a fingerprint of everything that determines the cached reference values of a sequence with a given example
+    id: the weights of the reference model (hashed from memory, so that local overrides and resized embeddings count),
+    its dtype and attention implementation, the tokenizer and its chat template, and the truncation settings.
+
+    The datasets are left out: the stores are keyed by example id, so other datasets only add sequences to them.
+
+    Returns:
+        The fingerprint as a hex string, and the dict of the components it was computed from.
+    """
+    weights = hashlib.blake2b(digest_size=16)
+    for name, tensor in sorted(reference_model.state_dict().items()):
+        weights.update(name.encode())
+        weights.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+
+    vocab = hashlib.blake2b(json.dumps(sorted(tokenizer.get_vocab().items())).encode(), digest_size=16)
+    components = {
+        'weights': weights.hexdigest(),
+        'reference_dtype': config.model.reference_dtype,
+        'attn_implementation': getattr(reference_model.config, '_attn_implementation', None),
+        'vocab': vocab.hexdigest(),
+        'special_tokens': tokenizer.special_tokens_map,
+        'chat_template': getattr(tokenizer, 'chat_template', None),
+        'max_length': config.model.max_length,
+        'max_prompt_length': config.model.max_prompt_length,
+    }
+    fingerprint = hashlib.blake2b(json.dumps(components, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return fingerprint, components
+
+
+# interval between the touches of the 'last_used' file of a reference cache entry in use (see keep_reference_cache_alive)
+REFERENCE_CACHE_KEEPALIVE_SECS = 600
+
+
+def keep_reference_cache_alive(path: str, interval: float = REFERENCE_CACHE_KEEPALIVE_SECS) -> Event:
+    """
+    Touch the 'last_used' file of a reference cache entry now, and then every interval seconds from a daemon thread for
+    as long as the process runs, so that evict_reference_caches (of this or any concurrent run) never removes an entry
+    that is in use.
+
+    Returns:
+        An event that stops the touches when set.
+    """
+    last_used_path = os.path.join(path, 'last_used')
+    open(last_used_path, 'w').close()
+    stop = Event()
+
+    def touch():
+        while not stop.wait(interval):
+            try:
+                os.utime(last_used_path)
+            except OSError:
+                pass
+
+    Thread(target=touch, daemon=True).start()
+    return stop
+
+
+def evict_reference_caches(cache_dir: str, keep: Optional[str] = None, max_size_gb: Optional[float] = None, max_age_days: Optional[float] = None,
+                           live_secs: float = 3 * REFERENCE_CACHE_KEEPALIVE_SECS):
+    """
+    Remove the entries (subdirectories) of a shared reference cache directory that were last used more than max_age_days
+    ago, and then the least recently used ones until the remaining entries take at most max_size_gb. An entry is used
+    when its 'last_used' file is touched, which keep_reference_cache_alive does periodically while a run uses it.
+    The entry named keep and the entries touched in the last live_secs seconds (in use by a running job) are never
+    removed, but still count towards max_size_gb.
+    """
+    entries = []
+    total_size = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path):
+            continue
+
+        last_used_path = os.path.join(path, 'last_used')
+        try:
+            last_used = os.path.getmtime(last_used_path if os.path.exists(last_used_path) else path)
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+        except OSError:
+            # removed by a concurrent eviction
+            continue
+
+        total_size += size
+        if name != keep and time.time() - last_used >= live_secs:
+            entries.append((last_used, size, path))
+
+    for last_used, size, path in sorted(entries):
+        expired = max_age_days is not None and time.time() - last_used > max_age_days * 86400
+        too_large = max_size_gb is not None and total_size > max_size_gb * 2**30
+        if expired or too_large:
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
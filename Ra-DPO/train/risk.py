@@ -0,0 +1,330 @@
+# Copyright (c) 2023 Contextual AI, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+VaR/CVaR engine used by the risk-aware trainers.
+
+The Value-at-Risk of a (batch, seq, vocab) tensor is the (1 - confidence_level) quantile over the vocabulary
+dimension. torch.quantile finds it by sorting the full vocabulary at every position, which is wasteful (only
+the lower tail is needed) and fails on inputs with more than 2^24 elements. The 'select' method below only
+selects the order statistics that the linear interpolation of torch.quantile needs, using topk over the
+shorter tail of the distribution.
+
+Both methods return the same threshold up to float32 rounding of the interpolation (|difference| <= 1e-6 times
+the magnitude of the values), so the CVaR masks they produce agree except for entries that lie exactly on the
+threshold.
+
+The confidence level can also be a list, in which case the VaR/CVaR is computed at every level at once, with the
+order statistics of all levels taken from a single selection.
+
+Instead of recomputing the VaR at every position, StreamingVaR tracks it across steps with P^2 estimates of the
+quantiles of the values pooled over positions (globally or per bucket of response positions), so that the CVaR mask
+is a single comparison against a precomputed threshold.
+"""
+import numpy as np
+import torch
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+
+VAR_METHODS = ('quantile', 'select')
+
+
+def _quantile_ranks(q: float, n: int, dtype: torch.dtype) -> Tuple[int, int, torch.Tensor]:
+    """
+    Return the indices of the order statistics below/above the q-quantile of n values, as well as the weight used
+    to interpolate between them. The rank is computed in the dtype of the input, exactly like torch.quantile.
+    """
+    rank = torch.tensor(q, dtype=dtype) * (n - 1)
+    rank_below = rank.floor()
+    return int(rank_below.item()), int(rank.ceil().item()), rank - rank_below
+
+
+def select_quantile(values: torch.Tensor, q: float, dim: int = -1) -> torch.Tensor:
+    """
+    Compute the q-quantile of values along dim with linear interpolation, like torch.quantile, but without sorting.
+
+    Only the order statistics on the shorter side of the quantile are selected with an unsorted topk; the two that
+    are needed for the interpolation are then picked from that (small) selection.
+
+    Args:
+        values: tensor of any shape
+        q: quantile in [0, 1]
+        dim: dimension over which to compute the quantile
+
+    Returns:
+        Tensor with the same shape as values, except that dim has size 1.
+    """
+    n = values.size(dim)
+    lo, hi, weight = _quantile_ranks(q, n, values.dtype)
+
+    if hi <= (n - 1) // 2:
+        # lower tail: the (hi + 1) smallest values contain order statistics lo and hi as their two largest
+        tail = torch.topk(values, hi + 1, dim=dim, largest=False, sorted=False).values
+        ends = torch.topk(tail, min(2, hi + 1), dim=dim, largest=True, sorted=True).values
+        value_above = ends.narrow(dim, 0, 1)
+        value_below = ends.narrow(dim, ends.size(dim) - 1, 1) if hi > lo else value_above
+    else:
+        # upper tail: the (n - lo) largest values contain order statistics lo and hi as their two smallest
+        tail = torch.topk(values, n - lo, dim=dim, largest=True, sorted=False).values
+        ends = torch.topk(tail, min(2, n - lo), dim=dim, largest=False, sorted=True).values
+        value_below = ends.narrow(dim, 0, 1)
+        value_above = ends.narrow(dim, ends.size(dim) - 1, 1) if hi > lo else value_below
+
+    return torch.lerp(value_below, value_above, weight.to(values.device))
+
+
+def select_quantiles(values: torch.Tensor, qs: Sequence[float]) -> torch.Tensor:
+    """
+    Compute several quantiles of values over the last dimension, like select_quantile, from a single topk.
+
+    The sorted topk covers the shorter of the two tails that contains all the needed order statistics, which are
+    then gathered for every quantile.
+
+    Args:
+        values: tensor of shape (..., n)
+        qs: quantiles in [0, 1]
+
+    Returns:
+        Tensor of shape (..., len(qs)).
+    """
+    if len(qs) == 1:
+        return select_quantile(values, qs[0], dim=-1)
+
+    n = values.size(-1)
+    ranks = [ _quantile_ranks(q, n, values.dtype) for q in qs ]
+    lower_size = max(hi for _, hi, _ in ranks) + 1
+    upper_size = n - min(lo for lo, _, _ in ranks)
+
+    if lower_size <= upper_size:
+        # tail[..., i] is order statistic i
+        tail = torch.topk(values, lower_size, dim=-1, largest=False, sorted=True).values
+        position = lambda rank: rank
+    else:
+        # tail[..., i] is order statistic n - 1 - i
+        tail = torch.topk(values, upper_size, dim=-1, largest=True, sorted=True).values
+        position = lambda rank: n - 1 - rank
+
+    below = tail.index_select(-1, torch.tensor([ position(lo) for lo, _, _ in ranks ], device=values.device))
+    above = tail.index_select(-1, torch.tensor([ position(hi) for _, hi, _ in ranks ], device=values.device))
+    weights = torch.stack([ weight for _, _, weight in ranks ]).to(values.device)
+
+    return torch.lerp(below, above, weights)
+
+
+def value_at_risk(values: torch.Tensor, confidence_level: Union[float, Sequence[float]], method: str = 'select') -> torch.Tensor:
+    """
+    Compute the Value-at-Risk, i.e., the (1 - confidence_level) quantile of values over the last dimension.
+
+    Args:
+        values: tensor of shape (..., vocab_size)
+        confidence_level: the confidence level of the VaR (e.g., 0.95), or a list of them
+        method: 'quantile' (full sort with torch.quantile) or 'select' (topk over the needed tail only)
+
+    Returns:
+        Tensor of shape (..., 1), or (..., len(confidence_level)) if confidence_level is a list.
+    """
+    if not isinstance(confidence_level, (int, float)):
+        if method == 'quantile':
+            qs = torch.tensor([ 1 - c for c in confidence_level ], dtype=values.dtype, device=values.device)
+            return torch.quantile(values, qs, dim=-1).movedim(0, -1)
+        elif method == 'select':
+            return select_quantiles(values, [ 1 - c for c in confidence_level ])
+        else:
+            raise ValueError(f"unknown VaR method '{method}'; must be one of {VAR_METHODS}")
+
+    if method == 'quantile':
+        return torch.quantile(values, 1 - confidence_level, dim=-1).unsqueeze(-1)
+    elif method == 'select':
+        return select_quantile(values, 1 - confidence_level, dim=-1)
+    else:
+        raise ValueError(f"unknown VaR method '{method}'; must be one of {VAR_METHODS}")
+
+
+def conditional_value_at_risk(losses: torch.Tensor, probabilities: torch.Tensor, confidence_level: Union[float, Sequence[float]], method: str = 'select',
+                              VaR: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Compute the probability-weighted losses above the VaR of the losses (summing over the last dimension gives the CVaR).
+
+    Args:
+        losses: tensor of shape (..., vocab_size)
+        probabilities: tensor of shape (..., vocab_size) used to weigh the losses
+        confidence_level: the confidence level of the VaR (e.g., 0.95), or a list of them
+        method: how to compute the VaR; see value_at_risk
+        VaR: optional precomputed VaR (e.g., from StreamingVaR) with the shape returned by value_at_risk; the NaN entries
+            are computed from the losses
+
+    Returns:
+        Tensor of shape (..., vocab_size), or (..., len(confidence_level), vocab_size) if confidence_level is a list.
+    """
+    if VaR is None:
+        VaR = value_at_risk(losses, confidence_level, method)
+    elif VaR.isnan().any():
+        VaR = torch.where(VaR.isnan(), value_at_risk(losses, confidence_level, method), VaR)
+
+    if not isinstance(confidence_level, (int, float)):
+        # compare every level's VaR against the same losses
+        VaR = VaR.unsqueeze(-1)
+        losses, probabilities = losses.unsqueeze(-2), probabilities.unsqueeze(-2)
+
+    mask = losses > VaR
+    return probabilities * losses * mask.float()
+
+
+class StreamingQuantiles:
+    """
+    P^2 estimates (Jain & Chlamtac, 1985) of several quantiles of several independent streams of values.
+
+    Every (stream, quantile) pair keeps five markers, so the memory does not grow with the number of observations.
+    All the streams are updated at once, one observation per stream at a time. Since this is a sequence of many
+    operations on tiny arrays, the state is kept in float64 numpy arrays on the CPU, where these are cheap.
+    """
+    def __init__(self, num_streams: int, qs: Sequence[float]):
+        qs = np.asarray(qs, dtype=np.float64)[:, None]
+        self.increments = np.concatenate((np.zeros_like(qs), qs / 2, qs, (1 + qs) / 2, np.ones_like(qs)), axis=-1)
+
+        self.heights = np.zeros((num_streams, len(qs), 5))
+        self.positions = np.broadcast_to(np.arange(1., 6.), self.heights.shape).copy()
+        self.desired_positions = np.broadcast_to(1 + 4 * self.increments, self.heights.shape).copy()
+        self.counts = np.zeros(num_streams, dtype=np.int64)
+
+    def update(self, values: torch.Tensor):
+        """
+        Args:
+            values: tensor of shape (num_streams, num_observations); NaN and infinite entries are skipped
+        """
+        values = values.detach().to('cpu', torch.float64).numpy()
+        values = np.where(np.isfinite(values), values, np.nan)
+
+        for column in values.T:
+            valid = ~np.isnan(column)
+
+            # the first five observations of a stream become its markers
+            initializing = np.flatnonzero(valid & (self.counts < 5))
+            if len(initializing):
+                self.heights[initializing, :, self.counts[initializing]] = column[initializing, None]
+                self.counts[initializing] += 1
+                complete = initializing[self.counts[initializing] == 5]
+                self.heights[complete] = np.sort(self.heights[complete], axis=-1)
+                valid[initializing] = False
+
+            active = valid & (self.counts >= 5)
+            if active.any():
+                self._step(active, column)
+                self.counts[active] += 1
+
+    def _step(self, active: np.ndarray, column: np.ndarray):
+        """Apply the P^2 update with the observations in column to the active streams."""
+        h, n, desired = self.heights, self.positions, self.desired_positions
+        active = active[:, None]
+        x = np.where(active, column[:, None], h[..., 2])
+
+        h[..., 0] = np.minimum(h[..., 0], x)
+        h[..., 4] = np.maximum(h[..., 4], x)
+        # index of the cell [h_k, h_{k+1}) that contains x, in 0..3
+        k = (x[..., None] >= h[..., 1:4]).sum(-1, keepdims=True)
+        n += (np.arange(5) > k) & active[..., None]
+        desired += self.increments * active[..., None]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in (1, 2, 3):
+                d = desired[..., i] - n[..., i]
+                move = active & (((d >= 1) & (n[..., i + 1] - n[..., i] > 1)) | ((d <= -1) & (n[..., i - 1] - n[..., i] < -1)))
+                if not move.any():
+                    continue
+                sign = np.sign(d)
+
+                parabolic = h[..., i] + sign / (n[..., i + 1] - n[..., i - 1]) * (
+                    (n[..., i] - n[..., i - 1] + sign) * (h[..., i + 1] - h[..., i]) / (n[..., i + 1] - n[..., i])
+                    + (n[..., i + 1] - n[..., i] - sign) * (h[..., i] - h[..., i - 1]) / (n[..., i] - n[..., i - 1])
+                )
+                neighbour_h = np.where(sign > 0, h[..., i + 1], h[..., i - 1])
+                neighbour_n = np.where(sign > 0, n[..., i + 1], n[..., i - 1])
+                linear = h[..., i] + sign * (neighbour_h - h[..., i]) / (neighbour_n - n[..., i])
+
+                adjusted = np.where((h[..., i - 1] < parabolic) & (parabolic < h[..., i + 1]), parabolic, linear)
+                h[..., i] = np.where(move, adjusted, h[..., i])
+                n[..., i] += np.where(move, sign, 0)
+
+    def estimates(self) -> torch.Tensor:
+        """Return the current estimates, of shape (num_streams, num_quantiles); NaN for streams with fewer than five observations."""
+        return torch.from_numpy(np.where((self.counts < 5)[:, None], np.nan, self.heights[..., 2]))
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return {k: torch.from_numpy(getattr(self, k).copy()) for k in ('heights', 'positions', 'desired_positions', 'counts')}
+
+    def load_state_dict(self, state_dict: Dict[str, torch.Tensor]):
+        for k, v in state_dict.items():
+            setattr(self, k, v.numpy().copy())
+
+
+class StreamingVaR:
+    """
+    Streaming estimate of the VaR of the values at the response positions, pooled across steps, either globally or per
+    bucket of response positions, and separately for each of num_parts parts of the vocabulary (e.g., the two halves
+    used by Ra-DPO's is_split_risk_ratio).
+    """
+    def __init__(self, confidence_levels: Sequence[float], num_parts: int = 1, num_buckets: int = 1, bucket_size: Optional[int] = None, num_samples: int = 32):
+        """
+        Args:
+            confidence_levels: list of confidence levels of the VaR
+            num_parts: number of parts of the vocabulary with separate estimates
+            num_buckets: number of buckets of response positions; the last bucket holds all the positions beyond it
+            bucket_size: number of response positions per bucket (None if num_buckets is 1)
+            num_samples: maximum number of values per part and bucket with which every call to sample_grid updates the estimates
+        """
+        self.num_parts = num_parts
+        self.num_buckets = num_buckets
+        self.bucket_size = bucket_size
+        self.num_samples = num_samples
+        self.quantiles = StreamingQuantiles(num_parts * num_buckets, [ 1 - c for c in confidence_levels ])
+
+    def buckets(self, response_positions: torch.LongTensor) -> torch.LongTensor:
+        """Map the index of every position within its response to its bucket."""
+        if self.num_buckets == 1:
+            return torch.zeros_like(response_positions)
+        return (response_positions // self.bucket_size).clamp(max=self.num_buckets - 1)
+
+    def thresholds(self, buckets: torch.LongTensor) -> torch.Tensor:
+        """Return the current VaR estimates of the given buckets, of shape (len(buckets), num_parts, num_confidence_levels) (NaN until estimated)."""
+        estimates = self.quantiles.estimates().view(self.num_parts, self.num_buckets, -1).float().to(buckets.device)
+        return estimates[:, buckets].transpose(0, 1)
+
+    def sample_grid(self, samples: torch.Tensor, buckets: torch.LongTensor) -> torch.Tensor:
+        """
+        Randomly pick up to num_samples of the given values for every part and bucket.
+
+        Args:
+            samples: values sampled at every position, of shape (num_positions, num_parts, samples_per_position)
+            buckets: bucket of every position, of shape (num_positions,)
+
+        Returns:
+            Tensor of shape (num_parts * num_buckets, num_samples), padded with NaN; this can be gathered across processes
+            before being passed to update.
+        """
+        streams = torch.arange(self.num_parts, device=samples.device).view(1, -1, 1) * self.num_buckets + buckets.view(-1, 1, 1)
+        streams, samples = streams.expand(samples.shape).flatten(), samples.detach().flatten()
+
+        # shuffle, then group by stream
+        order = torch.randperm(len(samples), device=samples.device)
+        order = order[streams[order].argsort(stable=True)]
+        streams, samples = streams[order], samples[order]
+
+        offsets = torch.bincount(streams, minlength=self.num_parts * self.num_buckets).cumsum(0) - torch.bincount(streams, minlength=self.num_parts * self.num_buckets)
+        ranks = torch.arange(len(streams), device=samples.device) - offsets[streams]
+        keep = ranks < self.num_samples
+
+        grid = samples.new_full((self.num_parts * self.num_buckets, self.num_samples), float('nan'))
+        grid[streams[keep], ranks[keep]] = samples[keep]
+        return grid
+
+    def update(self, grid: torch.Tensor):
+        """Update the estimates with a grid of shape (num_parts * num_buckets, num_observations) returned by sample_grid."""
+        self.quantiles.update(grid)
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return self.quantiles.state_dict()
+
+    def load_state_dict(self, state_dict: Dict[str, torch.Tensor]):
+        self.quantiles.load_state_dict(state_dict)
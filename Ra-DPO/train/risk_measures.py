@@ -0,0 +1,135 @@
+# Copyright (c) 2023 Contextual AI, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Risk measures for the risk ratio of Ra-DPO.
+
+Every measure maps the losses X = log p_ref - log p_policy over the vocabulary at a batch of positions, together with
+the reference probabilities p_ref that weigh them, to one value per position and confidence level:
+
+    cvar:     sum_v p_ref(v) X(v) 1[X(v) > VaR], where the VaR is the (1 - confidence_level) quantile of X over the
+              vocabulary (the original formulation of Ra-DPO)
+    entropic: (1 / theta) log E_ref[exp(theta X)]
+    evar:     inf_{z > 0} (1 / z) log(E_ref[exp(z X)] / (1 - confidence_level)), the entropic value-at-risk
+    wang:     the distortion risk measure of X under p_ref with the Wang transform g(u) = Phi(Phi^-1(u) + wang_lambda)
+
+As theta -> 0 (entropic) and wang_lambda = 0 (wang), the measures reduce to E_ref[X], i.e., the token-level KL
+divergence used by TDPO. Only 'cvar' and 'evar' depend on the confidence level; the others are repeated for every level.
+
+All measures take tensors of shape (..., vocab_size) and act independently on every row, so rows can be processed in
+chunks (see compute_risk) to bound the memory of the vocabulary-wide intermediate tensors. Entries with zero reference
+probability do not contribute to the value.
+"""
+import math
+import torch
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .risk import conditional_value_at_risk
+from .utils import chunked_apply
+
+
+def cvar(losses: torch.Tensor, probabilities: torch.Tensor, confidence_levels: Sequence[float], var_method: str = 'select',
+         var: Optional[torch.Tensor] = None, **kwargs) -> torch.Tensor:
+    """
+    Probability-weighted sum of the losses above their VaR. Returns a tensor of shape (..., len(confidence_levels)).
+    The VaR can be given as var, of shape (..., len(confidence_levels)) (see risk.StreamingVaR).
+    """
+    return conditional_value_at_risk(losses, probabilities, list(confidence_levels), var_method, VaR=var).sum(-1)
+
+
+def entropic_risk(losses: torch.Tensor, probabilities: torch.Tensor, confidence_levels: Sequence[float], theta: float = 1.0, **kwargs) -> torch.Tensor:
+    """Entropic risk with risk aversion theta > 0. Returns a tensor of shape (..., len(confidence_levels))."""
+    value = torch.logsumexp(theta * losses + probabilities.log(), dim=-1) / theta
+    return value.unsqueeze(-1).expand(*value.shape, len(confidence_levels))
+
+
+def entropic_value_at_risk(losses: torch.Tensor, probabilities: torch.Tensor, confidence_levels: Sequence[float], num_points: int = 32, **kwargs) -> torch.Tensor:
+    """
+    Entropic value-at-risk. Returns a tensor of shape (..., len(confidence_levels)).
+
+    The infimum over z is taken over num_points log-spaced values in [1e-2, 1e2], without gradients. The value is then
+    recomputed at the selected z, which gives the right gradient since the derivative with respect to z vanishes at the
+    infimum.
+    """
+    log_probabilities = probabilities.log()
+    log_tails = torch.tensor([ math.log(1 - c) for c in confidence_levels ], dtype=losses.dtype, device=losses.device)
+
+    with torch.no_grad():
+        zs = torch.logspace(-2, 2, num_points, dtype=losses.dtype, device=losses.device)
+        # one (..., vocab_size) tensor at a time, so that the grid does not multiply the memory
+        cumulants = torch.stack([ torch.logsumexp(z * losses + log_probabilities, dim=-1) for z in zs ], dim=-1)
+        best = ((cumulants.unsqueeze(-2) - log_tails.unsqueeze(-1)) / zs).argmin(-1)
+        z = zs[best]
+
+    cumulant = torch.logsumexp(z.unsqueeze(-1) * losses.unsqueeze(-2) + log_probabilities.unsqueeze(-2), dim=-1)
+    return (cumulant - log_tails) / z
+
+
+def wang_risk(losses: torch.Tensor, probabilities: torch.Tensor, confidence_levels: Sequence[float], wang_lambda: float = 0.5, **kwargs) -> torch.Tensor:
+    """
+    Distortion risk measure with the Wang transform; wang_lambda > 0 puts more weight on the larger losses.
+    Returns a tensor of shape (..., len(confidence_levels)).
+    """
+    sorted_losses, order = losses.sort(dim=-1, descending=True)
+    # probability of a loss at least as large as each sorted loss
+    tail_probabilities = probabilities.gather(-1, order).cumsum(-1)
+
+    normal = torch.distributions.Normal(0., 1.)
+    eps = torch.finfo(tail_probabilities.dtype).eps
+    distorted = normal.cdf(normal.icdf(tail_probabilities.clamp(eps, 1 - eps)) + wang_lambda)
+    weights = torch.diff(distorted, dim=-1, prepend=torch.zeros_like(distorted[..., :1]))
+
+    # entries without probability get no weight, which also keeps their (possibly infinite) losses out of the sum
+    value = (weights * sorted_losses.masked_fill(weights == 0, 0)).sum(-1)
+    return value.unsqueeze(-1).expand(*value.shape, len(confidence_levels))
+
+
+RISK_MEASURES: Dict[str, Callable[..., torch.Tensor]] = {
+    'cvar': cvar,
+    'entropic': entropic_risk,
+    'evar': entropic_value_at_risk,
+    'wang': wang_risk,
+}
+
+
+def compute_risk(risk_measure: str, losses: torch.Tensor, probabilities: torch.Tensor, confidence_levels: Sequence[float],
+                 chunk_size: Optional[int] = None, var: Optional[torch.Tensor] = None, **kwargs) -> torch.Tensor:
+    """
+    Compute a risk measure over the last dimension.
+
+    Args:
+        risk_measure: name of the measure (one of RISK_MEASURES)
+        losses: tensor of shape (num_rows, vocab_size)
+        probabilities: tensor of shape (num_rows, vocab_size) used to weigh the losses
+        confidence_levels: list of confidence levels (e.g., [0.95])
+        chunk_size: if set, process this many rows at a time (see utils.chunked_apply)
+        var: optional precomputed VaR of shape (num_rows, len(confidence_levels)), only supported by 'cvar'
+        kwargs: parameters of the measure (e.g., theta for 'entropic')
+
+    Returns:
+        Tensor of shape (num_rows, len(confidence_levels)).
+    """
+    if risk_measure not in RISK_MEASURES:
+        raise ValueError(f"unknown risk measure '{risk_measure}'; must be one of {list(RISK_MEASURES)}")
+
+    measure = RISK_MEASURES[risk_measure]
+    if var is None:
+        return chunked_apply(lambda l, p: (measure(l, p, confidence_levels, **kwargs),), losses, probabilities, chunk_size=chunk_size, dim=0)[0]
+
+    if risk_measure != 'cvar':
+        raise ValueError(f"a precomputed VaR is only supported by the 'cvar' risk measure, not '{risk_measure}'")
+    return chunked_apply(lambda l, p, v: (measure(l, p, confidence_levels, var=v, **kwargs),), losses, probabilities, var, chunk_size=chunk_size, dim=0)[0]
+
+
+def split_vocabulary(*tensors: torch.Tensor, is_split: bool = True) -> List[Tuple[torch.Tensor, ...]]:
+    """
+    Return the given (..., vocab_size) tensors restricted to the first and second half of the vocabulary, as two tuples,
+    or the tensors themselves as a single tuple if not is_split.
+    """
+    if not is_split:
+        return [tensors]
+
+    mid_index = tensors[0].size(-1) // 2
+    return [ tuple(t[..., :mid_index] for t in tensors), tuple(t[..., mid_index:] for t in tensors) ]
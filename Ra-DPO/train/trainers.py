@@ -20,7 +20,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 import transformers
 import gc
-from .models import AutoModelForCausalLM, AutoModelForCausalLMWithValueHead
+from .models import AutoModelForCausalLM, AutoModelForCausalLMWithValueHead, AdapterDisabledReference, PipelinedReferenceModel
 from omegaconf import OmegaConf, DictConfig
 from transformers import AutoTokenizer
 from accelerate import Accelerator
@@ -37,8 +37,19 @@ from .utils import (
     entropy_from_logits,
     delete_dicts,
     rowwise_product,
+    chunked_apply,
+    pack_response_positions,
+    unpack_positions,
+    sum_per_sequence,
+    sparsify_reference_logits,
+    sparse_support_logps,
+    split_shared_prefix,
+    repeat_past_key_values,
+    block_diagonal_causal_mask,
     get_base_model_state_dict_from_peft
 )
+from .risk import value_at_risk, StreamingVaR
+from .risk_measures import compute_risk, split_vocabulary
 import numpy as np
 import wandb
 from tqdm import tqdm
@@ -56,6 +67,11 @@ class BasicTrainer(object):
     policy_hf_model_class = AutoModelForCausalLM
     reference_hf_model_class = AutoModelForCausalLM
     use_reference_model = True
+    # if true, the trainer needs the token-level distribution of the reference model and not only its sequence logprobs
+    use_reference_distribution = False
+    # if true, the losses only use the sum of the reference logprobs of every sequence, so the cache can store only the sums
+    # (for KTO, only without loss.tokenwise_KL)
+    sums_reference_logps = False
 
     def __init__(self, 
                  tokenizer: AutoTokenizer, 
@@ -105,22 +121,45 @@ class BasicTrainer(object):
             self.scheduler
         )
 
-    def get_batch_logps(self, logits: torch.FloatTensor, labels: torch.LongTensor):
-        """Compute the token-level log probabilities of the given labels under the given logits."""
+        if isinstance(self.reference_model, AdapterDisabledReference):
+            # the reference has to run the prepared (e.g., FSDP-wrapped) policy
+            self.reference_model = AdapterDisabledReference(self.policy, self.accelerator.unwrap_model(self.policy))
+
+    @property
+    def cached_reference(self) -> bool:
+        """Whether the reference model returns its log probabilities and sparse distributions through the interface of
+        CachedReferenceModel (cached, or computed ahead by PipelinedReferenceModel) instead of logits."""
+        return self.config.cache_reference_logprobs or isinstance(self.reference_model, PipelinedReferenceModel)
+
+    def reference_batches(self, iterator, num_skip_batches: int = 0):
+        """Iterate over the batches of the iterator; with a PipelinedReferenceModel, the reference outputs of the batches
+        after the first num_skip_batches are computed ahead of them (see PipelinedReferenceModel.pipeline)."""
+        if isinstance(self.reference_model, PipelinedReferenceModel):
+            return self.reference_model.pipeline(iterator, num_skip_batches)
+        return iterator
+
+    def gather_metric(self, values: torch.Tensor) -> torch.Tensor:
+        """
+        Gather the values of a metric from all processes. Values per position are first padded to the longest sequence of
+        any process, as if the shards of the batch had been collated together.
+        """
+        if values.dim() > 1:
+            values = self.accelerator.pad_across_processes(values, dim=1)
+        return self.accelerator.gather(values)
+
+    def get_batch_logps(self, logits: torch.FloatTensor, labels: torch.LongTensor, cu_seqlens: Optional[torch.Tensor] = None):
+        """Compute the token-level log probabilities of the given labels under the given logits.
+        For packed sequences, cu_seqlens are their cumulative lengths and the log probabilities are returned per sequence."""
         # ignoring vocab size, batch size x length should be equal
         assert logits.shape[:-1] == labels.shape
 
-        labels = labels[:, 1:].clone()
-        logits = logits[:, :-1, :]
-        loss_mask = (labels != -100)
-
-        # dummy token; we'll ignore the losses on these tokens later
-        labels[labels == -100] = 0
+        # only the response positions are passed through the log-softmax
+        loss_mask, labels, (logits,) = pack_response_positions(labels, logits, cu_seqlens=cu_seqlens)
 
         distribution_logps = logits.float().log_softmax(-1)
-        per_token_logps = torch.gather(distribution_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        per_token_logps = torch.gather(distribution_logps, dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
 
-        return per_token_logps * loss_mask
+        return unpack_positions(per_token_logps, loss_mask)
         
     def get_batch_samples(self, batch: Dict[str, torch.LongTensor]) -> Tuple[str, str]:
         """Generate samples from the policy."""
@@ -196,7 +235,8 @@ class BasicTrainer(object):
         # Wrap the eval_iterator with accelerator.prepare
         eval_dataloader = self.accelerator.prepare(self.eval_iterator)
 
-        for eval_batch in (tqdm(eval_dataloader, desc='Computing eval metrics') if self.accelerator.is_main_process else eval_dataloader):
+        eval_batches = self.reference_batches(eval_dataloader)
+        for eval_batch in (tqdm(eval_batches, desc='Computing eval metrics') if self.accelerator.is_main_process else eval_batches):
             eval_batch = {k: v.to(self.accelerator.device) if isinstance(v, torch.Tensor) else v for k, v in eval_batch.items()}
             with torch.no_grad():
                 _, eval_metrics = self.get_batch_metrics(eval_batch, mode='eval')
@@ -235,15 +275,23 @@ class BasicTrainer(object):
 
         last_log = None
         batch_metrics = defaultdict(list)
+        next_eval = 0 if self.config.do_first_eval else self.config.eval_every
+        # examples in the batches accumulated since the last update, if the batch sizes vary (see model.max_batch_tokens)
+        accumulated_examples = 0
+
+        for batch in self.reference_batches(self.train_iterator, self.num_skip_batches):
+            # the examples in the batch across all processes, which is model.batch_size unless model.max_batch_tokens is set
+            batch_size = len(batch['prompt_text']) * self.accelerator.num_processes
 
-        for batch in self.train_iterator:
             if self.batch_counter < self.num_skip_batches:
                 self.batch_counter += 1
-                self.example_counter += self.config.model.batch_size
+                self.example_counter += batch_size
                 continue
 
             # EVALUATION
-            if self.example_counter % self.config.eval_every == 0 and (self.example_counter > 0 or self.config.do_first_eval):
+            if self.example_counter >= next_eval:
+                # every multiple of eval_every that is reached, even by stepping over it with a batch of varying size
+                next_eval = (self.example_counter // self.config.eval_every + 1) * self.config.eval_every
                 results = self.eval()
 
                 if self.example_counter > 0:
@@ -265,11 +313,19 @@ class BasicTrainer(object):
             with self.accelerator.accumulate(self.policy):
                 batch = {k: v.to(self.accelerator.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
                 loss, metrics = self.get_batch_metrics(batch)
+
+                if self.config.model.max_batch_tokens:
+                    accumulated_examples += batch_size
+
                 self.accelerator.backward(loss)
 
                 for k, v in metrics.items():
                     batch_metrics[k].extend(torch.as_tensor(v).reshape(-1).float().cpu().numpy().tolist())
 
+                if self.config.model.max_batch_tokens and self.accelerator.sync_gradients:
+                    self.scale_accumulated_gradients(accumulated_examples)
+                    accumulated_examples = 0
+
                 grad_norm = self.accelerator.clip_grad_norm_(self.policy.parameters(), self.config.model.max_grad_norm)
                 batch_metrics['grad_norm'].extend(torch.as_tensor(grad_norm).reshape(-1).float().cpu().numpy().tolist())
                 self.optimizer.step()
@@ -278,11 +334,19 @@ class BasicTrainer(object):
                 accumulated += 1
 
             step_time = time.time() - start_time
-            examples_per_second = self.config.model.batch_size / step_time
+            examples_per_second = batch_size / step_time
             batch_metrics['examples_per_second'].append(examples_per_second)
+
+            # time that the step waited for its batch to be built (see dataloader.PrefetchLoader)
+            if isinstance(self.train_iterator, dataloader.PrefetchLoader):
+                batch_metrics['dataloader/starvation_seconds'].append(self.train_iterator.starvation_seconds)
+
+            # fraction of the batch that is padding (see dataloader.DataLoader.length_grouped_batches)
+            if 'padding_ratio' in batch:
+                batch_metrics['dataloader/padding_ratio'].append(batch['padding_ratio'])
             
             self.batch_counter += 1
-            self.example_counter += self.config.model.batch_size
+            self.example_counter += batch_size
 
             if last_log is None or time.time() - last_log > self.config.minimum_log_interval_secs:
                 mean_train_metrics = {}
@@ -308,6 +372,23 @@ class BasicTrainer(object):
                 self.free_memory()
                 accumulated = 0
 
+    def scale_accumulated_gradients(self, accumulated_examples: int):
+        """
+        Scale the gradient accumulated over batches of varying sizes (see model.max_batch_tokens) to that of the same
+        examples in full batches.
+
+        The loss of every batch is a sum over the examples of the process, so the accumulated gradient is the sum over all
+        the examples divided by the number of processes (averaged by DDP/FSDP) and gradient_accumulation_steps (divided
+        by accelerator.backward). Multiplying it by gradient_accumulation_steps * batch_size / accumulated_examples makes
+        it the mean gradient of the examples times the same constant as for full batches, and leaves it unchanged when
+        every batch is full.
+        """
+        scale = self.config.model.gradient_accumulation_steps * self.config.model.batch_size / accumulated_examples
+        if scale != 1:
+            for p in self.policy.parameters():
+                if p.grad is not None:
+                    p.grad.mul_(scale)
+
     def save(self, output_dir: Optional[str] = None, metrics: Optional[Dict] = {}, final_save=True):
         """Save tokenizer, policy model, optimizer, scheduler state to disk."""
         self.accelerator.print(f"Saving...")
@@ -321,6 +402,8 @@ class BasicTrainer(object):
 
             with open(os.path.join(output_dir, 'metrics.json'), 'w') as f:
                 metrics['counter'] = self.example_counter
+                # the batches to skip when resuming, which is not counter / batch_size if model.max_batch_tokens is set
+                metrics['batch_counter'] = self.batch_counter
                 json.dump(metrics, f)
         
         self.accelerator.wait_for_everyone()
@@ -390,7 +473,7 @@ class SFTTrainer(BasicTrainer):
 
         # Gather losses and logps from all processes
         total_nonzero_elements = self.accelerator.gather((policy_chosen_logps != 0).sum().detach()).sum()
-        metrics[f'logps_{mode}/chosen'] = self.accelerator.gather(policy_chosen_logps.detach()).sum() / total_nonzero_elements
+        metrics[f'logps_{mode}/chosen'] = self.accelerator.gather(policy_chosen_logps.sum().detach()).sum() / total_nonzero_elements
         metrics[f'loss/{mode}'] = self.accelerator.gather(losses.sum().detach()).sum() / total_nonzero_elements
 
         del policy_chosen_logits, policy_chosen_logps
@@ -412,7 +495,7 @@ class UnpairedPreferenceTrainer(BasicTrainer):
         """
         with self.accelerator.autocast():
             if use_cache:
-                all_logps = model(batch['target_combined_input_ids']).to(self.policy_dtype).to(self.accelerator.device)
+                all_logps = model(batch['target_combined_input_ids'], batch['target_example_id'], dtype=self.policy_dtype, device=self.accelerator.device)
             else:
                 all_logits = model(
                     batch['target_combined_input_ids'], 
@@ -439,7 +522,7 @@ class UnpairedPreferenceTrainer(BasicTrainer):
         else:
             policy_chosen_logps, policy_rejected_logps = self.forward(self.policy, batch)
             with torch.no_grad():
-                reference_chosen_logps, reference_rejected_logps = self.forward(self.reference_model, batch, use_cache=self.config.cache_reference_logprobs)
+                reference_chosen_logps, reference_rejected_logps = self.forward(self.reference_model, batch, use_cache=self.cached_reference)
             losses, chosen_rewards, rejected_rewards = self.loss(policy_chosen_logps, policy_rejected_logps, reference_chosen_logps, reference_rejected_logps)
 
         # all_gather treats empty lists/tensors poorly, and empty lists can occur because a batch can contain all chosen or all rejected example
@@ -477,7 +560,8 @@ class PairedPreferenceTrainer(BasicTrainer):
             batch: A batch of data. Must contain the keys 'chosen_input_ids' and 'rejected_input_ids', which are tensors of shape (batch_size, sequence_length).
             
         Returns:
-            A dictionary containing the concatenated inputs under the key 'concatenated_input_ids'.
+            A dictionary containing the concatenated inputs under the key 'concatenated_input_ids'. Tensors of shape (batch_size,), like the
+            example ids, are concatenated without padding.
         """
         max_length = max(batch['chosen_combined_input_ids'].shape[1], batch['rejected_combined_input_ids'].shape[1])
         concatenated_batch = {}
@@ -486,7 +570,8 @@ class PairedPreferenceTrainer(BasicTrainer):
             if k.startswith('chosen') and isinstance(batch[k], torch.Tensor):
                 pad_value = -100 if 'labels' in k else 0
                 concatenated_key = k.replace('chosen', 'concatenated')
-                concatenated_batch[concatenated_key] = pad_to_length(batch[k], max_length, pad_value=pad_value)
+                # per-sequence tensors (e.g., the example ids) are not padded
+                concatenated_batch[concatenated_key] = pad_to_length(batch[k], max_length, pad_value=pad_value) if batch[k].dim() > 1 else batch[k]
 
         for k in batch:
             if k.startswith('rejected') and isinstance(batch[k], torch.Tensor):
@@ -494,11 +579,155 @@ class PairedPreferenceTrainer(BasicTrainer):
                 concatenated_key = k.replace('rejected', 'concatenated')
                 concatenated_batch[concatenated_key] = torch.cat((
                     concatenated_batch[concatenated_key],
-                    pad_to_length(batch[k], max_length, pad_value=pad_value),
+                    pad_to_length(batch[k], max_length, pad_value=pad_value) if batch[k].dim() > 1 else batch[k],
                 ), dim=0)
 
+        # packed sequences (see dataloader.DataLoader.pack) are already in the same order
+        for k in batch:
+            if k.startswith('packed') and isinstance(batch[k], torch.Tensor):
+                concatenated_batch[k] = batch[k]
+
         return concatenated_batch
 
+    def forward_inputs(self, model: nn.Module, concatenated_batch: Dict[str, torch.LongTensor]) -> Optional[Dict[str, torch.Tensor]]:
+        """Return the inputs to run the given model on for concatenated_logits: the packed sequences if the model can run
+        them (see packed_inputs), else the shared-prefix inputs if enabled (see shared_prefix_inputs), else None for the
+        padded concatenated sequences."""
+        return self.packed_inputs(model, concatenated_batch) or self.shared_prefix_inputs(model, concatenated_batch)
+
+    def packed_inputs(self, model: nn.Module, concatenated_batch: Dict[str, torch.LongTensor]) -> Optional[Dict[str, torch.Tensor]]:
+        """Return the packed sequences of the batch, if any, with the attention mask to run the given model on them.
+
+        Models using flash attention 2 get no attention mask and tell the sequences apart by their position ids
+        (variable-length attention); other models that accept custom 4D masks get a block-diagonal causal mask. For
+        models that do neither (e.g., GPT-2 and GPT-NeoX in transformers 4.44), None is returned and the padded
+        sequences are used.
+        """
+        if 'packed_input_ids' not in concatenated_batch:
+            return None
+
+        # the HF base model, which builds the attention mask
+        base_model = next((m for m in model.modules() if hasattr(m, '_update_causal_mask')), None)
+        if base_model is None:
+            return None
+
+        packed = { k: concatenated_batch[f'packed_{k}'] for k in ['input_ids', 'labels', 'position_ids', 'cu_seqlens'] }
+        if base_model.config._attn_implementation == 'flash_attention_2':
+            packed['attention_mask'] = None
+        else:
+            packed['attention_mask'] = block_diagonal_causal_mask(packed['cu_seqlens'], base_model.get_input_embeddings().weight.dtype)
+
+        return packed
+
+    def shared_prefix_inputs(self, model: nn.Module, concatenated_batch: Dict[str, torch.LongTensor]) -> Optional[Dict[str, torch.Tensor]]:
+        """Split the concatenated batch with utils.split_shared_prefix if config.shared_prefix_forward is set, else return None.
+
+        HF models do not return a KV cache under activation checkpointing in training mode, so the concatenated
+        sequences are run as they are in that case.
+        """
+        if not self.config.shared_prefix_forward or (model.training and self.config.model.activation_checkpointing):
+            return None
+
+        return split_shared_prefix(
+            concatenated_batch['concatenated_combined_input_ids'],
+            concatenated_batch['concatenated_combined_attention_mask'],
+            concatenated_batch['concatenated_labels'],
+        )
+
+    def concatenated_logits(self, model: nn.Module, concatenated_batch: Dict[str, torch.LongTensor],
+                            inputs: Optional[Dict[str, torch.Tensor]] = None) -> Tuple[torch.FloatTensor, torch.LongTensor, Optional[torch.Tensor]]:
+        """Run the given model on the concatenated chosen and rejected inputs.
+
+        Args:
+            model: the policy or reference model
+            concatenated_batch: output of concatenated_inputs
+            inputs: optional output of forward_inputs; with packed inputs, the sequences are run as a single row without
+                padding; with shared-prefix inputs, the prompt of every pair is encoded once and its KV cache is reused for
+                the chosen and rejected continuations
+
+        Returns:
+            logits: tensor of shape (2 * batch_size, length, vocab_size), over the full sequences or only over the
+                continuations, or of shape (1, total_length, vocab_size) for packed sequences
+            labels: tensor of shape (2 * batch_size, length), or (1, total_length), aligned with the logits
+            cu_seqlens: the cumulative sequence lengths of packed sequences, else None
+        """
+        if inputs is None:
+            logits = model(
+                concatenated_batch['concatenated_combined_input_ids'],
+                attention_mask=concatenated_batch['concatenated_combined_attention_mask'],
+            ).logits
+            return logits.to(self.policy_dtype), concatenated_batch['concatenated_labels'], None
+
+        if 'cu_seqlens' in inputs:
+            logits = model(
+                inputs['input_ids'],
+                attention_mask=inputs['attention_mask'],
+                position_ids=inputs['position_ids'],
+            ).logits
+            return logits.to(self.policy_dtype), inputs['labels'], inputs['cu_seqlens']
+
+        shared_prefix = inputs
+        past_key_values = None
+        if shared_prefix['prefix_input_ids'].shape[1] > 0:
+            # the logits of the prefix are not needed, only its KV cache
+            past_key_values = model(
+                shared_prefix['prefix_input_ids'],
+                attention_mask=shared_prefix['prefix_attention_mask'],
+                use_cache=True,
+            ).past_key_values
+            past_key_values = repeat_past_key_values(past_key_values, 2)
+
+        logits = model(
+            shared_prefix['continuation_input_ids'],
+            attention_mask=shared_prefix['continuation_attention_mask'],
+            position_ids=shared_prefix['continuation_position_ids'],
+            past_key_values=past_key_values,
+            # some models only accept a legacy (tuple) cache when use_cache is set; the returned cache is dropped
+            use_cache=True,
+        ).logits
+        return logits.to(self.policy_dtype), shared_prefix['continuation_labels'], None
+
+    def response_position_inputs(self, logits: torch.FloatTensor, reference_logits: Union[torch.FloatTensor, Tuple[torch.Tensor, ...]],
+                                 labels: torch.LongTensor, cu_seqlens: Optional[torch.Tensor] = None):
+        """Select the response positions of the policy and reference outputs, for the losses that compare their
+        distributions at every position (TDPO and Ra-DPO), so that only those go through the vocabulary-wide computations.
+
+        Args:
+            logits: Logits of the policy (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
+            reference_logits: Logits of the reference model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
+                Alternatively, the sparse reference distribution at the response positions returned by ReferenceModelWrapper.get_reference_distributions.
+            labels: Labels of the sequences. Label tokens with a value of -100 are ignored. Shape: (batch_size, sequence_length)
+            cu_seqlens: For packed sequences (batch_size of 1), their cumulative lengths.
+
+        Returns:
+            The loss mask of the response positions, the labels and policy logits at those positions, the dense reference
+            logits at those positions (None if reference_logits is the cached sparse distribution), the sparse reference distribution at those
+            positions (see sparsify_reference_logits; None unless it is cached or config.loss.reference_topk is set), and
+            the mean reference mass outside the top-k of every sequence (None for a dense reference).
+        """
+        if isinstance(reference_logits, tuple):
+            loss_mask, labels, (logits,) = pack_response_positions(labels, logits, cu_seqlens=cu_seqlens)
+            reference, reference_logits = reference_logits, None
+            assert reference[0].shape[0] == labels.shape[0], "cached reference distributions do not match the response positions"
+        else:
+            assert reference_logits.shape[:-1] == labels.shape
+
+            loss_mask, labels, (logits, reference_logits) = pack_response_positions(labels, logits, reference_logits, cu_seqlens=cu_seqlens)
+            reference = None
+
+            if self.config.loss.reference_topk:
+                with torch.no_grad():
+                    reference = chunked_apply(
+                        functools.partial(sparsify_reference_logits, k=self.config.loss.reference_topk),
+                        reference_logits, labels, chunk_size=self.config.loss.chunk_size, dim=0
+                    )
+
+        reference_tail_mass = None
+        if reference is not None:
+            reference_tail_mass = sum_per_sequence(reference[2].exp(), loss_mask) / loss_mask.sum(-1).clamp(min=1)
+
+        return loss_mask, labels, logits, reference_logits, reference, reference_tail_mass
+
     def forward(self, model: nn.Module, batch: Dict[str, Union[List, torch.LongTensor]], use_cache: bool=False) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
         """Run the given model on the given batch of inputs, concatenating the chosen and rejected inputs together.
            Return two tensors of shape (batch size), one of the chosen examples, another of the rejected ones.
@@ -512,14 +741,10 @@ class PairedPreferenceTrainer(BasicTrainer):
             concatenated_batch = self.concatenated_inputs(batch)
 
             if use_cache:
-                all_logps = model(batch['concatenated_combined_input_ids']).to(self.policy_dtype).to(self.accelerator.device)
+                all_logps = model(concatenated_batch['concatenated_combined_input_ids'], concatenated_batch['concatenated_example_id'], dtype=self.policy_dtype, device=self.accelerator.device)
             else:
-                all_logits = model(
-                    concatenated_batch['concatenated_combined_input_ids'], 
-                    attention_mask=concatenated_batch['concatenated_combined_attention_mask'],
-                ).logits.to(self.policy_dtype)
-                
-                all_logps = self.get_batch_logps(all_logits, concatenated_batch['concatenated_labels'])
+                all_logits, all_labels, cu_seqlens = self.concatenated_logits(model, concatenated_batch, self.forward_inputs(model, concatenated_batch))
+                all_logps = self.get_batch_logps(all_logits, all_labels, cu_seqlens=cu_seqlens)
         
         chosen_logps = all_logps[:batch['chosen_combined_input_ids'].shape[0], ...]
         rejected_logps = all_logps[batch['chosen_combined_input_ids'].shape[0]:, ...]
@@ -535,21 +760,21 @@ class PairedPreferenceTrainer(BasicTrainer):
         else:
             policy_chosen_logps, policy_rejected_logps = self.forward(self.policy, batch)
             with torch.no_grad():
-                reference_chosen_logps, reference_rejected_logps = self.forward(self.reference_model, batch, use_cache=self.config.cache_reference_logprobs)
+                reference_chosen_logps, reference_rejected_logps = self.forward(self.reference_model, batch, use_cache=self.cached_reference)
             losses, chosen_rewards, rejected_rewards = self.loss(policy_chosen_logps, policy_rejected_logps, reference_chosen_logps, reference_rejected_logps)
 
         # accuracy calculated on paired examples (for apples-to-apples comparison with UnpairedPreferenceTrainer)
         reward_accuracies = (chosen_rewards > rejected_rewards).float()
 
-        metrics[f'rewards_{mode}/chosen'] = self.accelerator.gather(chosen_rewards.detach())
-        metrics[f'rewards_{mode}/rejected'] = self.accelerator.gather(rejected_rewards.detach())
-        metrics[f'rewards_{mode}/margins'] = self.accelerator.gather((chosen_rewards - rejected_rewards).detach())
+        metrics[f'rewards_{mode}/chosen'] = self.gather_metric(chosen_rewards.detach())
+        metrics[f'rewards_{mode}/rejected'] = self.gather_metric(rejected_rewards.detach())
+        metrics[f'rewards_{mode}/margins'] = self.gather_metric((chosen_rewards - rejected_rewards).detach())
 
-        metrics[f'rewards_{mode}/accuracies'] = self.accelerator.gather(reward_accuracies.detach())
+        metrics[f'rewards_{mode}/accuracies'] = self.gather_metric(reward_accuracies.detach())
 
-        metrics[f'logps_{mode}/rejected'] = self.accelerator.gather(policy_rejected_logps.detach())
-        metrics[f'logps_{mode}/chosen'] = self.accelerator.gather(policy_chosen_logps.detach())
-        metrics[f'loss/{mode}'] = self.accelerator.gather(losses.mean().detach()).mean()
+        metrics[f'logps_{mode}/rejected'] = self.gather_metric(policy_rejected_logps.detach())
+        metrics[f'logps_{mode}/chosen'] = self.gather_metric(policy_chosen_logps.detach())
+        metrics[f'loss/{mode}'] = self.gather_metric(losses.mean().detach()).mean()
 
         del chosen_rewards, rejected_rewards, reward_accuracies, policy_chosen_logps, policy_rejected_logps
         if self.reference_model:
@@ -559,6 +784,8 @@ class PairedPreferenceTrainer(BasicTrainer):
 
 
 class DPOTrainer(PairedPreferenceTrainer):
+    sums_reference_logps = True
+
     def loss(self,
         policy_chosen_logps: torch.FloatTensor,
         policy_rejected_logps: torch.FloatTensor,
@@ -576,6 +803,8 @@ class DPOTrainer(PairedPreferenceTrainer):
 
 
 class TDPOTrainer(PairedPreferenceTrainer):
+    use_reference_distribution = True
+
     def loss(self,
         chosen_logps_margin: torch.FloatTensor,
         rejected_logps_margin: torch.FloatTensor,
@@ -625,13 +854,15 @@ class TDPOTrainer(PairedPreferenceTrainer):
            We do this to avoid doing two forward passes, because it's faster for FSDP.
         """
         concatenated_batch = self.concatenated_inputs(batch)
-        all_logits = model(concatenated_batch['concatenated_combined_input_ids'],
-                           attention_mask=concatenated_batch['concatenated_combined_attention_mask']).logits.to(self.policy_dtype)
-        with torch.no_grad():
-            reference_all_logits = reference_model(concatenated_batch['concatenated_combined_input_ids'],
-                                                   attention_mask=concatenated_batch[
-                                                       'concatenated_combined_attention_mask']).logits.to(self.policy_dtype)
-        all_logps_margin, all_position_kl, all_logps = self.get_batch_logps(all_logits, reference_all_logits, concatenated_batch['concatenated_labels'])
+        # the reference is run on the same inputs as the policy, so that both logits are aligned with all_labels
+        inputs = self.forward_inputs(model, concatenated_batch)
+        all_logits, all_labels, cu_seqlens = self.concatenated_logits(model, concatenated_batch, inputs)
+        if self.cached_reference:
+            reference_all_logits = reference_model.get_reference_distributions(concatenated_batch['concatenated_example_id'], device=all_logits.device)
+        else:
+            with torch.no_grad():
+                reference_all_logits, _, _ = self.concatenated_logits(reference_model, concatenated_batch, inputs)
+        all_logps_margin, all_position_kl, all_logps, all_reference_tail_mass = self.get_batch_logps(all_logits, reference_all_logits, all_labels, cu_seqlens=cu_seqlens)
 
         chosen_logps_margin = all_logps_margin[:batch['chosen_combined_input_ids'].shape[0]]
         rejected_logps_margin = all_logps_margin[batch['chosen_combined_input_ids'].shape[0]:]
@@ -641,52 +872,87 @@ class TDPOTrainer(PairedPreferenceTrainer):
         rejected_logps = all_logps[batch['chosen_combined_input_ids'].shape[0]:].detach()
 
         return chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, \
-            chosen_logps, rejected_logps
+            chosen_logps, rejected_logps, all_reference_tail_mass
 
-    def get_batch_logps(self, logits: torch.FloatTensor, reference_logits: torch.FloatTensor, labels: torch.LongTensor):
+    def get_batch_logps(self, logits: torch.FloatTensor, reference_logits: torch.FloatTensor, labels: torch.LongTensor, cu_seqlens: Optional[torch.Tensor] = None):
         """Compute the kl divergence/log probabilities of the given labels under the given logits.
 
         Args:
             logits: Logits of the model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
             reference_logits: Logits of the reference model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
+                Alternatively, the sparse reference distribution at the response positions returned by ReferenceModelWrapper.get_reference_distributions.
             labels: Labels for which to compute the log probabilities. Label tokens with a value of -100 are ignored. Shape: (batch_size, sequence_length)
+            cu_seqlens: For packed sequences (batch_size of 1), their cumulative lengths, so that the sums are taken per sequence.
             
         Returns:
             Several tensors of shape (batch_size,) containing the average/sum kl divergence/log probabilities of the given labels under the given logits.
         """
         assert logits.shape[:-1] == labels.shape
-        assert reference_logits.shape[:-1] == labels.shape
 
-        labels = labels[:, 1:].clone()
-        logits = logits[:, :-1, :]
-        reference_logits = reference_logits[:, :-1, :]
+        loss_mask, labels, logits, reference_logits, reference, reference_tail_mass = self.response_position_inputs(logits, reference_logits, labels, cu_seqlens)
+
+        if reference is not None:
+            logps_margin, per_position_kl, per_token_logps = chunked_apply(
+                self.get_sparse_position_stats, logits, *reference, labels, chunk_size=self.config.loss.chunk_size, dim=0
+            )
+        else:
+            logps_margin, per_position_kl, per_token_logps = chunked_apply(
+                self.get_position_stats, logits, reference_logits, labels, chunk_size=self.config.loss.chunk_size, dim=0
+            )
+
+        return sum_per_sequence(logps_margin, loss_mask), \
+            sum_per_sequence(per_position_kl, loss_mask), \
+            sum_per_sequence(per_token_logps, loss_mask), \
+            reference_tail_mass
 
-        loss_mask = (labels != -100)
+    def get_position_stats(self, logits: torch.FloatTensor, reference_logits: torch.FloatTensor, labels: torch.LongTensor):
+        """Compute the log probability margin, the sequential kl divergence and the log probability of the label at every position.
 
-        # dummy token; we'll ignore the losses on these tokens later
-        labels[labels == -100] = 0
+        Args:
+            logits: Logits of the model (unnormalized) at the response positions. Shape: (num_tokens, vocab_size)
+            reference_logits: Logits of the reference model (unnormalized) at the response positions. Shape: (num_tokens, vocab_size)
+            labels: Labels of the response positions. Shape: (num_tokens,)
 
+        Returns:
+            Three tensors of shape (num_tokens,).
+        """
         distribution_logps = logits.float().log_softmax(-1)
         
         reference_distribution_ps = reference_logits.float().softmax(-1)
         reference_distribution_logps = reference_distribution_ps.log()
         per_position_kl = (reference_distribution_ps * (reference_distribution_logps - distribution_logps)).sum(-1)
     
-        per_token_logps = torch.gather(distribution_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2)
-        per_reference_token_logps = torch.gather(reference_distribution_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        per_token_logps = torch.gather(distribution_logps, dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+        per_reference_token_logps = torch.gather(reference_distribution_logps, dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
 
-        logps_margin = per_token_logps - per_reference_token_logps
+        return per_token_logps - per_reference_token_logps, per_position_kl, per_token_logps
 
-        return (logps_margin * loss_mask).sum(-1), \
-            (per_position_kl * loss_mask).sum(-1), \
-            (per_token_logps * loss_mask).sum(-1)
+    def get_sparse_position_stats(self, logits: torch.FloatTensor, topk_ids: torch.LongTensor, topk_logps: torch.FloatTensor,
+                                  tail_logps: torch.FloatTensor, reference_label_logps: torch.FloatTensor, labels: torch.LongTensor):
+        """Like get_position_stats, but with the reference distribution restricted to its top-k tokens plus one bucket for the rest of the vocabulary.
+
+        Args:
+            logits: Logits of the model (unnormalized) at the response positions. Shape: (num_tokens, vocab_size)
+            topk_ids, topk_logps, tail_logps, reference_label_logps: The sparsified reference distribution (see utils.sparsify_reference_logits).
+            labels: Labels of the response positions. Shape: (num_tokens,)
+
+        Returns:
+            Three tensors of shape (num_tokens,).
+        """
+        support_logps, per_token_logps = sparse_support_logps(logits, topk_ids, labels)
+
+        reference_support_logps = torch.cat((topk_logps, tail_logps.unsqueeze(-1)), dim=-1)
+        reference_support_ps = reference_support_logps.exp()
+        per_position_kl = (reference_support_ps * (reference_support_logps - support_logps)).sum(-1)
+
+        return per_token_logps - reference_label_logps, per_position_kl, per_token_logps
 
     def get_batch_metrics(self, batch: Dict[str, Union[List, torch.LongTensor]], mode: str='train'):
         """Compute the TDPO loss and other metrics for the given batch of inputs."""
 
         metrics = {}
 
-        chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, policy_chosen_logps, policy_rejected_logps\
+        chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, policy_chosen_logps, policy_rejected_logps, reference_tail_mass\
             = self.forward(self.policy, self.reference_model, batch)
         losses, chosen_rewards, rejected_rewards = self.loss(chosen_logps_margin, rejected_logps_margin,
                                                                 chosen_position_kl, rejected_position_kl,
@@ -694,16 +960,20 @@ class TDPOTrainer(PairedPreferenceTrainer):
 
         reward_accuracies = (chosen_rewards > rejected_rewards).float()
 
-        metrics[f'KL_{mode}/chosen'] = self.accelerator.gather(chosen_position_kl.detach())
-        metrics[f'KL_{mode}/rejected'] = self.accelerator.gather(rejected_position_kl.detach())
-        metrics[f'KL_{mode}/margins'] = self.accelerator.gather((chosen_position_kl-rejected_position_kl).detach())
+        metrics[f'KL_{mode}/chosen'] = self.gather_metric(chosen_position_kl.detach())
+        metrics[f'KL_{mode}/rejected'] = self.gather_metric(rejected_position_kl.detach())
+        metrics[f'KL_{mode}/margins'] = self.gather_metric((chosen_position_kl-rejected_position_kl).detach())
+
+        if reference_tail_mass is not None:
+            # probability mass of the reference distribution that is dropped by the top-k approximation
+            metrics[f'reference_tail_mass_{mode}'] = self.gather_metric(reference_tail_mass.detach())
         
-        metrics[f'rewards_{mode}/chosen'] = self.accelerator.gather(chosen_rewards.detach())
-        metrics[f'rewards_{mode}/rejected'] = self.accelerator.gather(rejected_rewards.detach())
-        metrics[f'rewards_{mode}/margins'] = self.accelerator.gather((chosen_rewards - rejected_rewards).detach())
+        metrics[f'rewards_{mode}/chosen'] = self.gather_metric(chosen_rewards.detach())
+        metrics[f'rewards_{mode}/rejected'] = self.gather_metric(rejected_rewards.detach())
+        metrics[f'rewards_{mode}/margins'] = self.gather_metric((chosen_rewards - rejected_rewards).detach())
 
-        metrics[f'rewards_{mode}/accuracies'] = self.accelerator.gather(reward_accuracies.detach())
-        metrics[f'loss/{mode}'] = self.accelerator.gather(losses.mean().detach()).mean()
+        metrics[f'rewards_{mode}/accuracies'] = self.gather_metric(reward_accuracies.detach())
+        metrics[f'loss/{mode}'] = self.gather_metric(losses.mean().detach()).mean()
 
         del chosen_rewards, rejected_rewards, reward_accuracies, policy_chosen_logps, policy_rejected_logps
 
@@ -711,6 +981,42 @@ class TDPOTrainer(PairedPreferenceTrainer):
 
 
 class Ra_DPOTrainer(PairedPreferenceTrainer):
+    use_reference_distribution = True
+    # streaming estimate of the VaR thresholds (see config.loss.var_estimator)
+    var_estimator = None
+    measure_var_drift = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if self.config.loss.var_estimator:
+            if self.config.loss.risk_measure != 'cvar' or self.config.loss.is_cal_risk_distribution_logps:
+                raise ValueError("var_estimator is only supported by the cvar risk measure without is_cal_risk_distribution_logps")
+
+            # the dense risk ratio has one VaR per half of the vocabulary if is_split_risk_ratio, the sparse one a single VaR
+            sparse = self.config.loss.reference_topk or self.cached_reference
+            self.var_estimator = StreamingVaR(
+                self.confidence_levels,
+                num_parts=(2 if self.config.loss.is_split_risk_ratio and not sparse else 1),
+                num_buckets=(self.config.loss.var_num_buckets if self.config.loss.var_estimator == 'position' else 1),
+                bucket_size=self.config.loss.var_bucket_size,
+                num_samples=self.config.loss.var_samples_per_bucket,
+            )
+
+            estimator_path = os.path.join(self.config.model.from_checkpoint or '', 'var_estimator.pt')
+            if self.config.model.from_checkpoint and os.path.exists(estimator_path):
+                self.accelerator.print(f'Loading VaR estimator from {estimator_path}')
+                self.var_estimator.load_state_dict(torch.load(estimator_path))
+
+    @property
+    def confidence_levels(self) -> List[float]:
+        """The confidence levels of the risk ratio. config.loss.confidence_level can be a single level or a list of them,
+        in which case the first one is optimized and the risk ratio, rewards and loss are logged at every level."""
+        confidence_level = self.config.loss.confidence_level
+        if isinstance(confidence_level, (int, float)):
+            return [float(confidence_level)]
+        return [ float(c) for c in confidence_level ]
+
     def loss(self,
         chosen_logps_margin: torch.FloatTensor,
         rejected_logps_margin: torch.FloatTensor,
@@ -760,13 +1066,15 @@ class Ra_DPOTrainer(PairedPreferenceTrainer):
            We do this to avoid doing two forward passes, because it's faster for FSDP.
         """
         concatenated_batch = self.concatenated_inputs(batch)
-        all_logits = model(concatenated_batch['concatenated_combined_input_ids'],
-                           attention_mask=concatenated_batch['concatenated_combined_attention_mask']).logits.to(self.policy_dtype)
-        with torch.no_grad():
-            reference_all_logits = reference_model(concatenated_batch['concatenated_combined_input_ids'],
-                                                   attention_mask=concatenated_batch[
-                                                       'concatenated_combined_attention_mask']).logits.to(self.policy_dtype)
-        all_logps_margin, all_position_kl, all_position_risk_ratio, all_logps = self.get_batch_logps(all_logits, reference_all_logits, concatenated_batch['concatenated_labels'])
+        # the reference is run on the same inputs as the policy, so that both logits are aligned with all_labels
+        inputs = self.forward_inputs(model, concatenated_batch)
+        all_logits, all_labels, cu_seqlens = self.concatenated_logits(model, concatenated_batch, inputs)
+        if self.cached_reference:
+            reference_all_logits = reference_model.get_reference_distributions(concatenated_batch['concatenated_example_id'], device=all_logits.device)
+        else:
+            with torch.no_grad():
+                reference_all_logits, _, _ = self.concatenated_logits(reference_model, concatenated_batch, inputs)
+        all_logps_margin, all_position_kl, all_position_risk_ratio, all_logps, all_reference_tail_mass = self.get_batch_logps(all_logits, reference_all_logits, all_labels, cu_seqlens=cu_seqlens)
 
         chosen_logps_margin = all_logps_margin[:batch['chosen_combined_input_ids'].shape[0]]
         rejected_logps_margin = all_logps_margin[batch['chosen_combined_input_ids'].shape[0]:]
@@ -781,89 +1089,166 @@ class Ra_DPOTrainer(PairedPreferenceTrainer):
         rejected_logps = all_logps[batch['chosen_combined_input_ids'].shape[0]:].detach()
 
         return chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, \
-            chosen_position_risk_ratio, rejected_position_risk_ratio, chosen_logps, rejected_logps
+            chosen_position_risk_ratio, rejected_position_risk_ratio, chosen_logps, rejected_logps, all_reference_tail_mass
 
-    def get_batch_logps(self, logits: torch.FloatTensor, reference_logits: torch.FloatTensor, labels: torch.LongTensor):
+    def get_batch_logps(self, logits: torch.FloatTensor, reference_logits: torch.FloatTensor, labels: torch.LongTensor, cu_seqlens: Optional[torch.Tensor] = None):
         """Compute the kl divergence/log probabilities of the given labels under the given logits.
 
         Args:
             logits: Logits of the model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
             reference_logits: Logits of the reference model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
+                Alternatively, the sparse reference distribution at the response positions returned by ReferenceModelWrapper.get_reference_distributions.
             labels: Labels for which to compute the log probabilities. Label tokens with a value of -100 are ignored. Shape: (batch_size, sequence_length)
+            cu_seqlens: For packed sequences (batch_size of 1), their cumulative lengths, so that the sums are taken per sequence.
             
         Returns:
             Several tensors of shape (batch_size,) containing the average/sum kl divergence/log probabilities of the given labels under the given logits.
+            The risk ratio has shape (batch_size, len(self.confidence_levels)).
         """
         assert logits.shape[:-1] == labels.shape
-        assert reference_logits.shape[:-1] == labels.shape
 
-        labels = labels[:, 1:].clone()
-        logits = logits[:, :-1, :]
-        reference_logits = reference_logits[:, :-1, :]
+        loss_mask, labels, logits, reference_logits, reference, reference_tail_mass = self.response_position_inputs(logits, reference_logits, labels, cu_seqlens)
 
-        loss_mask = (labels != -100)
+        if self.var_estimator is not None:
+            # the thresholds are read once, before the estimator is updated, so that recomputing a chunk in the backward pass gives the same result
+            buckets = self.var_estimator.buckets((loss_mask.cumsum(-1) - 1)[loss_mask])
+            var_inputs = (self.var_estimator.thresholds(buckets),)
+        else:
+            var_inputs = ()
 
-        # dummy token; we'll ignore the losses on these tokens later
-        labels[labels == -100] = 0
+        if reference is not None:
+            logps_margin, per_position_kl, per_position_risk_ratio, per_token_logps, *var_stats = chunked_apply(
+                self.get_sparse_position_stats, logits, *reference, labels, *var_inputs, chunk_size=self.config.loss.chunk_size, dim=0
+            )
+        else:
+            logps_margin, per_position_kl, per_position_risk_ratio, per_token_logps, *var_stats = chunked_apply(
+                self.get_position_stats, logits, reference_logits, labels, *var_inputs, chunk_size=self.config.loss.chunk_size, dim=0
+            )
+
+        if var_stats:
+            # consumed by get_batch_metrics to update the estimator and measure its drift
+            self.var_stats = (*var_stats, buckets)
+
+        return sum_per_sequence(logps_margin, loss_mask), \
+            sum_per_sequence(per_position_kl, loss_mask), \
+            sum_per_sequence(per_position_risk_ratio, loss_mask), \
+            sum_per_sequence(per_token_logps, loss_mask), \
+            reference_tail_mass
 
+    def get_position_stats(self, logits: torch.FloatTensor, reference_logits: torch.FloatTensor, labels: torch.LongTensor,
+                           var_thresholds: Optional[torch.FloatTensor] = None):
+        """Compute the log probability margin, the sequential kl divergence, the risk ratio and the log probability of the label at every position.
+
+        Args:
+            logits: Logits of the model (unnormalized) at the response positions. Shape: (num_tokens, vocab_size)
+            reference_logits: Logits of the reference model (unnormalized) at the response positions. Shape: (num_tokens, vocab_size)
+            labels: Labels of the response positions. Shape: (num_tokens,)
+            var_thresholds: VaR thresholds of self.var_estimator at the response positions, if any. Shape: (num_tokens, num_parts, len(self.confidence_levels))
+
+        Returns:
+            Four tensors of shape (num_tokens,), except for the risk ratio, which has shape (num_tokens, len(self.confidence_levels)).
+            With var_thresholds, the two tensors returned by get_var_stats follow.
+        """
         distribution_logps = logits.float().log_softmax(-1) 
         
         reference_distribution_ps = reference_logits.float().softmax(-1)
         reference_distribution_logps = reference_distribution_ps.log()
 
         per_position_kl = (reference_distribution_ps * (reference_distribution_logps - distribution_logps)).sum(-1)
-        
 
         if not self.config.loss.is_cal_risk_distribution_logps:
-            per_position_risk_ratio = (self.calculate_cvar(reference_distribution_logps, distribution_logps, reference_distribution_ps, self.config.loss.confidence_level, self.config.loss.is_split_risk_ratio)).sum(-1)
+            per_position_risk_ratio = self.calculate_risk_ratio(reference_distribution_logps, distribution_logps, reference_distribution_ps, self.config.loss.is_split_risk_ratio, var_thresholds)
         else:
-            per_position_risk_ratio, reference_distribution_logps, distribution_logps = self.cal_risk_distribution_logps(reference_distribution_logps, distribution_logps, reference_distribution_ps, self.config.loss.confidence_level, self.config.loss.is_split_risk_ratio)
-            per_position_risk_ratio = (per_position_risk_ratio).sum(-1)
+            if len(self.confidence_levels) > 1:
+                raise ValueError("is_cal_risk_distribution_logps does not support more than one confidence level")
+
+            per_position_risk_ratio, reference_distribution_logps, distribution_logps = self.cal_risk_distribution_logps(reference_distribution_logps, distribution_logps, reference_distribution_ps, self.confidence_levels[0], self.config.loss.is_split_risk_ratio)
+            per_position_risk_ratio = (per_position_risk_ratio).sum(-1, keepdim=True)
     
-        per_token_logps = torch.gather(distribution_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2)
-        per_reference_token_logps = torch.gather(reference_distribution_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        per_token_logps = torch.gather(distribution_logps, dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+        per_reference_token_logps = torch.gather(reference_distribution_logps, dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
 
-        logps_margin = per_token_logps - per_reference_token_logps
+        if var_thresholds is not None:
+            return (per_token_logps - per_reference_token_logps, per_position_kl, per_position_risk_ratio, per_token_logps) + \
+                self.get_var_stats(reference_distribution_logps, distribution_logps, var_thresholds, self.config.loss.is_split_risk_ratio)
 
-        return (logps_margin * loss_mask).sum(-1), \
-            (per_position_kl * loss_mask).sum(-1), \
-            (per_position_risk_ratio * loss_mask).sum(-1), \
-            (per_token_logps * loss_mask).sum(-1)
+        return per_token_logps - per_reference_token_logps, per_position_kl, per_position_risk_ratio, per_token_logps
 
-    def calculate_cvar(self, reference_distribution, distribution, probabilities, confidence_level, is_split_risk_ratio = True):
-        """
-        Para: distribution, probabilities, confidence_level 
-        
-        Return: CVaR
+    def get_sparse_position_stats(self, logits: torch.FloatTensor, topk_ids: torch.LongTensor, topk_logps: torch.FloatTensor,
+                                  tail_logps: torch.FloatTensor, reference_label_logps: torch.FloatTensor, labels: torch.LongTensor,
+                                  var_thresholds: Optional[torch.FloatTensor] = None):
+        """Like get_position_stats, but with the reference distribution restricted to its top-k tokens plus one bucket for the rest of the vocabulary.
+
+        The risk measure is computed over the k + 1 entries of that support, without splitting the vocabulary.
+
+        Args:
+            logits: Logits of the model (unnormalized) at the response positions. Shape: (num_tokens, vocab_size)
+            topk_ids, topk_logps, tail_logps, reference_label_logps: The sparsified reference distribution (see utils.sparsify_reference_logits).
+            labels: Labels of the response positions. Shape: (num_tokens,)
+            var_thresholds: VaR thresholds of self.var_estimator at the response positions, if any. Shape: (num_tokens, 1, len(self.confidence_levels))
+
+        Returns:
+            Four tensors of shape (num_tokens,), except for the risk ratio, which has shape (num_tokens, len(self.confidence_levels)).
+            With var_thresholds, the two tensors returned by get_var_stats follow.
         """
-        distribution = reference_distribution - distribution
-        # split (chonsen & rejected)
-        if is_split_risk_ratio == True:
-            mid_index = distribution.size(2) // 2
+        if self.config.loss.is_cal_risk_distribution_logps:
+            raise ValueError("is_cal_risk_distribution_logps is not supported with a sparse (top-k) reference distribution")
 
-            chosen_distribution, rejected_distribution = distribution[:, :, :mid_index], distribution[:, :, mid_index:]
-            chosen_probabilities, rejected_probabilities = probabilities[:, :, :mid_index], probabilities[:, :, mid_index:]
+        support_logps, per_token_logps = sparse_support_logps(logits, topk_ids, labels)
 
-            chosen_VaR = torch.quantile(chosen_distribution, 1-confidence_level, dim=2).unsqueeze(-1)
-            rejected_VaR = torch.quantile(rejected_distribution, 1-confidence_level, dim=2).unsqueeze(-1)
+        reference_support_logps = torch.cat((topk_logps, tail_logps.unsqueeze(-1)), dim=-1)
+        reference_support_ps = reference_support_logps.exp()
+        per_position_kl = (reference_support_ps * (reference_support_logps - support_logps)).sum(-1)
+        per_position_risk_ratio = self.calculate_risk_ratio(reference_support_logps, support_logps, reference_support_ps, False, var_thresholds)
 
-            chosen_mask = chosen_distribution > chosen_VaR 
-            rejected_mask = rejected_distribution > rejected_VaR
+        if var_thresholds is not None:
+            return (per_token_logps - reference_label_logps, per_position_kl, per_position_risk_ratio, per_token_logps) + \
+                self.get_var_stats(reference_support_logps, support_logps, var_thresholds, False)
 
-            chosen_weighted_losses_above_VaR = chosen_probabilities * chosen_distribution * chosen_mask.float()
-            rejected_weighted_losses_above_VaR = rejected_probabilities * rejected_distribution * rejected_mask.float()
+        return per_token_logps - reference_label_logps, per_position_kl, per_position_risk_ratio, per_token_logps
 
-            CVaR = torch.cat((chosen_weighted_losses_above_VaR, rejected_weighted_losses_above_VaR), dim=2)
-        else:
-            VaR = torch.quantile(distribution, 1-confidence_level, dim=2).unsqueeze(-1)
+    def calculate_risk_ratio(self, reference_distribution_logps, distribution_logps, probabilities, is_split_risk_ratio = True, var_thresholds = None):
+        """
+        Para: reference_distribution_logps, distribution_logps, probabilities (of the reference model), is_split_risk_ratio,
+            var_thresholds (optional VaR of every part of the vocabulary, of shape (..., num_parts, len(self.confidence_levels)))
+
+        Return: the risk measure config.loss.risk_measure of the log ratios at every confidence level, summed over the two halves
+            of the vocabulary if is_split_risk_ratio. Shape: (..., len(self.confidence_levels))
+        """
+        losses = reference_distribution_logps - distribution_logps
+
+        # split (chonsen & rejected)
+        return sum(
+            compute_risk(self.config.loss.risk_measure, *half, self.confidence_levels,
+                         var=(None if var_thresholds is None else var_thresholds[:, i]),
+                         var_method=self.config.loss.var_method,
+                         theta=self.config.loss.entropic_theta,
+                         num_points=self.config.loss.evar_num_points,
+                         wang_lambda=self.config.loss.wang_lambda)
+            for i, half in enumerate(split_vocabulary(losses, probabilities, is_split=is_split_risk_ratio))
+        )
+
+    def get_var_stats(self, reference_distribution_logps, distribution_logps, var_thresholds, is_split_risk_ratio = True):
+        """
+        Para: reference_distribution_logps, distribution_logps, var_thresholds (see calculate_risk_ratio), is_split_risk_ratio
 
-            mask = distribution > VaR 
+        Return: the log ratios at config.loss.var_samples_per_position random tokens of every part of the vocabulary, with which
+            self.var_estimator is updated, of shape (..., num_parts, var_samples_per_position); and, if self.measure_var_drift, the
+            gap between var_thresholds and the exact VaR of every part, of shape (..., num_parts, len(self.confidence_levels)) (NaN otherwise)
+        """
+        samples, gaps = [], []
 
-            weighted_losses_above_VaR = probabilities * distribution * mask.float()
+        with torch.no_grad():
+            for i, (losses,) in enumerate(split_vocabulary(reference_distribution_logps - distribution_logps, is_split=is_split_risk_ratio)):
+                index = torch.randint(losses.size(-1), (losses.size(0), self.config.loss.var_samples_per_position), device=losses.device)
+                samples.append(losses.gather(-1, index))
 
-            CVaR = weighted_losses_above_VaR
+                if self.measure_var_drift:
+                    gaps.append(var_thresholds[:, i] - value_at_risk(losses, self.confidence_levels, self.config.loss.var_method))
+                else:
+                    gaps.append(torch.full_like(var_thresholds[:, i], float('nan')))
 
-        return CVaR
+        return torch.stack(samples, dim=1), torch.stack(gaps, dim=1)
 
     def cal_risk_distribution_logps(self, reference_distribution_logps, distribution_logps, probabilities, confidence_level, is_split_risk_ratio = True):
         """
@@ -871,73 +1256,33 @@ class Ra_DPOTrainer(PairedPreferenceTrainer):
         
         Return: CVaR, reference_distribution_logps_risk, distribution_logps_risk
         """
-
         # split (chonsen & rejected)
-        if is_split_risk_ratio == True:
-            mid_index = distribution_logps.size(2) // 2
-            
-            # split
-            chosen_reference_distribution_logps, rejected_reference_distribution_logps = reference_distribution_logps[:, :, :mid_index], reference_distribution_logps[:, :, mid_index:]
-            chosen_distribution_logps, rejected_distribution_logps = distribution_logps[:, :, :mid_index], distribution_logps[:, :, mid_index:]
-            
-            #  quantile
-            chosen_reference_distribution_logps_quantile = torch.quantile(chosen_reference_distribution_logps, 1-confidence_level, dim=2).unsqueeze(-1)
-            chosen_distribution_logps_quantile = torch.quantile(chosen_distribution_logps, 1-confidence_level, dim=2).unsqueeze(-1)
-            rejected_reference_distribution_logps_quantile = torch.quantile(rejected_reference_distribution_logps, 1-confidence_level, dim=2).unsqueeze(-1)
-            rejected_distribution_logps_quantile = torch.quantile(rejected_distribution_logps, 1-confidence_level, dim=2).unsqueeze(-1)
-
-            # mask
-            chosen_reference_distribution_logps_mask = chosen_reference_distribution_logps > chosen_reference_distribution_logps_quantile
-            chosen_distribution_logps_mask = chosen_distribution_logps > chosen_distribution_logps_quantile 
-            rejected_reference_distribution_logps_mask = rejected_reference_distribution_logps > rejected_reference_distribution_logps_quantile
-            rejected_distribution_logps_mask = rejected_distribution_logps > rejected_distribution_logps_quantile
-
-            # VaR
-            chosen_reference_distribution_logps_VaR = chosen_reference_distribution_logps_quantile * chosen_reference_distribution_logps_mask.float()
-            chosen_distribution_logps_VaR = chosen_distribution_logps_quantile * chosen_distribution_logps_mask.float()
-            rejected_reference_distribution_logps_VaR = rejected_reference_distribution_logps_quantile * rejected_reference_distribution_logps_mask.float()
-            rejected_distribution_logps_VaR = rejected_distribution_logps_quantile * rejected_distribution_logps_mask.float()
-             
-            # cal chosen_distribution & rejected_distribution
-            chosen_distribution = chosen_reference_distribution_logps_VaR - chosen_distribution_logps_VaR
-            rejected_distribution = rejected_reference_distribution_logps_VaR - rejected_distribution_logps_VaR
-
-            # cal reference_distribution_logps_risk & distribution_logps_risk
-            reference_distribution_logps_risk = torch.cat((chosen_reference_distribution_logps_VaR, rejected_reference_distribution_logps_VaR), dim=2)
-            distribution_logps_risk = torch.cat((chosen_distribution_logps_VaR, rejected_distribution_logps_VaR), dim=2)
-
-            # split chosen_probabilities & rejected_probabilities
-            chosen_probabilities, rejected_probabilities = probabilities[:, :, :mid_index], probabilities[:, :, mid_index:]
-
-            chosen_weighted_losses_above_VaR = chosen_probabilities * chosen_distribution
-            rejected_weighted_losses_above_VaR = rejected_probabilities * rejected_distribution
-
-            CVaR = torch.cat((chosen_weighted_losses_above_VaR, rejected_weighted_losses_above_VaR), dim=2)
-        else:
-            #  quantile
-            reference_distribution_logps_quantile = torch.quantile(reference_distribution_logps, 1-confidence_level, dim=2).unsqueeze(-1)
-            distribution_logps_quantile = torch.quantile(distribution_logps, 1-confidence_level, dim=2).unsqueeze(-1)
-           
-            # mask
-            reference_distribution_logps_mask = reference_distribution_logps > reference_distribution_logps_quantile
-            distribution_logps_mask = distribution_logps > distribution_logps_quantile 
-
-            # VaR
-            reference_distribution_logps_VaR = reference_distribution_logps_quantile * reference_distribution_logps_mask.float()
-            distribution_logps_VaR = distribution_logps_quantile * distribution_logps_mask.float()
-            
-            # cal chosen_distribution & rejected_distribution
-            distribution = reference_distribution_logps_VaR - distribution_logps_VaR
+        halves = [ self._cal_risk_distribution_logps(*half, confidence_level) for half in 
+                   split_vocabulary(reference_distribution_logps, distribution_logps, probabilities, is_split=is_split_risk_ratio) ]
+        CVaR, reference_distribution_logps_risk, distribution_logps_risk = [ torch.cat(x, dim=-1) for x in zip(*halves) ]
 
-            # cal reference_distribution_logps_risk & distribution_logps_risk
-            reference_distribution_logps_risk = reference_distribution_logps_VaR
-            distribution_logps_risk = distribution_logps_VaR
+        return CVaR, reference_distribution_logps_risk, distribution_logps_risk
 
-            weighted_losses_above_VaR = probabilities * distribution
+    def _cal_risk_distribution_logps(self, reference_distribution_logps, distribution_logps, probabilities, confidence_level):
+        """cal_risk_distribution_logps over one part of the vocabulary."""
+        #  quantile
+        reference_distribution_logps_quantile = value_at_risk(reference_distribution_logps, confidence_level, self.config.loss.var_method)
+        distribution_logps_quantile = value_at_risk(distribution_logps, confidence_level, self.config.loss.var_method)
+       
+        # mask
+        reference_distribution_logps_mask = reference_distribution_logps > reference_distribution_logps_quantile
+        distribution_logps_mask = distribution_logps > distribution_logps_quantile 
+
+        # VaR
+        reference_distribution_logps_VaR = reference_distribution_logps_quantile * reference_distribution_logps_mask.float()
+        distribution_logps_VaR = distribution_logps_quantile * distribution_logps_mask.float()
+        
+        # cal distribution
+        distribution = reference_distribution_logps_VaR - distribution_logps_VaR
 
-            CVaR = weighted_losses_above_VaR
+        weighted_losses_above_VaR = probabilities * distribution
 
-        return CVaR, reference_distribution_logps_risk, distribution_logps_risk
+        return weighted_losses_above_VaR, reference_distribution_logps_VaR, distribution_logps_VaR
 
 
     def get_batch_metrics(self, batch: Dict[str, Union[List, torch.LongTensor]], mode: str='train'):
@@ -945,35 +1290,82 @@ class Ra_DPOTrainer(PairedPreferenceTrainer):
 
         metrics = {}
 
-        chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, chosen_position_risk_ratio, rejected_position_risk_ratio, policy_chosen_logps, policy_rejected_logps\
-            = self.forward(self.policy, self.reference_model, batch)
-        losses, chosen_rewards, rejected_rewards = self.loss(chosen_logps_margin, rejected_logps_margin,
-                                                                chosen_position_risk_ratio, rejected_position_risk_ratio,
-                                                                beta=self.config.loss.beta, alpha=self.config.loss.alpha, if_ra_dpo2=self.config.loss.if_ra_dpo2)
+        if self.var_estimator is not None:
+            self.measure_var_drift = mode != 'train' or self.batch_counter % self.config.loss.var_drift_every == 0
 
-        reward_accuracies = (chosen_rewards > rejected_rewards).float()
-
-        metrics[f'KL_{mode}/chosen'] = self.accelerator.gather(chosen_position_kl.detach())
-        metrics[f'KL_{mode}/rejected'] = self.accelerator.gather(rejected_position_kl.detach())
-        metrics[f'KL_{mode}/margins'] = self.accelerator.gather((chosen_position_kl - rejected_position_kl).detach())
+        chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, chosen_position_risk_ratio, rejected_position_risk_ratio, policy_chosen_logps, policy_rejected_logps, reference_tail_mass\
+            = self.forward(self.policy, self.reference_model, batch)
 
-        metrics[f'risk_ratio_{mode}/chosen'] = self.accelerator.gather(chosen_position_risk_ratio.detach())
-        metrics[f'risk_ratio_{mode}/rejected'] = self.accelerator.gather(rejected_position_risk_ratio.detach())
-        metrics[f'risk_ratio_{mode}/margins'] = self.accelerator.gather((chosen_position_risk_ratio - rejected_position_risk_ratio).detach())
+        if self.var_estimator is not None:
+            var_samples, var_gaps, buckets = self.var_stats
+
+            if mode == 'train':
+                # every process updates its estimator with the samples of all processes, so the estimators stay identical
+                grid = self.accelerator.gather(self.var_estimator.sample_grid(var_samples, buckets).unsqueeze(0))
+                self.var_estimator.update(grid.transpose(0, 1).flatten(1))
+
+            if self.measure_var_drift and not var_gaps.isnan().all():
+                # gap between the estimated VaR and the exact per-position VaR of the current batch
+                metrics[f'var_drift_{mode}/abs_gap'] = self.gather_metric(var_gaps.abs().nanmean().detach())
+                metrics[f'var_drift_{mode}/gap'] = self.gather_metric(var_gaps.nanmean().detach())
+
+            del self.var_stats
+        # one column per confidence level, of which the first is optimized
+        all_losses, all_chosen_rewards, all_rejected_rewards = self.loss(chosen_logps_margin.unsqueeze(-1), rejected_logps_margin.unsqueeze(-1),
+                                                                         chosen_position_risk_ratio, rejected_position_risk_ratio,
+                                                                         beta=self.config.loss.beta, alpha=self.config.loss.alpha, if_ra_dpo2=self.config.loss.if_ra_dpo2)
+        all_reward_accuracies = (all_chosen_rewards > all_rejected_rewards).float()
+
+        if len(self.confidence_levels) > 1:
+            for i, confidence_level in enumerate(self.confidence_levels):
+                metrics[f'risk_ratio_{mode}/chosen_cl{confidence_level}'] = self.gather_metric(chosen_position_risk_ratio[:, i].detach())
+                metrics[f'risk_ratio_{mode}/rejected_cl{confidence_level}'] = self.gather_metric(rejected_position_risk_ratio[:, i].detach())
+                metrics[f'risk_ratio_{mode}/margins_cl{confidence_level}'] = self.gather_metric((chosen_position_risk_ratio[:, i] - rejected_position_risk_ratio[:, i]).detach())
+                metrics[f'rewards_{mode}/margins_cl{confidence_level}'] = self.gather_metric((all_chosen_rewards[:, i] - all_rejected_rewards[:, i]).detach())
+                metrics[f'rewards_{mode}/accuracies_cl{confidence_level}'] = self.gather_metric(all_reward_accuracies[:, i].detach())
+                metrics[f'loss/{mode}_cl{confidence_level}'] = self.gather_metric(all_losses[:, i].mean().detach()).mean()
+
+        losses, chosen_rewards, rejected_rewards, reward_accuracies = all_losses[:, 0], all_chosen_rewards[:, 0], all_rejected_rewards[:, 0], all_reward_accuracies[:, 0]
+        chosen_position_risk_ratio, rejected_position_risk_ratio = chosen_position_risk_ratio[:, 0], rejected_position_risk_ratio[:, 0]
+
+        metrics[f'KL_{mode}/chosen'] = self.gather_metric(chosen_position_kl.detach())
+        metrics[f'KL_{mode}/rejected'] = self.gather_metric(rejected_position_kl.detach())
+        metrics[f'KL_{mode}/margins'] = self.gather_metric((chosen_position_kl - rejected_position_kl).detach())
+
+        if reference_tail_mass is not None:
+            # probability mass of the reference distribution that is dropped by the top-k approximation
+            metrics[f'reference_tail_mass_{mode}'] = self.gather_metric(reference_tail_mass.detach())
+
+        metrics[f'risk_ratio_{mode}/chosen'] = self.gather_metric(chosen_position_risk_ratio.detach())
+        metrics[f'risk_ratio_{mode}/rejected'] = self.gather_metric(rejected_position_risk_ratio.detach())
+        metrics[f'risk_ratio_{mode}/margins'] = self.gather_metric((chosen_position_risk_ratio - rejected_position_risk_ratio).detach())
         
-        metrics[f'rewards_{mode}/chosen'] = self.accelerator.gather(chosen_rewards.detach())
-        metrics[f'rewards_{mode}/rejected'] = self.accelerator.gather(rejected_rewards.detach())
-        metrics[f'rewards_{mode}/margins'] = self.accelerator.gather((chosen_rewards - rejected_rewards).detach())
+        metrics[f'rewards_{mode}/chosen'] = self.gather_metric(chosen_rewards.detach())
+        metrics[f'rewards_{mode}/rejected'] = self.gather_metric(rejected_rewards.detach())
+        metrics[f'rewards_{mode}/margins'] = self.gather_metric((chosen_rewards - rejected_rewards).detach())
 
-        metrics[f'rewards_{mode}/accuracies'] = self.accelerator.gather(reward_accuracies.detach())
-        metrics[f'loss/{mode}'] = self.accelerator.gather(losses.mean().detach()).mean()
+        metrics[f'rewards_{mode}/accuracies'] = self.gather_metric(reward_accuracies.detach())
+        metrics[f'loss/{mode}'] = self.gather_metric(losses.mean().detach()).mean()
 
         del chosen_rewards, rejected_rewards, reward_accuracies, policy_chosen_logps, policy_rejected_logps
 
         return losses.sum(), metrics
 
 
+    def save(self, output_dir: Optional[str] = None, metrics: Optional[Dict] = {}, final_save=True):
+        """Save tokenizer, policy model, optimizer, scheduler state and VaR estimator (if any) to disk."""
+        if output_dir is None:
+            output_dir = os.path.join(self.run_dir, f'step-{self.example_counter}')
+
+        super().save(output_dir, metrics, final_save)
+
+        if self.var_estimator is not None and self.accelerator.is_main_process:
+            torch.save(self.var_estimator.state_dict(), os.path.join(output_dir, 'var_estimator.pt'))
+
+
 class CDPOTrainer(PairedPreferenceTrainer):
+    sums_reference_logps = True
+
     def loss(self,
         policy_chosen_logps: torch.FloatTensor,
         policy_rejected_logps: torch.FloatTensor,
@@ -1018,6 +1410,8 @@ class SLiCTrainer(PairedPreferenceTrainer):
 
 
 class KTOTrainer(UnpairedPreferenceTrainer):
+    sums_reference_logps = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.previous_KL = 0
@@ -1101,7 +1495,7 @@ class KTOTrainer(UnpairedPreferenceTrainer):
         with self.accelerator.autocast():
             with torch.no_grad():
                 if use_cache:
-                    KL_logps = model(batch[f'KL_combined_input_ids']).to(self.policy_dtype).to(self.accelerator.device)
+                    KL_logps = model(batch[f'KL_combined_input_ids'], batch[f'KL_example_id'], dtype=self.policy_dtype, device=self.accelerator.device)
                 else:
                     KL_logits = model(
                         batch[f'KL_combined_input_ids'],
@@ -1111,7 +1505,7 @@ class KTOTrainer(UnpairedPreferenceTrainer):
                     KL_logps = self.get_batch_logps(KL_logits, batch[f'KL_labels'])
 
             if use_cache:
-                target_logps = model(batch[f'target_combined_input_ids']).to(self.policy_dtype).to(self.accelerator.device)
+                target_logps = model(batch[f'target_combined_input_ids'], batch[f'target_example_id'], dtype=self.policy_dtype, device=self.accelerator.device)
             else:
                 target_logits = model(
                     batch[f'target_combined_input_ids'],
@@ -1134,7 +1528,7 @@ class KTOTrainer(UnpairedPreferenceTrainer):
 
         policy_chosen_logps, policy_rejected_logps, policy_chosen_KL_logps, policy_rejected_KL_logps = self.forward(self.policy, batch)
         with torch.no_grad():
-            reference_chosen_logps, reference_rejected_logps, reference_chosen_KL_logps, reference_rejected_KL_logps = self.forward(self.reference_model, batch, use_cache=self.config.cache_reference_logprobs)
+            reference_chosen_logps, reference_rejected_logps, reference_chosen_KL_logps, reference_rejected_KL_logps = self.forward(self.reference_model, batch, use_cache=self.cached_reference)
         
         losses, chosen_rewards, rejected_rewards, KL = self.loss(
             policy_chosen_logps,
@@ -1169,6 +1563,8 @@ class KTOTrainer(UnpairedPreferenceTrainer):
 
 
 class KTOZeroTrainer(UnpairedPreferenceTrainer):
+    sums_reference_logps = True
+
     def loss(self,
         policy_chosen_logps: torch.FloatTensor,
         policy_rejected_logps: torch.FloatTensor,
@@ -1250,7 +1646,7 @@ class PPOTrainer(BasicTrainer):
             all_values = all_values[:, :-1].contiguous()
         else: # if reference
             if use_cache:
-                all_logps = model(batch['target_combined_input_ids']).to(self.policy_dtype).to(self.accelerator.device)
+                all_logps = model(batch['target_combined_input_ids'], batch['target_example_id'], dtype=self.policy_dtype, device=self.accelerator.device)
             else:
                 all_logits = model(batch['target_combined_input_ids'], attention_mask=batch['target_combined_attention_mask']).logits.to(self.policy_dtype)
                 all_values = None
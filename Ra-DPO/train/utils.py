@@ -7,10 +7,11 @@ import os
 from datetime import datetime
 import torch
 import torch.distributed as dist
+from torch.utils.checkpoint import checkpoint
 import inspect
 import importlib.util
 import os
-from typing import Dict, Union, Type, List
+from typing import Dict, Union, Type, List, Callable, Optional, Tuple
 from collections.abc import Mapping
 
 import huggingface_hub
@@ -80,6 +81,201 @@ def pad_to_length(tensor: torch.Tensor, length: int, pad_value: Union[int, float
         return torch.cat([tensor, pad_value * torch.ones(*pad_size, dtype=tensor.dtype, device=tensor.device)], dim=dim)
 
 
+def pack_response_positions(labels: torch.LongTensor, *tensors: torch.Tensor, cu_seqlens: Optional[torch.Tensor] = None) -> Tuple[torch.BoolTensor, torch.LongTensor, Tuple[torch.Tensor, ...]]:
+    """
+    Gather the positions whose labels are not -100 (i.e., the response tokens) into dense tensors, before any math is
+    done over the vocabulary. The labels are shifted one to the left, so that the logits at position t are paired with
+    the label at position t + 1.
+
+    Args:
+        labels: tensor of shape (batch_size, sequence_length), with -100 for the positions to ignore
+        tensors: tensors of shape (batch_size, sequence_length, ...) that are aligned with the (unshifted) labels
+        cu_seqlens: if the batch is a single row of packed sequences (see dataloader.DataLoader.pack), the cumulative
+            sequence lengths, of shape (num_sequences + 1,); the first label of every sequence must be -100
+
+    Returns:
+        loss_mask: boolean tensor of shape (batch_size, sequence_length - 1) marking the gathered positions, or of shape
+            (num_sequences, max_sequence_length - 1) for packed sequences, so that the values of every sequence can be
+            summed with sum_per_sequence
+        packed_labels: tensor of shape (num_tokens,)
+        packed_tensors: tuple of tensors of shape (num_tokens, ...)
+    """
+    labels = labels[:, 1:]
+    loss_mask = (labels != -100)
+    packed_tensors = tuple(t[:, :-1][loss_mask] for t in tensors)
+    packed_labels = labels[loss_mask]
+
+    if cu_seqlens is not None:
+        # the last position of every sequence is never gathered, so the positions keep their order in the per-sequence mask
+        loss_mask = unpack_sequences(torch.cat((loss_mask[0], loss_mask.new_zeros(1))), cu_seqlens)[:, :-1]
+
+    return loss_mask, packed_labels, packed_tensors
+
+
+def unpack_sequences(values: torch.Tensor, cu_seqlens: torch.Tensor, padding_value: Union[int, float] = 0) -> torch.Tensor:
+    """
+    Scatter the values of packed sequences into a right-padded tensor.
+
+    Args:
+        values: tensor of shape (total_length, ...)
+        cu_seqlens: cumulative sequence lengths, of shape (num_sequences + 1,)
+        padding_value: value of the padding
+
+    Returns:
+        Tensor of shape (num_sequences, max_sequence_length, ...).
+    """
+    lengths = cu_seqlens.diff().long()
+    sequence_idx = torch.repeat_interleave(torch.arange(len(lengths), device=values.device), lengths)
+    position_idx = torch.arange(values.shape[0], device=values.device) - cu_seqlens.long()[sequence_idx]
+
+    unpacked = values.new_full((len(lengths), int(lengths.max())) + values.shape[1:], padding_value)
+    unpacked[sequence_idx, position_idx] = values
+    return unpacked
+
+
+def block_diagonal_causal_mask(cu_seqlens: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Additive attention mask that lets every token of packed sequences attend to itself and the previous tokens of its own
+    sequence only, in the inverted form accepted by HF models as a custom 4D mask.
+
+    Args:
+        cu_seqlens: cumulative sequence lengths, of shape (num_sequences + 1,)
+        dtype: dtype of the mask (that of the model's hidden states)
+
+    Returns:
+        Tensor of shape (1, 1, total_length, total_length), with 0 where attention is allowed and the smallest value of dtype elsewhere.
+    """
+    lengths = cu_seqlens.diff().long()
+    sequence_idx = torch.repeat_interleave(torch.arange(len(lengths), device=cu_seqlens.device), lengths)
+    allowed = (sequence_idx.unsqueeze(-1) == sequence_idx.unsqueeze(0)).tril()
+    return torch.zeros(allowed.shape, dtype=dtype, device=cu_seqlens.device).masked_fill(~allowed, torch.finfo(dtype).min)[None, None]
+
+
+def unpack_positions(values: torch.Tensor, loss_mask: torch.BoolTensor) -> torch.Tensor:
+    """
+    Scatter per-token values produced by pack_response_positions back to their positions, with zeros elsewhere.
+
+    Args:
+        values: tensor of shape (num_tokens,)
+        loss_mask: boolean tensor of shape (batch_size, sequence_length - 1)
+
+    Returns:
+        Tensor of shape (batch_size, sequence_length - 1).
+    """
+    return values.new_zeros(loss_mask.shape).masked_scatter(loss_mask, values)
+
+
+def sum_per_sequence(values: torch.Tensor, loss_mask: torch.BoolTensor) -> torch.Tensor:
+    """
+    Sum per-token values produced by pack_response_positions over the tokens of each sequence.
+
+    Args:
+        values: tensor of shape (num_tokens, ...)
+        loss_mask: boolean tensor of shape (batch_size, sequence_length - 1)
+
+    Returns:
+        Tensor of shape (batch_size, ...).
+    """
+    sequence_idx = loss_mask.nonzero()[:, 0]
+    return values.new_zeros((loss_mask.shape[0],) + values.shape[1:]).index_add(0, sequence_idx, values)
+
+
+def chunked_apply(fn: Callable[..., Tuple[torch.Tensor, ...]], *tensors: torch.Tensor, chunk_size: Optional[int] = None, dim: int = 1) -> Tuple[torch.Tensor, ...]:
+    """
+    Apply fn to consecutive chunks of the given tensors along dim and concatenate the outputs along the same dim.
+
+    fn must act independently on every index of dim (e.g., on every position of a sequence) and return a tuple of
+    tensors. When gradients are needed, each chunk is checkpointed, so that only the chunk inputs are saved for the
+    backward pass and fn is recomputed there. The gradients are exact, and the peak memory of the intermediate
+    tensors created by fn is bounded by the chunk size instead of the full size of dim.
+
+    Args:
+        fn: function taking one chunk of each tensor and returning a tuple of tensors
+        tensors: tensors that all have the same size along dim
+        chunk_size: number of indices per chunk; if None, fn is applied to the full tensors without checkpointing
+        dim: dimension to chunk over
+
+    Returns:
+        The tuple returned by fn, as if it had been applied to the full tensors.
+    """
+    if chunk_size is None or tensors[0].size(dim) == 0:
+        return fn(*tensors)
+
+    needs_grad = torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+    outputs = []
+
+    for start in range(0, tensors[0].size(dim), chunk_size):
+        chunk = [ t.narrow(dim, start, min(chunk_size, t.size(dim) - start)) for t in tensors ]
+        if needs_grad:
+            outputs.append(checkpoint(fn, *chunk, use_reentrant=False))
+        else:
+            outputs.append(fn(*chunk))
+
+    return tuple(torch.cat(output, dim=dim) for output in zip(*outputs))
+
+
+def split_shared_prefix(input_ids: torch.LongTensor, attention_mask: torch.LongTensor, labels: torch.LongTensor) -> Dict[str, torch.Tensor]:
+    """
+    Split right-padded chosen/rejected sequences, concatenated as in PairedPreferenceTrainer.concatenated_inputs (the
+    first half chosen, the second half rejected), into the prefix that each pair shares and the two continuations.
+
+    The shared prefix of a pair is its longest common prefix, stopped before the last prompt token, so that the logit
+    predicting the first response token is computed in the continuation. The prefix can be encoded once and its KV cache
+    reused for both continuations (see PairedPreferenceTrainer.shared_prefix_logits).
+
+    Args:
+        input_ids: tensor of shape (2 * num_pairs, sequence_length)
+        attention_mask: tensor of shape (2 * num_pairs, sequence_length), ones followed by zeros
+        labels: tensor of shape (2 * num_pairs, sequence_length), with -100 for the prompt and padding
+
+    Returns:
+        A dict with
+            prefix_input_ids, prefix_attention_mask: tensors of shape (num_pairs, prefix_length), right-padded
+            continuation_input_ids, continuation_labels, continuation_position_ids: tensors of shape (2 * num_pairs,
+                continuation_length), right-padded; the labels are -100 over the padding
+            continuation_attention_mask: tensor of shape (2 * num_pairs, prefix_length + continuation_length) over the
+                prefix (repeated for both halves) and the continuation
+    """
+    num_pairs = input_ids.shape[0] // 2
+    valid = attention_mask.bool()
+
+    same = (input_ids[:num_pairs] == input_ids[num_pairs:]) & valid[:num_pairs] & valid[num_pairs:]
+    common_lengths = same.long().cumprod(-1).sum(-1)
+    # index of the first response token (0 if there is none, in which case nothing is shared)
+    response_starts = (labels != -100).long().argmax(-1)
+    prompt_ends = torch.minimum(response_starts[:num_pairs], response_starts[num_pairs:])
+    prefix_lengths = torch.minimum(common_lengths, prompt_ends - 1).clamp(min=0)
+
+    prefix_length = int(prefix_lengths.max())
+    prefix_attention_mask = (torch.arange(prefix_length, device=input_ids.device) < prefix_lengths.unsqueeze(-1)).long()
+    prefix_input_ids = input_ids[:num_pairs, :prefix_length] * prefix_attention_mask
+
+    starts = prefix_lengths.repeat(2)
+    continuation_lengths = valid.sum(-1) - starts
+    continuation_length = int(continuation_lengths.max())
+    continuation_mask = torch.arange(continuation_length, device=input_ids.device) < continuation_lengths.unsqueeze(-1)
+    # the padding past the end of a sequence is clamped to its last position, which keeps the position ids in range
+    continuation_position_ids = (starts.unsqueeze(-1) + torch.arange(continuation_length, device=input_ids.device)).clamp(max=input_ids.shape[1] - 1)
+
+    return {
+        'prefix_input_ids': prefix_input_ids,
+        'prefix_attention_mask': prefix_attention_mask,
+        'continuation_input_ids': input_ids.gather(1, continuation_position_ids) * continuation_mask,
+        'continuation_labels': labels.gather(1, continuation_position_ids).masked_fill(~continuation_mask, -100),
+        'continuation_position_ids': continuation_position_ids,
+        'continuation_attention_mask': torch.cat((prefix_attention_mask.repeat(2, 1), continuation_mask.long()), dim=1),
+    }
+
+
+def repeat_past_key_values(past_key_values, repeats: int):
+    """Repeat a KV cache (legacy tuple of (key, value) per layer or a transformers Cache) along the batch dimension."""
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        legacy_cache = repeat_past_key_values(past_key_values.to_legacy_cache(), repeats)
+        return type(past_key_values).from_legacy_cache(legacy_cache)
+
+    return tuple(tuple(t.repeat(repeats, *([1] * (t.dim() - 1))) for t in layer) for layer in past_key_values)
+
+
 def clip_by_value(x, tensor_min, tensor_max):
     """
     Tensor extenstion to torch.clamp
@@ -122,6 +318,61 @@ def rowwise_product(mat: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     return mat.prod(dim=1)
 
 
+def log1mexp(x: torch.Tensor) -> torch.Tensor:
+    """
+    Compute log(1 - exp(x)) for x <= 0 in a numerically stable way. x is clamped slightly below zero, so that an
+    (almost) empty probability mass gives a very small log probability instead of -inf.
+    """
+    x = x.clamp(max=-torch.finfo(torch.float32).eps)
+    return torch.where(x > -0.6931, torch.log(-torch.expm1(x)), torch.log1p(-torch.exp(x)))
+
+
+def sparsify_reference_logits(reference_logits: torch.Tensor, labels: torch.LongTensor, k: int) -> Tuple[torch.LongTensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Compress the reference distribution at each position into its top-k tokens plus one bucket that lumps together
+    the probability mass of all the other tokens.
+
+    Args:
+        reference_logits: tensor of shape (num_tokens, vocab_size)
+        labels: tensor of shape (num_tokens,) of the tokens whose reference log probabilities are needed
+        k: number of tokens to keep (capped at vocab_size - 1)
+
+    Returns:
+        topk_ids: tensor of shape (num_tokens, k) of the ids of the kept tokens
+        topk_logps: tensor of shape (num_tokens, k) of their log probabilities
+        tail_logps: tensor of shape (num_tokens,) of the log probability of the lumped bucket
+        label_logps: tensor of shape (num_tokens,) of the log probabilities of the labels
+    """
+    reference_logits = reference_logits.float()
+    normalizer = reference_logits.logsumexp(-1, keepdim=True)
+    topk_logits, topk_ids = reference_logits.topk(min(k, reference_logits.size(-1) - 1), dim=-1)
+    topk_logps = topk_logits - normalizer
+    tail_logps = log1mexp(topk_logps.logsumexp(-1))
+    label_logps = (torch.gather(reference_logits, dim=-1, index=labels.unsqueeze(-1)) - normalizer).squeeze(-1)
+    return topk_ids, topk_logps, tail_logps, label_logps
+
+
+def sparse_support_logps(logits: torch.Tensor, topk_ids: torch.LongTensor, labels: torch.LongTensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the log probabilities of a model on the support of a sparsified reference distribution, i.e., on the
+    top-k tokens of the reference and the bucket lumping the rest of the vocabulary.
+
+    Args:
+        logits: tensor of shape (num_tokens, vocab_size)
+        topk_ids: tensor of shape (num_tokens, k) returned by sparsify_reference_logits
+        labels: tensor of shape (num_tokens,)
+
+    Returns:
+        support_logps: tensor of shape (num_tokens, k + 1), where the last entry is the bucket
+        label_logps: tensor of shape (num_tokens,) of the log probabilities of the labels
+    """
+    normalizer = logits.float().logsumexp(-1, keepdim=True)
+    topk_logps = torch.gather(logits, dim=-1, index=topk_ids).float() - normalizer
+    tail_logps = log1mexp(topk_logps.logsumexp(-1))
+    label_logps = (torch.gather(logits, dim=-1, index=labels.unsqueeze(-1)).float() - normalizer).squeeze(-1)
+    return torch.cat((topk_logps, tail_logps.unsqueeze(-1)), dim=-1), label_logps
+
+
 def entropy_from_logits(logits: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     """Calculate entropy from logits.
     